@@ -100,6 +100,10 @@ class coco(imdb):
         widths = [ann['width'] for ann in anns]
         return widths
 
+    def image_sizes(self):
+        anns = self._COCO.loadImgs(self._image_index)
+        return [(ann['width'], ann['height']) for ann in anns]
+
     def image_path_at(self, i):
         """
         Return the absolute path to image i in the image sequence.
@@ -129,6 +133,19 @@ class coco(imdb):
     def mcg_roidb(self):
         return self._roidb_from_proposals('MCG')
 
+    # proposal method name -> directory of the precomputed proposals
+    _PROPOSAL_DIRS = {'selective_search': 'selective_search',
+                      'edge_boxes': 'edge_boxes_AR',
+                      'mcg': 'MCG'}
+
+    def get_proposal_loader(self, method):
+        """Read test proposals one image at a time, without the roidb."""
+        if method not in self._PROPOSAL_DIRS:
+            return None
+        method = self._PROPOSAL_DIRS[method]
+        return lambda i: self._load_proposal_boxes(method,
+                                                   self._image_index[i])
+
     def _roidb_from_proposals(self, method):
         """
         Creates a roidb from pre-computed proposals of a particular methods.
@@ -169,6 +186,15 @@ class coco(imdb):
         lib/datasets/tools/mcg_munge.py.
         """
         box_list = []
+        print 'Loading {} boxes'.format(method)
+        for i, index in enumerate(self._image_index):
+            if i % 1000 == 0:
+                print '{:d} / {:d}'.format(i + 1, len(self._image_index))
+            box_list.append(self._load_proposal_boxes(method, index))
+        return self.create_roidb_from_box_list(box_list, gt_roidb)
+
+    def _load_proposal_boxes(self, method, index):
+        """Load the top k proposals of method for one image."""
         top_k = self.config['top_k']
         valid_methods = [
             'MCG',
@@ -177,33 +203,27 @@ class coco(imdb):
             'edge_boxes_70']
         assert method in valid_methods
 
-        print 'Loading {} boxes'.format(method)
-        for i, index in enumerate(self._image_index):
-            if i % 1000 == 0:
-                print '{:d} / {:d}'.format(i + 1, len(self._image_index))
-
-            box_file = osp.join(
-                cfg.DATA_DIR, 'coco_proposals', method, 'mat',
-                self._get_box_file(index))
-
-            raw_data = sio.loadmat(box_file)['boxes']
-            boxes = np.maximum(raw_data - 1, 0).astype(np.uint16)
-            if method == 'MCG':
-                # Boxes from the MCG website are in (y1, x1, y2, x2) order
-                boxes = boxes[:, (1, 0, 3, 2)]
-            # Remove duplicate boxes and very small boxes and then take top k
-            keep = ds_utils.unique_boxes(boxes)
-            boxes = boxes[keep, :]
-            keep = ds_utils.filter_small_boxes(boxes, self.config['min_size'])
-            boxes = boxes[keep, :]
-            boxes = boxes[:top_k, :]
-            box_list.append(boxes)
-            # Sanity check
-            im_ann = self._COCO.loadImgs(index)[0]
-            width = im_ann['width']
-            height = im_ann['height']
-            ds_utils.validate_boxes(boxes, width=width, height=height)
-        return self.create_roidb_from_box_list(box_list, gt_roidb)
+        box_file = osp.join(
+            cfg.DATA_DIR, 'coco_proposals', method, 'mat',
+            self._get_box_file(index))
+
+        raw_data = sio.loadmat(box_file)['boxes']
+        boxes = np.maximum(raw_data - 1, 0).astype(np.uint16)
+        if method == 'MCG':
+            # Boxes from the MCG website are in (y1, x1, y2, x2) order
+            boxes = boxes[:, (1, 0, 3, 2)]
+        # Remove duplicate boxes and very small boxes and then take top k
+        keep = ds_utils.unique_boxes(boxes)
+        boxes = boxes[keep, :]
+        keep = ds_utils.filter_small_boxes(boxes, self.config['min_size'])
+        boxes = boxes[keep, :]
+        boxes = boxes[:top_k, :]
+        # Sanity check
+        im_ann = self._COCO.loadImgs(index)[0]
+        width = im_ann['width']
+        height = im_ann['height']
+        ds_utils.validate_boxes(boxes, width=width, height=height)
+        return boxes
 
     def gt_roidb(self):
         """
@@ -333,43 +353,37 @@ class coco(imdb):
             cPickle.dump(coco_eval, fid, cPickle.HIGHEST_PROTOCOL)
         print 'Wrote COCO eval results to: {}'.format(eval_file)
 
-    def _coco_results_one_category(self, boxes, cat_id):
-        results = []
-        for im_ind, index in enumerate(self.image_index):
-            dets = boxes[im_ind].astype(np.float)
-            if dets == []:
-                continue
-            scores = dets[:, -1]
-            xs = dets[:, 0]
-            ys = dets[:, 1]
-            ws = dets[:, 2] - xs + 1
-            hs = dets[:, 3] - ys + 1
-            results.extend(
-              [{'image_id' : index,
-                'category_id' : cat_id,
-                'bbox' : [xs[k], ys[k], ws[k], hs[k]],
-                'score' : scores[k]} for k in xrange(dets.shape[0])])
-        return results
-
-    def _write_coco_results_file(self, all_boxes, res_file):
+    def _write_coco_results_file(self, detections, res_file):
         # [{"image_id": 42,
         #   "category_id": 18,
         #   "bbox": [258.15,41.29,348.26,243.78],
         #   "score": 0.236}, ...]
-        results = []
-        for cls_ind, cls in enumerate(self.classes):
-            if cls == '__background__':
-                continue
-            print 'Collecting {} results ({:d}/{:d})'.format(cls, cls_ind,
-                                                          self.num_classes - 1)
-            coco_cat_id = self._class_to_coco_cat_id[cls]
-            results.extend(self._coco_results_one_category(all_boxes[cls_ind],
-                                                           coco_cat_id))
+        cat_ids = np.array([self._class_to_coco_cat_id.get(cls, -1)
+                            for cls in self.classes])
+        # group by category, keeping the image order inside each category
+        order = np.argsort(detections.classes, kind='mergesort')
+        order = order[detections.classes[order] > 0]
+        print 'Collecting {:d} results'.format(len(order))
+        dets = detections.boxes[order, :].astype(np.float)
+        xs = dets[:, 0]
+        ys = dets[:, 1]
+        ws = dets[:, 2] - xs + 1
+        hs = dets[:, 3] - ys + 1
+        results = [{'image_id' : index,
+                    'category_id' : cat_id,
+                    'bbox' : [x, y, w, h],
+                    'score' : score}
+                   for index, cat_id, x, y, w, h, score in zip(
+                       np.asarray(self.image_index)[
+                           detections.images[order]].tolist(),
+                       cat_ids[detections.classes[order]].tolist(),
+                       xs.tolist(), ys.tolist(), ws.tolist(), hs.tolist(),
+                       detections.scores[order].astype(np.float).tolist())]
         print 'Writing results json to {}'.format(res_file)
         with open(res_file, 'w') as fid:
             json.dump(results, fid)
 
-    def evaluate_detections(self, all_boxes, output_dir):
+    def evaluate_detections(self, detections, output_dir):
         res_file = osp.join(output_dir, ('detections_' +
                                          self._image_set +
                                          self._year +
@@ -377,7 +391,8 @@ class coco(imdb):
         if self.config['use_salt']:
             res_file += '_{}'.format(str(uuid.uuid4()))
         res_file += '.json'
-        self._write_coco_results_file(all_boxes, res_file)
+        self._write_coco_results_file(self._as_detections(detections),
+                                      res_file)
         # Only do evaluation on non-test sets
         if self._image_set.find('test') == -1:
             self._do_detection_eval(res_file, output_dir)
@@ -7,15 +7,20 @@
 
 import os
 import os.path as osp
+import threading
 import PIL
 from utils.cython_bbox import bbox_overlaps
 import numpy as np
 import scipy.sparse
 from fast_rcnn.config import cfg
+from fast_rcnn.detections import Detections
 
 class imdb(object):
     """Image database."""
 
+    # guards the lazy creation of proposal loaders
+    _proposal_lock = threading.Lock()
+
     def __init__(self, name):
         self._name = name
         self._num_classes = 0
@@ -24,6 +29,8 @@ class imdb(object):
         self._obj_proposer = 'selective_search'
         self._roidb = None
         self._roidb_handler = self.default_roidb
+        self._proposal_method = None
+        self._proposal_loader = None
         # Use this dict for storing dataset specific config options
         self.config = {}
 
@@ -52,9 +59,47 @@ class imdb(object):
         self._roidb_handler = val
 
     def set_proposal_method(self, method):
+        self._proposal_method = method
+        self._proposal_loader = None
         method = eval('self.' + method + '_roidb')
         self.roidb_handler = method
 
+    def proposal_boxes(self, i):
+        """Return the object proposals of image i (without ground truth).
+
+        Unless the roidb has already been built, the proposals are read
+        through the loader from get_proposal_loader(), which skips the
+        ground-truth overlaps that only training needs.
+        """
+        if self._roidb is None:
+            if self._proposal_loader is None:
+                with self._proposal_lock:
+                    if self._proposal_loader is None:
+                        self._proposal_loader = \
+                            self.get_proposal_loader(self._proposal_method) \
+                            or self._roidb_proposals
+            return self._proposal_loader(i)
+        return self._roidb_proposals(i)
+
+    def get_proposal_loader(self, method):
+        """Return a function mapping an image index to the proposals of
+        method, or None if the proposals can only be read from the roidb.
+        """
+        return None
+
+    def _roidb_proposals(self, i):
+        # The roidb may contain ground-truth rois (for example, if the roidb
+        # comes from the training or val split). We only want the rois that
+        # have the gt_classes field set to 0, which means there's no ground
+        # truth.
+        if self._roidb is None:
+            # test_net's prep threads can get here together: build the
+            # roidb (and write its cache) only once
+            with self._proposal_lock:
+                self.roidb
+        roidb = self.roidb
+        return roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
+
     @property
     def roidb(self):
         # A roidb is a list of dictionaries, each with the following keys:
@@ -84,21 +129,43 @@ class imdb(object):
     def default_roidb(self):
         raise NotImplementedError
 
-    def evaluate_detections(self, all_boxes, output_dir=None):
+    def evaluate_detections(self, detections, output_dir=None):
         """
-        all_boxes is a list of length number-of-classes.
-        Each list element is a list of length number-of-images.
-        Each of those list elements is either an empty list []
-        or a numpy array of detection.
+        detections is a fast_rcnn.detections.Detections holding the
+        image, class, score and box of every detection.
+
+        The legacy all_boxes nested lists are accepted too (see
+        _as_detections): a list of length number-of-classes, each element a
+        list of length number-of-images, and
 
         all_boxes[class][image] = [] or np.array of shape #dets x 5
         """
         raise NotImplementedError
 
+    @staticmethod
+    def _as_detections(detections):
+        """Convert legacy all_boxes lists to Detections."""
+        if isinstance(detections, Detections):
+            return detections
+        return Detections.from_all_boxes(detections)
+
     def _get_widths(self):
       return [PIL.Image.open(self.image_path_at(i)).size[0]
               for i in xrange(self.num_images)]
 
+    def image_sizes(self):
+        """(width, height) of every image.
+
+        The sizes cached in the roidb (see roi_data_layer.roidb.prepare_roidb)
+        are used when it has been built; otherwise only the image headers
+        are read.
+        """
+        if self._roidb is not None and \
+                all('width' in r and 'height' in r for r in self._roidb):
+            return [(r['width'], r['height']) for r in self._roidb]
+        return [PIL.Image.open(self.image_path_at(i)).size
+                for i in xrange(self.num_images)]
+
     def append_flipped_images(self):
         num_images = self.num_images
         widths = self._get_widths()
@@ -37,7 +37,7 @@ class pascal_voc(imdb):
         self._image_ext = '.jpg'
         self._image_index = self._load_image_set_index()
         # Default to roidb handler
-        self._roidb_handler = self.selective_search_roidb
+        self.set_proposal_method('selective_search')
         self._salt = str(uuid.uuid4())
         self._comp_id = 'comp4'
 
@@ -149,32 +149,46 @@ class pascal_voc(imdb):
 
         return roidb
 
-    def _load_rpn_roidb(self, gt_roidb):
+    def get_proposal_loader(self, method):
+        """Read test proposals without building the roidb."""
+        if method == 'rpn':
+            return self._load_rpn_boxes().__getitem__
+        if method == 'selective_search':
+            raw_data = self._load_selective_search_data()
+            return lambda i: self._selective_search_boxes(raw_data[i])
+        return None
+
+    def _load_rpn_boxes(self):
         filename = self.config['rpn_file']
         print 'loading {}'.format(filename)
         assert os.path.exists(filename), \
                'rpn data not found at: {}'.format(filename)
         with open(filename, 'rb') as f:
-            box_list = cPickle.load(f)
+            return cPickle.load(f)
+
+    def _load_rpn_roidb(self, gt_roidb):
+        box_list = self._load_rpn_boxes()
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
-    def _load_selective_search_roidb(self, gt_roidb):
+    def _load_selective_search_data(self):
         filename = os.path.abspath(os.path.join(cfg.DATA_DIR,
                                                 'selective_search_data',
                                                 self.name + '.mat'))
         assert os.path.exists(filename), \
                'Selective search data not found at: {}'.format(filename)
-        raw_data = sio.loadmat(filename)['boxes'].ravel()
+        return sio.loadmat(filename)['boxes'].ravel()
 
-        box_list = []
-        for i in xrange(raw_data.shape[0]):
-            boxes = raw_data[i][:, (1, 0, 3, 2)] - 1
-            keep = ds_utils.unique_boxes(boxes)
-            boxes = boxes[keep, :]
-            keep = ds_utils.filter_small_boxes(boxes, self.config['min_size'])
-            boxes = boxes[keep, :]
-            box_list.append(boxes)
+    def _selective_search_boxes(self, raw_boxes):
+        boxes = raw_boxes[:, (1, 0, 3, 2)] - 1
+        keep = ds_utils.unique_boxes(boxes)
+        boxes = boxes[keep, :]
+        keep = ds_utils.filter_small_boxes(boxes, self.config['min_size'])
+        return boxes[keep, :]
 
+    def _load_selective_search_roidb(self, gt_roidb):
+        raw_data = self._load_selective_search_data()
+        box_list = [self._selective_search_boxes(raw_data[i])
+                    for i in xrange(raw_data.shape[0])]
         return self.create_roidb_from_box_list(box_list, gt_roidb)
 
     def _load_pascal_annotation(self, index):
@@ -239,23 +253,23 @@ class pascal_voc(imdb):
             filename)
         return path
 
-    def _write_voc_results_file(self, all_boxes):
+    def _write_voc_results_file(self, detections):
+        image_index = np.asarray(self.image_index)
         for cls_ind, cls in enumerate(self.classes):
             if cls == '__background__':
                 continue
             print 'Writing {} VOC results file'.format(cls)
             filename = self._get_voc_results_file_template().format(cls)
+            inds = np.where(detections.classes == cls_ind)[0]
+            # the VOCdevkit expects 1-based indices
+            boxes = detections.boxes[inds, :] + 1
             with open(filename, 'wt') as f:
-                for im_ind, index in enumerate(self.image_index):
-                    dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
-                        continue
-                    # the VOCdevkit expects 1-based indices
-                    for k in xrange(dets.shape[0]):
-                        f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
-                                format(index, dets[k, -1],
-                                       dets[k, 0] + 1, dets[k, 1] + 1,
-                                       dets[k, 2] + 1, dets[k, 3] + 1))
+                f.writelines(
+                    '{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(
+                        index, score, x1, y1, x2, y2)
+                    for index, score, (x1, y1, x2, y2) in zip(
+                        image_index[detections.images[inds]],
+                        detections.scores[inds], boxes))
 
     def _do_python_eval(self, output_dir = 'output'):
         annopath = os.path.join(
@@ -317,8 +331,8 @@ class pascal_voc(imdb):
         print('Running:\n{}'.format(cmd))
         status = subprocess.call(cmd, shell=True)
 
-    def evaluate_detections(self, all_boxes, output_dir):
-        self._write_voc_results_file(all_boxes)
+    def evaluate_detections(self, detections, output_dir):
+        self._write_voc_results_file(self._as_detections(detections))
         self._do_python_eval(output_dir)
         if self.config['matlab_eval']:
             self._do_matlab_eval(output_dir)
@@ -60,6 +60,37 @@ def bbox_transform_inv(boxes, deltas):
 
     return pred_boxes
 
+def bbox_transform_inv_pairs(boxes, deltas, inds, classes):
+    """Apply the regression deltas of selected (box, class) pairs only.
+
+    Returns the same P x 4 array as
+    bbox_transform_inv(boxes, deltas).reshape(R, K, 4)[inds, classes]
+    without decoding the other R * K - P pairs.
+    """
+    if len(inds) == 0:
+        return np.zeros((0, 4), dtype=deltas.dtype)
+
+    boxes = boxes[inds, :].astype(deltas.dtype, copy=False)
+    deltas = deltas.reshape((deltas.shape[0], -1, 4))[inds, classes]
+
+    widths = boxes[:, 2] - boxes[:, 0] + 1.0
+    heights = boxes[:, 3] - boxes[:, 1] + 1.0
+    ctr_x = boxes[:, 0] + 0.5 * widths
+    ctr_y = boxes[:, 1] + 0.5 * heights
+
+    pred_ctr_x = deltas[:, 0] * widths + ctr_x
+    pred_ctr_y = deltas[:, 1] * heights + ctr_y
+    pred_w = np.exp(deltas[:, 2]) * widths
+    pred_h = np.exp(deltas[:, 3]) * heights
+
+    pred_boxes = np.empty((len(inds), 4), dtype=deltas.dtype)
+    pred_boxes[:, 0] = pred_ctr_x - 0.5 * pred_w
+    pred_boxes[:, 1] = pred_ctr_y - 0.5 * pred_h
+    pred_boxes[:, 2] = pred_ctr_x + 0.5 * pred_w
+    pred_boxes[:, 3] = pred_ctr_y + 0.5 * pred_h
+
+    return pred_boxes
+
 def clip_boxes(boxes, im_shape):
     """
     Clip boxes to image boundaries.
@@ -149,9 +149,52 @@ __C.TEST.SCALES = (600,)
 # Max pixel size of the longest side of a scaled input image
 __C.TEST.MAX_SIZE = 1000
 
+# Multi-scale pyramid construction (these trade exactness for speed):
+# resize the decoded uint8 image and subtract the pixel means per level
+__C.TEST.PYRAMID_UINT8 = False
+# build a downscaled level from the next finer downscaled level when
+# (coarse scale / fine scale) >= this ratio; 0 always resizes the original
+__C.TEST.PYRAMID_CHAIN_RATIO = 0.
+# pack all levels of an image into one canvas instead of padding each level to
+# the largest one, leaving this many pixels between levels
+__C.TEST.PYRAMID_PACK = False
+__C.TEST.PYRAMID_PACK_GAP = 32
+
+# Images to detect on per forward pass in test_net (see im_detect_batch)
+__C.TEST.IMS_PER_BATCH = 1
+
+# test_net pipeline: threads reading images and building input blobs, threads
+# thresholding and NMSing the detections (0 runs a stage on the main thread),
+# and the number of items queued between stages
+__C.TEST.PREP_THREADS = 2
+__C.TEST.POST_THREADS = 2
+__C.TEST.PIPELINE_DEPTH = 4
+
+# Flush detections to the on-disk log in the output directory every this many
+# images; an interrupted test_net resumes from the last flush
+__C.TEST.CHECKPOINT_IMAGES = 100
+
+# Shape bucketing, so that Caffe rarely has to reshape the net: pad data blobs
+# to one of this many canonical shapes chosen from the test set's image sizes
+# (0 disables), and pad the rois blob to a multiple of this many RoIs
+__C.TEST.SHAPE_BUCKETS = 0
+__C.TEST.ROI_BUCKET = 0
+
+# im_detect_tiled: side of the square tiles a large image is cut into (each tile
+# is tested like a whole image) and the overlap between neighbouring tiles
+__C.TEST.TILE_SIZE = 600
+__C.TEST.TILE_OVERLAP = 100
+
 # Overlap threshold used for non-maximum suppression (suppress boxes with
 # IoU >= this threshold)
 __C.TEST.NMS = 0.3
+# 'hard' NMS, or 'linear' / 'gaussian' Soft-NMS, which decays the scores of
+# overlapping detections instead of removing them
+__C.TEST.NMS_METHOD = 'hard'
+# Width of the gaussian Soft-NMS decay
+__C.TEST.SOFT_NMS_SIGMA = 0.5
+# Soft-NMS drops detections whose decayed score falls below this
+__C.TEST.SOFT_NMS_MIN_SCORE = 0.001
 
 # Experimental: treat the (K+1) units in the cls_score layer as linear
 # predictors (trained, eg, with one-vs-rest SVMs).
@@ -160,6 +203,10 @@ __C.TEST.SVM = False
 # Test using bounding-box regressors
 __C.TEST.BBOX_REG = True
 
+# In test_net, only regress and clip the (RoI, class) pairs whose score passes
+# the detection threshold (same detections, less post-processing)
+__C.TEST.SPARSE_DECODE = True
+
 # Propose boxes
 __C.TEST.HAS_RPN = False
 
@@ -216,6 +263,10 @@ __C.EXP_DIR = 'default'
 # Use GPU implementation of non-maximum suppression
 __C.USE_GPU_NMS = True
 
+# NMS backend for every call ('py', 'cpu', 'cpu_bitmask' or 'gpu'); empty
+# picks the fastest for the number of boxes, see fast_rcnn/nms_wrapper.py
+__C.NMS_BACKEND = ''
+
 # Default GPU device id
 __C.GPU_ID = 0
 
@@ -225,11 +276,12 @@ def get_output_dir(imdb, net=None):
     If the directory does not exist, it is created.
 
     A canonical path is built using the name from an imdb and a network
-    (if not None).
+    (if not None). net may also be given as the network name.
     """
     outdir = osp.abspath(osp.join(__C.ROOT_DIR, 'output', __C.EXP_DIR, imdb.name))
     if net is not None:
-        outdir = osp.join(outdir, net.name)
+        outdir = osp.join(outdir,
+                          net if isinstance(net, basestring) else net.name)
     if not os.path.exists(outdir):
         os.makedirs(outdir)
     return outdir
@@ -0,0 +1,166 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Content-addressed on-disk cache of per-image detections."""
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import numpy as np
+
+from fast_rcnn.test import im_detect, _image_detections, _config_digest
+
+def _file_digest(path, chunk_size=1 << 20):
+    sha = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class DetectionCache(object):
+    """Post-NMS detections keyed by the content of everything they depend on.
+
+    A key hashes the image pixels, the proposals, the weights file, the
+    detection settings (thresh, max_per_image) and the cfg.TEST fields that
+    change detections. Entries are stored as .npy files under cache_dir and
+    evicted least recently used first once they take more than max_bytes.
+    The most recent max_memory_entries are also kept in memory, so repeated
+    images cost one hash of their pixels. Returned arrays are read-only and
+    shared between lookups.
+
+    Keys are MD5 digests: hashing the pixels dominates the cost of a hit and
+    MD5 is several times faster than SHA-1 here.
+
+    The cache only stays valid while the prototxt is unchanged; use a
+    separate cache_dir per network definition.
+    """
+
+    def __init__(self, cache_dir, caffemodel, max_bytes=1 << 30,
+                 max_memory_entries=1024):
+        self._dir = cache_dir
+        self._max_bytes = max_bytes
+        self._max_memory_entries = max_memory_entries
+        self._model_digest = _file_digest(caffemodel)
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # on-disk entries, least recently used first
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.npy'):
+                st = os.stat(os.path.join(cache_dir, name))
+                entries.append((st.st_mtime, name[:-4], st.st_size))
+        entries.sort()
+        self._disk = collections.OrderedDict(
+            (key, size) for _, key, size in entries)
+        self._disk_bytes = sum(self._disk.itervalues())
+
+    def key(self, im, boxes=None, thresh=0.05, max_per_image=100):
+        """Return the cache key of detecting on im (with boxes)."""
+        sha = hashlib.md5(self._model_digest)
+        sha.update(_config_digest())
+        sha.update(repr((im.shape, im.dtype.str, thresh, max_per_image)))
+        sha.update(np.ascontiguousarray(im).data)
+        if boxes is not None:
+            boxes = np.ascontiguousarray(boxes, dtype=np.float32)
+            sha.update(repr(boxes.shape))
+            sha.update(boxes.data)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Return the cached detections for key, or None."""
+        with self._lock:
+            dets = self._memory.pop(key, None)
+            if dets is not None:
+                self._memory[key] = dets
+                self.hits += 1
+                return dets
+            size = self._disk.pop(key, None)
+            if size is None:
+                self.misses += 1
+                return None
+            self._disk[key] = size
+        path = self._path(key)
+        try:
+            dets = np.load(path)
+            # mark as recently used for later processes
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            dets.flags.writeable = False
+            self._remember(key, dets)
+        return dets
+
+    def put(self, key, dets):
+        """Store the detections for key, evicting old entries if needed."""
+        dets = dets.copy()
+        dets.flags.writeable = False
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, dets)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, self._path(key))
+        with self._lock:
+            self._forget(key)
+            self._disk[key] = size
+            self._disk_bytes += size
+            self._remember(key, dets)
+            while self._disk_bytes > self._max_bytes and len(self._disk) > 1:
+                old_key = next(iter(self._disk))
+                self._forget(old_key)
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def detect(self, net, im, boxes=None, thresh=0.05, max_per_image=100):
+        """Return the detections of im, computing them on a cache miss.
+
+        Returns:
+            dets (ndarray): N x 6 array of (x1, y1, x2, y2, score, class), as
+                returned by _image_detections
+        """
+        key = self.key(im, boxes, thresh, max_per_image)
+        dets = self.get(key)
+        if dets is None:
+            scores, pred_boxes = im_detect(net, im, boxes)
+            dets = _image_detections(scores, pred_boxes, max_per_image, thresh)
+            self.put(key, dets)
+            dets.flags.writeable = False
+        return dets
+
+    def stats(self):
+        """Return hit / miss counts, the hit rate and the cache size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': float(self.hits) / max(lookups, 1),
+                    'entries': len(self._disk), 'bytes': self._disk_bytes}
+
+    def _path(self, key):
+        return os.path.join(self._dir, key + '.npy')
+
+    def _remember(self, key, dets):
+        self._memory.pop(key, None)
+        self._memory[key] = dets
+        while len(self._memory) > self._max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _forget(self, key):
+        self._memory.pop(key, None)
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
@@ -0,0 +1,296 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Column-wise container for the detections of an image set."""
+
+import os
+import threading
+import numpy as np
+
+_COLUMNS = ('images', 'classes', 'scores', 'boxes', 'offsets')
+
+class Detections(object):
+    """Detections of a whole image set, stored column-wise.
+
+    Columns (one row per detection):
+        images (int32): image index
+        classes (int32): class index
+        scores (float32): detection score
+        boxes (float32): N x 4 (x1, y1, x2, y2)
+
+    Rows are sorted by image, then by class; within an (image, class) cell
+    they keep the order they were added in (decreasing score after NMS).
+    Rows offsets[i]:offsets[i + 1] belong to image i.
+
+    Detections are added one image at a time with append() (in any image
+    order, e.g. from several worker threads) and the columns are assembled
+    on first access.
+    """
+
+    def __init__(self, num_images, num_classes):
+        self.num_images = num_images
+        self.num_classes = num_classes
+        self._chunks = [None] * num_images
+        self._columns = None
+
+    @classmethod
+    def from_columns(cls, num_images, num_classes, images, classes, scores,
+                     boxes):
+        """Wrap existing columns, which must already be sorted."""
+        detections = cls(num_images, num_classes)
+        detections._chunks = None
+        detections._columns = {
+            'images': images, 'classes': classes, 'scores': scores,
+            'boxes': boxes,
+            'offsets': np.searchsorted(images, np.arange(num_images + 1))}
+        return detections
+
+    @classmethod
+    def from_all_boxes(cls, all_boxes):
+        """Convert the legacy all_boxes[cls][image] nested lists."""
+        num_classes = len(all_boxes)
+        num_images = len(all_boxes[0])
+        detections = cls(num_images, num_classes)
+        for i in xrange(num_images):
+            cells = [np.hstack((all_boxes[j][i][:, :5],
+                                np.tile(j, (len(all_boxes[j][i]), 1))))
+                     .astype(np.float32)
+                     for j in xrange(num_classes) if len(all_boxes[j][i]) > 0]
+            if len(cells) > 0:
+                detections.append(i, np.vstack(cells))
+        return detections
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load detections saved with save(); columns are memory-mapped."""
+        num_classes = int(np.load(os.path.join(path, 'num_classes.npy')))
+        columns = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                      mmap_mode=mmap_mode))
+                       for name in _COLUMNS)
+        detections = cls(len(columns['offsets']) - 1, num_classes)
+        detections._chunks = None
+        detections._columns = columns
+        return detections
+
+    def save(self, path):
+        """Save every column as a .npy file in directory path."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        columns = self._get_columns()
+        for name in _COLUMNS:
+            np.save(os.path.join(path, name + '.npy'), columns[name])
+        np.save(os.path.join(path, 'num_classes.npy'), self.num_classes)
+
+    def append(self, im_ind, dets):
+        """Set the detections of one image.
+
+        Arguments:
+            im_ind (int): image index
+            dets (ndarray): N x 6 array of (x1, y1, x2, y2, score, class),
+                sorted by class
+        """
+        if self._chunks is None:
+            self._chunks = [self.image(i) for i in xrange(self.num_images)]
+        self._chunks[im_ind] = dets
+        self._columns = None
+
+    def image(self, im_ind):
+        """Return the detections of one image as an N x 6 array of
+        (x1, y1, x2, y2, score, class).
+        """
+        if self._columns is None:
+            dets = self._chunks[im_ind]
+            return np.zeros((0, 6), dtype=np.float32) if dets is None else dets
+        columns = self._get_columns()
+        start, end = columns['offsets'][im_ind:im_ind + 2]
+        dets = np.empty((end - start, 6), dtype=np.float32)
+        dets[:, :4] = columns['boxes'][start:end]
+        dets[:, 4] = columns['scores'][start:end]
+        dets[:, 5] = columns['classes'][start:end]
+        return dets
+
+    def take(self, inds):
+        """Return the detections at sorted row indices inds."""
+        columns = self._get_columns()
+        return Detections.from_columns(
+            self.num_images, self.num_classes, columns['images'][inds],
+            columns['classes'][inds], columns['scores'][inds],
+            columns['boxes'][inds])
+
+    def to_all_boxes(self):
+        """Convert to the legacy all_boxes[cls][image] nested lists.
+
+        Every foreground entry is an N x 5 array of (x1, y1, x2, y2, score),
+        background entries are [].
+        """
+        columns = self._get_columns()
+        dets = np.hstack((columns['boxes'], columns['scores'][:, np.newaxis]))
+        cells = columns['images'].astype(np.int64) * self.num_classes + \
+            columns['classes']
+        starts = np.searchsorted(
+            cells, np.arange(self.num_images * self.num_classes + 1))
+        all_boxes = [[[] for _ in xrange(self.num_images)]
+                     for _ in xrange(self.num_classes)]
+        for j in xrange(1, self.num_classes):
+            for i in xrange(self.num_images):
+                cell = i * self.num_classes + j
+                all_boxes[j][i] = dets[starts[cell]:starts[cell + 1], :]
+        return all_boxes
+
+    def __len__(self):
+        return len(self._get_columns()['images'])
+
+    @property
+    def images(self):
+        return self._get_columns()['images']
+
+    @property
+    def classes(self):
+        return self._get_columns()['classes']
+
+    @property
+    def scores(self):
+        return self._get_columns()['scores']
+
+    @property
+    def boxes(self):
+        return self._get_columns()['boxes']
+
+    @property
+    def offsets(self):
+        return self._get_columns()['offsets']
+
+    def _get_columns(self):
+        if self._columns is None:
+            chunks = [np.zeros((0, 6), dtype=np.float32) if dets is None
+                      else dets for dets in self._chunks]
+            counts = [len(dets) for dets in chunks]
+            dets = np.vstack(chunks)
+            offsets = np.zeros(self.num_images + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            self._columns = {
+                'images': np.repeat(np.arange(self.num_images,
+                                              dtype=np.int32), counts),
+                'classes': dets[:, 5].astype(np.int32),
+                'scores': dets[:, 4].astype(np.float32),
+                'boxes': dets[:, :4].astype(np.float32),
+                'offsets': offsets}
+        return self._columns
+
+class DetectionLog(object):
+    """Append-only on-disk log of per-image detections.
+
+    Detections are buffered and flushed every chunk_size images to
+    <path>.bin as float32 rows of (image, x1, y1, x2, y2, score, class).
+    After each flush a line "<rows> <image> <image> ..." is appended to
+    <path>.progress, marking those images as done; rows without a progress
+    line are dropped when the log is reopened. Opening an existing log
+    resumes it, so already processed images can be skipped; a log written
+    for another number of images or classes, or other settings (a digest
+    of whatever else the detections depend on), is started over.
+    append() may be called from several threads.
+    """
+
+    _ROW = 7
+
+    def __init__(self, path, num_images, num_classes, chunk_size=100,
+                 settings=''):
+        self.num_images = num_images
+        self.num_classes = num_classes
+        self._chunk_size = chunk_size
+        self._data_file = path + '.bin'
+        self._progress_file = path + '.progress'
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffer_images = []
+        self._num_rows = 0
+        self.done = set()
+
+        header = '{:d} {:d} {}'.format(num_images, num_classes,
+                                       settings).rstrip() + '\n'
+        # bytes of the progress file that describe flushed chunks
+        valid = 0
+        if os.path.exists(self._progress_file):
+            with open(self._progress_file) as f:
+                lines = f.readlines()
+            if len(lines) > 0 and lines[0] == header:
+                valid = len(header)
+                for line in lines[1:]:
+                    # the last line may have been cut short by a crash
+                    if not line.endswith('\n'):
+                        break
+                    fields = [int(x) for x in line.split()]
+                    self._num_rows = fields[0]
+                    self.done.update(fields[1:])
+                    valid += len(line)
+            elif len(lines) > 1:
+                print 'Detection log {} was written with other settings, ' \
+                      'starting over'.format(self._progress_file)
+        with open(self._progress_file, 'ab') as f:
+            f.truncate(valid)
+            if valid == 0:
+                f.write(header)
+        with open(self._data_file, 'ab') as f:
+            f.truncate(self._num_rows * self._ROW * 4)
+
+    def append(self, im_ind, dets):
+        """Add the detections of one image.
+
+        Arguments:
+            im_ind (int): image index
+            dets (ndarray): N x 6 array of (x1, y1, x2, y2, score, class),
+                sorted by class
+        """
+        rows = np.empty((dets.shape[0], self._ROW), dtype=np.float32)
+        rows[:, 0] = im_ind
+        rows[:, 1:] = dets
+        with self._lock:
+            self._buffer.append(rows)
+            self._buffer_images.append(im_ind)
+            if len(self._buffer_images) >= self._chunk_size:
+                self._flush()
+
+    def flush(self):
+        """Write the buffered detections and mark their images done."""
+        with self._lock:
+            self._flush()
+
+    def load(self):
+        """Return every flushed detection as Detections."""
+        self.flush()
+        if self._num_rows == 0:
+            rows = np.zeros((0, self._ROW), dtype=np.float32)
+        else:
+            rows = np.memmap(self._data_file, dtype=np.float32, mode='r',
+                             shape=(self._num_rows, self._ROW))
+        rows = rows[np.argsort(rows[:, 0], kind='mergesort'), :]
+        return Detections.from_columns(
+            self.num_images, self.num_classes, rows[:, 0].astype(np.int32),
+            rows[:, 6].astype(np.int32), rows[:, 5].copy(),
+            rows[:, 1:5].copy())
+
+    def remove(self):
+        """Delete the log files."""
+        for filename in (self._data_file, self._progress_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _flush(self):
+        if len(self._buffer_images) == 0:
+            return
+        rows = np.vstack(self._buffer)
+        with open(self._data_file, 'ab') as f:
+            rows.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._num_rows += rows.shape[0]
+        with open(self._progress_file, 'ab') as f:
+            f.write(' '.join(str(x) for x in
+                             [self._num_rows] + self._buffer_images) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(self._buffer_images)
+        self._buffer = []
+        self._buffer_images = []
@@ -0,0 +1,80 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Memory-mapped on-disk store of per-RoI features."""
+
+import os
+import numpy as np
+
+class FeatureStore(object):
+    """Features of the RoIs of every image, stacked in one .npy file.
+
+    <path>/features.npy holds one row per RoI; rows offsets[i]:offsets[i + 1]
+    belong to image i, in the order its RoIs were given. <path>/offsets.npy
+    is only written by finish(), so a store without it is incomplete.
+
+    The features are memory-mapped: opening a store is cheap, pages are read
+    on demand and shared between processes that open the same store.
+    """
+
+    def __init__(self, path, offsets, features):
+        self.path = path
+        self.offsets = offsets
+        self._features = features
+
+    @classmethod
+    def create(cls, path, counts, dim, dtype=np.float32):
+        """Create an empty store for images with counts[i] RoIs each."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        features = np.lib.format.open_memmap(
+            os.path.join(path, 'features.npy'), mode='w+', dtype=dtype,
+            shape=(int(offsets[-1]), dim))
+        return cls(path, offsets, features)
+
+    @classmethod
+    def open(cls, path):
+        """Open a finished store read-only."""
+        offsets = np.load(os.path.join(path, 'offsets.npy'))
+        features = np.load(os.path.join(path, 'features.npy'), mmap_mode='r')
+        return cls(path, offsets, features)
+
+    @staticmethod
+    def is_complete(path):
+        """True if path holds a finished store."""
+        return os.path.exists(os.path.join(path, 'offsets.npy'))
+
+    @property
+    def num_images(self):
+        return len(self.offsets) - 1
+
+    @property
+    def dim(self):
+        return self._features.shape[1]
+
+    @property
+    def counts(self):
+        """Number of RoIs of every image."""
+        return np.diff(self.offsets)
+
+    def image(self, i, dtype=np.float32):
+        """Return the R_i x dim features of image i as dtype."""
+        start, end = self.offsets[i:i + 2]
+        return np.asarray(self._features[start:end], dtype=dtype)
+
+    def write(self, i, feat):
+        """Set the features of image i."""
+        start, end = self.offsets[i:i + 2]
+        assert feat.shape[0] == end - start, \
+            'Image {:d} has {:d} RoIs, got {:d} features'.format(
+                i, end - start, feat.shape[0])
+        self._features[start:end] = feat
+
+    def finish(self):
+        """Flush the features and mark the store complete."""
+        self._features.flush()
+        np.save(os.path.join(self.path, 'offsets.npy'), self.offsets)
@@ -5,16 +5,265 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
+"""NMS entry points and the dispatch between NMS kernels.
+
+Every kernel is a registered backend, imported on first use; a backend that
+fails to import (e.g., gpu in a CPU-only build) is simply unavailable. On
+the first call the available backends are timed on synthetic proposals of
+a few sizes and every call then goes to the fastest backend for its number
+of boxes. The calibration is stored in cfg.DATA_DIR/cache and reused by
+later processes on the same host.
+"""
+
+import bisect
+import collections
+import cPickle
+import importlib
+import os
+import socket
+import tempfile
+import threading
+import time
+import numpy as np
 from fast_rcnn.config import cfg
-from nms.gpu_nms import gpu_nms
-from nms.cpu_nms import cpu_nms
 
-def nms(dets, thresh, force_cpu=False):
-    """Dispatch to either CPU or GPU NMS implementations."""
+# name -> (module, function) of every NMS kernel; all take (dets, thresh)
+_BACKENDS = collections.OrderedDict([
+    ('py', ('nms.py_cpu_nms', 'py_cpu_nms')),
+    ('cpu', ('nms.cpu_nms', 'cpu_nms')),
+    ('cpu_bitmask', ('nms.cpu_bitmask_nms', 'cpu_bitmask_nms')),
+    ('gpu', ('nms.gpu_nms', 'gpu_nms')),
+])
+# backends that can stop once max_num boxes are kept
+_SUPPORTS_MAX_NUM = set(['py', 'cpu', 'cpu_bitmask'])
+
+# numbers of boxes and IoU thresholds the backends are timed on
+_CALIBRATION_SIZES = (16, 64, 256, 1024, 6000)
+_CALIBRATION_THRESHS = (0.3, 0.7)
+# stop timing a backend once it is this many times slower than the best
+_CALIBRATION_DROP = 4.0
+
+_kernels = {}
+# cfg.USE_GPU_NMS -> (min_boxes, backend names) of the dispatch table
+_dispatch = {}
+_lock = threading.Lock()
+
+def register_backend(name, module, function, supports_max_num=False):
+    """Register the NMS kernel module.function(dets, thresh) as name.
+
+    Registering invalidates the current calibration.
+    """
+    with _lock:
+        _BACKENDS[name] = (module, function)
+        if supports_max_num:
+            _SUPPORTS_MAX_NUM.add(name)
+        else:
+            _SUPPORTS_MAX_NUM.discard(name)
+        _kernels.pop(name, None)
+        _dispatch.clear()
+
+def _kernel(name):
+    """Return the kernel of backend name, or None if it cannot be imported."""
+    if name not in _kernels:
+        module, function = _BACKENDS[name]
+        try:
+            _kernels[name] = getattr(importlib.import_module(module), function)
+        except ImportError:
+            _kernels[name] = None
+    return _kernels[name]
+
+def available_backends():
+    """Names of the backends that can be used, in registration order."""
+    return [name for name in _BACKENDS
+            if (name != 'gpu' or cfg.USE_GPU_NMS) and
+            _kernel(name) is not None]
+
+def _check_backend(name):
+    """Raise a ValueError unless backend name can be used."""
+    backends = available_backends()
+    if name not in backends:
+        if name not in _BACKENDS:
+            reason = 'unknown'
+        elif name == 'gpu' and not cfg.USE_GPU_NMS:
+            reason = 'disabled (cfg.USE_GPU_NMS is off)'
+        else:
+            reason = 'not available (the kernel failed to import)'
+        raise ValueError('NMS backend {!r} is {}; available backends: {}'
+                         .format(name, reason, ', '.join(backends)))
+
+def _run(name, dets, thresh, max_num):
+    kernel = _kernel(name)
+    if kernel is None:
+        raise ValueError('NMS backend {} is not available'.format(name))
+    if name == 'gpu':
+        keep = kernel(dets, thresh, device_id=cfg.GPU_ID)
+    elif name in _SUPPORTS_MAX_NUM:
+        return kernel(dets, thresh, max_num=max_num)
+    else:
+        keep = kernel(dets, thresh)
+    return keep[:max_num] if max_num > 0 else keep
+
+def _calibration_dets(num_boxes, rng, im_size=(600, 1000)):
+    """Score-ranked boxes clustered around a few objects, like RPN output."""
+    num_objects = max(num_boxes // 200, 1)
+    centers = rng.rand(num_objects, 2) * (im_size[1], im_size[0])
+    sizes = np.exp(rng.uniform(np.log(16), np.log(400), (num_objects, 2)))
+    obj = rng.randint(0, num_objects, num_boxes)
+    ctr = centers[obj] + rng.randn(num_boxes, 2) * sizes[obj] * 0.2
+    wh = sizes[obj] * np.exp(rng.randn(num_boxes, 2) * 0.2)
+    dets = np.empty((num_boxes, 5), dtype=np.float32)
+    dets[:, 0:2] = ctr - wh / 2
+    dets[:, 2:4] = ctr + wh / 2
+    dets[:, 4] = rng.rand(num_boxes)
+    return dets
+
+def _time_backend(name, dets, iters=3):
+    """Best time of name over iters runs at every calibration threshold."""
+    total = 0.
+    for thresh in _CALIBRATION_THRESHS:
+        best = np.inf
+        for _ in xrange(iters):
+            start = time.time()
+            _run(name, dets, thresh, 0)
+            best = min(best, time.time() - start)
+        total += best
+    return total
+
+def calibrate():
+    """Time the available backends and return the dispatch table.
+
+    Returns:
+        table (list): (min_boxes, backend) pairs sorted by min_boxes; a call
+            with N boxes goes to the backend of the last pair with
+            min_boxes <= N
+    """
+    rng = np.random.RandomState(cfg.RNG_SEED)
+    backends = available_backends()
+    # warm up (e.g., CUDA context creation) before timing
+    warmup = _calibration_dets(_CALIBRATION_SIZES[0], rng)
+    for name in backends:
+        _run(name, warmup, _CALIBRATION_THRESHS[0], 0)
+
+    winners = []
+    for num_boxes in _CALIBRATION_SIZES:
+        dets = _calibration_dets(num_boxes, rng)
+        times = dict((name, _time_backend(name, dets)) for name in backends)
+        best = min(backends, key=lambda name: times[name])
+        winners.append(best)
+        backends = [name for name in backends
+                    if times[name] <= _CALIBRATION_DROP * times[best]]
+
+    # switch backends halfway (in log scale) between calibration sizes
+    table = [(0, winners[0])]
+    for i in xrange(1, len(winners)):
+        if winners[i] != table[-1][1]:
+            crossover = np.sqrt(_CALIBRATION_SIZES[i - 1] *
+                                _CALIBRATION_SIZES[i])
+            table.append((int(crossover), winners[i]))
+    return table
+
+def _calibration_file():
+    return os.path.join(cfg.DATA_DIR, 'cache',
+                        'nms_backends_{}.pkl'.format(socket.gethostname()))
+
+def _load_dispatch():
+    """Return the stored dispatch table, calibrating if there is none for
+    the current set of backends."""
+    backends = available_backends()
+    if len(backends) == 1:
+        return [(0, backends[0])]
+    cache_file = _calibration_file()
+    key = (tuple(backends), _CALIBRATION_SIZES, _CALIBRATION_THRESHS)
+    # one table per set of backends
+    tables = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as fid:
+                tables = cPickle.load(fid)
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+            pass
+    if key in tables:
+        return tables[key]
+
+    table = calibrate()
+    tables[key] = table
+    print 'NMS backends by number of boxes: {}'.format(
+        ', '.join('{:d}+: {}'.format(n, name) for n, name in table))
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fid:
+            cPickle.dump(tables, fid, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_file)
+    except (IOError, OSError):
+        # an unwritable cache only costs a calibration per process
+        pass
+    return table
+
+def backend_for(num_boxes):
+    """Name of the backend used for num_boxes boxes."""
+    if cfg.NMS_BACKEND:
+        _check_backend(cfg.NMS_BACKEND)
+        return cfg.NMS_BACKEND
+    use_gpu = bool(cfg.USE_GPU_NMS)
+    if use_gpu not in _dispatch:
+        with _lock:
+            if use_gpu not in _dispatch:
+                table = _load_dispatch()
+                _dispatch[use_gpu] = ([n for n, _ in table],
+                                      [name for _, name in table])
+    bounds, names = _dispatch[use_gpu]
+    return names[bisect.bisect_right(bounds, num_boxes) - 1]
+
+def nms(dets, thresh, max_num=0, backend=None):
+    """Apply NMS to dets (N x 5: x1, y1, x2, y2, score) with the fastest
+    backend for N boxes, or with backend if given.
+
+    Only the max_num highest-scoring kept boxes are returned (max_num <= 0:
+    all of them); the CPU kernels stop scanning once they have that many.
+    """
 
     if dets.shape[0] == 0:
         return []
-    if cfg.USE_GPU_NMS and not force_cpu:
-        return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
+    if backend is None:
+        backend = backend_for(dets.shape[0])
     else:
-        return cpu_nms(dets, thresh)
+        _check_backend(backend)
+    return _run(backend, dets, thresh, max_num)
+
+_GROUP_NMS_METHODS = {'hard': 0, 'linear': 1, 'gaussian': 2}
+
+def group_nms(boxes, scores, groups, thresh, method='hard', sigma=0.5,
+              min_score=0.001, max_num=0):
+    """Hard NMS or Soft-NMS within each group of boxes, in one compiled call.
+
+    Boxes in different groups never suppress each other. All groups are
+    suppressed by a single CPU loop, which is faster than calling nms() per
+    group for the many small groups of per-class detections. Hard NMS keeps
+    the same boxes as the cpu backend applied to every group, also when
+    scores are tied.
+
+    Arguments:
+        boxes (ndarray): N x 4 array of (x1, y1, x2, y2)
+        scores (ndarray): N scores
+        groups (ndarray): N integer group ids (e.g., classes)
+        thresh (float): IoU threshold; with linear Soft-NMS, scores are only
+            decayed above it, with gaussian Soft-NMS it is unused
+        method (str): 'hard', 'linear' or 'gaussian'
+        sigma (float): width of the gaussian decay
+        min_score (float): Soft-NMS drops boxes whose score falls below this
+        max_num (int): keep at most this many boxes per group (0: no limit)
+
+    Returns:
+        keep (ndarray): indices of the kept boxes, sorted by group and, within
+            a group, by decreasing score
+        keep_scores (ndarray): scores of the kept boxes after Soft-NMS decay
+    """
+    from nms.cpu_group_nms import cpu_group_nms
+    return cpu_group_nms(np.ascontiguousarray(boxes, dtype=np.float32),
+                         np.ascontiguousarray(scores, dtype=np.float32),
+                         np.ascontiguousarray(groups, dtype=np.int64),
+                         thresh, _GROUP_NMS_METHODS[method], sigma,
+                         min_score, max_num)
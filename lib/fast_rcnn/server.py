@@ -0,0 +1,340 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Serve a Fast R-CNN network over a local socket.
+
+Messages in both directions are a 4-byte big-endian header length, a JSON
+header and the binary parts listed in header['sizes']:
+
+    detect request:  {'op': 'detect', 'shape': [h, w, 3]} + uint8 BGR
+                     pixels (or encoded image bytes when 'shape' is absent)
+                     [+ float32 R x 4 proposals]
+    detect response: {'num_dets': N} + float32 N x 6 detections
+                     (x1, y1, x2, y2, score, class)
+    stats request:   {'op': 'stats'}
+    stats response:  {'stats': {...}} (see DetectionServer.stats)
+
+Any failure is answered with {'error': message}. A malformed request is
+answered before it is queued, so it never reaches a batch shared with other
+clients; a header that breaks the framing also closes the connection.
+
+The network can be any object with a Caffe-style forward() and blobs, so
+this module does not import caffe.
+"""
+
+import collections
+import json
+import socket
+import SocketServer
+import struct
+import threading
+import time
+import Queue
+
+import numpy as np
+import cv2
+
+from fast_rcnn.config import cfg
+from fast_rcnn.test import _get_batch_blobs, _forward_batch, \
+    _image_detections
+from utils.pipeline import StagePool
+
+class _Request(object):
+    """One image waiting for detection."""
+
+    def __init__(self, im, boxes):
+        self.im = im
+        self.boxes = boxes
+        self.arrival_time = time.time()
+        self.dets = None
+        self.error = None
+        self.done = threading.Event()
+
+class DetectionServer(object):
+    """Detection service around a warm network.
+
+    Requests from concurrent connections are queued and batched: a batch
+    is started by the oldest waiting request and closed when it holds
+    max_batch_size images or that request has waited max_latency seconds.
+    Only the batching thread touches the network. Thresholding and NMS run
+    in num_threads worker threads.
+    """
+
+    def __init__(self, net, address=('127.0.0.1', 0), max_batch_size=4,
+                 max_latency=0.01, thresh=0.05, max_per_image=100,
+                 num_threads=2):
+        self._net = net
+        self._max_batch_size = max_batch_size
+        self._max_latency = max_latency
+        self._thresh = thresh
+        self._max_per_image = max_per_image
+        self._queue = Queue.Queue()
+        self._post_pool = StagePool('post', self._finish, num_threads,
+                                    max_queue=2 * max_batch_size)
+
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=10000)
+        self._start_time = time.time()
+        self._num_requests = 0
+        self._num_errors = 0
+        self._num_batches = 0
+        self._num_batched = 0
+
+        self._batch_thread = threading.Thread(target=self._batch_loop)
+        self._batch_thread.daemon = True
+        self._batch_thread.start()
+
+        self._server = _TCPServer(address, _Handler)
+        self._server.detector = self
+        self._serve_thread = None
+        # SocketServer's shutdown() waits forever unless serve_forever() ran
+        self._serving = False
+
+    @property
+    def address(self):
+        """(host, port) the server is listening on."""
+        return self._server.server_address
+
+    def serve_forever(self):
+        """Handle connections on the calling thread until shutdown()."""
+        self._serving = True
+        self._server.serve_forever()
+
+    def start(self):
+        """Handle connections on a background thread."""
+        # set before the thread runs, so an early shutdown() still stops it
+        self._serving = True
+        self._serve_thread = threading.Thread(target=self.serve_forever)
+        self._serve_thread.daemon = True
+        self._serve_thread.start()
+
+    def shutdown(self):
+        """Stop accepting connections and stop the worker threads."""
+        if self._serving:
+            self._server.shutdown()
+        self._server.server_close()
+        self._queue.put(None)
+        self._batch_thread.join()
+        self._post_pool.close()
+
+    def detect(self, im, boxes=None):
+        """Detect objects in im, batched with other concurrent requests.
+
+        Returns:
+            dets (ndarray): N x 6 array of (x1, y1, x2, y2, score, class)
+        """
+        if not cfg.TEST.HAS_RPN and boxes is None:
+            raise ValueError('Object proposals are required without an RPN')
+        request = _Request(im, boxes)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.dets
+
+    def stats(self):
+        """Return latency percentiles (ms) and throughput counters."""
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000.
+            stats = {'requests': self._num_requests,
+                     'errors': self._num_errors,
+                     'batches': self._num_batches,
+                     'mean_batch_size': float(self._num_batched) /
+                                        max(self._num_batches, 1),
+                     'throughput': self._num_requests /
+                                   (time.time() - self._start_time)}
+        for p in (50, 95, 99):
+            stats['p{:d}_ms'.format(p)] = \
+                float(np.percentile(latencies, p)) if len(latencies) else 0.
+        return stats
+
+    def _batch_loop(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = request.arrival_time + self._max_latency
+            while len(batch) < self._max_batch_size:
+                try:
+                    request = self._queue.get(
+                        timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if request is None:
+                    # finish this batch, then stop
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        with self._lock:
+            self._num_batches += 1
+            self._num_batched += len(batch)
+        try:
+            blobs, blob_info = _get_batch_blobs(
+                [request.im for request in batch],
+                None if cfg.TEST.HAS_RPN else
+                [request.boxes for request in batch])
+            outputs = _forward_batch(self._net, blobs, blob_info,
+                                     sparse=cfg.TEST.SPARSE_DECODE)
+        except Exception as e:
+            for request in batch:
+                self._complete(request, error=repr(e))
+            return
+        for request, (scores, boxes) in zip(batch, outputs):
+            self._post_pool.submit(request, scores, boxes)
+
+    def _finish(self, request, scores, boxes):
+        try:
+            dets = _image_detections(scores, boxes, self._max_per_image,
+                                     self._thresh)
+        except Exception as e:
+            self._complete(request, error=repr(e))
+        else:
+            self._complete(request, dets=dets)
+
+    def _complete(self, request, dets=None, error=None):
+        request.dets = dets
+        request.error = error
+        with self._lock:
+            if error is None:
+                self._num_requests += 1
+                self._latencies.append(time.time() - request.arrival_time)
+            else:
+                self._num_errors += 1
+        request.done.set()
+
+class _TCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """Answer the requests of one connection until it is closed."""
+
+    def handle(self):
+        detector = self.server.detector
+        while True:
+            try:
+                header, parts = _recv_msg(self.rfile)
+            except EOFError:
+                return
+            except ValueError as e:
+                # the message boundaries are lost
+                _send_msg(self.wfile, {'error': repr(e)})
+                return
+            try:
+                if header.get('op') == 'stats':
+                    _send_msg(self.wfile, {'stats': detector.stats()})
+                    continue
+                im, boxes = _parse_detect_request(header, parts)
+                dets = detector.detect(im, boxes)
+                _send_msg(self.wfile, {'num_dets': dets.shape[0]},
+                          [dets.astype(np.float32).tostring()])
+            except Exception as e:
+                _send_msg(self.wfile, {'error': repr(e)})
+
+def _parse_detect_request(header, parts):
+    """Return the (image, proposals) of a detect request, or raise
+    ValueError if it is malformed.
+    """
+    if header.get('op', 'detect') != 'detect':
+        raise ValueError('Unknown op {!r}'.format(header['op']))
+    if len(parts) not in (1, 2):
+        raise ValueError('Expected an image and optional proposals, '
+                         'got {:d} parts'.format(len(parts)))
+    if 'shape' in header:
+        shape = header['shape']
+        if not (isinstance(shape, list) and len(shape) == 3 and
+                all(isinstance(n, int) and n > 0 for n in shape)):
+            raise ValueError('Bad image shape {!r}'.format(shape))
+        if len(parts[0]) != np.prod(shape):
+            raise ValueError('Image shape {!r} does not match {:d} bytes'
+                             .format(shape, len(parts[0])))
+        im = np.frombuffer(parts[0], dtype=np.uint8).reshape(shape)
+    else:
+        im = cv2.imdecode(np.frombuffer(parts[0], dtype=np.uint8),
+                          cv2.IMREAD_COLOR)
+        if im is None:
+            raise ValueError('Could not decode the image')
+    if im.ndim != 3 or im.shape[2] != 3:
+        raise ValueError('Expected a 3-channel image, got shape {!r}'
+                         .format(im.shape))
+
+    boxes = None
+    if len(parts) > 1:
+        if len(parts[1]) == 0 or len(parts[1]) % 16 != 0:
+            raise ValueError('Proposals must be a non-empty float32 R x 4 '
+                             'array, got {:d} bytes'.format(len(parts[1])))
+        boxes = np.frombuffer(parts[1], dtype=np.float32).reshape((-1, 4))
+    return im, boxes
+
+class DetectionClient(object):
+    """Client for DetectionServer."""
+
+    def __init__(self, address):
+        self._sock = socket.create_connection(address)
+        self._rfile = self._sock.makefile('rb')
+        self._wfile = self._sock.makefile('wb')
+
+    def detect(self, im, boxes=None):
+        """Send a BGR uint8 image (and proposals) and return its detections
+        as an N x 6 array of (x1, y1, x2, y2, score, class).
+        """
+        im = np.ascontiguousarray(im, dtype=np.uint8)
+        parts = [im.tostring()]
+        if boxes is not None:
+            parts.append(np.ascontiguousarray(boxes, dtype=np.float32)
+                         .tostring())
+        _send_msg(self._wfile, {'op': 'detect', 'shape': im.shape}, parts)
+        header, parts = self._recv()
+        return np.frombuffer(parts[0], dtype=np.float32).reshape(
+            (header['num_dets'], 6))
+
+    def stats(self):
+        """Return the server's stats()."""
+        _send_msg(self._wfile, {'op': 'stats'})
+        return self._recv()[0]['stats']
+
+    def close(self):
+        self._rfile.close()
+        self._wfile.close()
+        self._sock.close()
+
+    def _recv(self):
+        header, parts = _recv_msg(self._rfile)
+        if 'error' in header:
+            raise RuntimeError(header['error'])
+        return header, parts
+
+def _send_msg(f, header, parts=()):
+    header = dict(header, sizes=[len(part) for part in parts])
+    data = json.dumps(header)
+    f.write(struct.pack('!I', len(data)) + data)
+    for part in parts:
+        f.write(part)
+    f.flush()
+
+def _recv_exactly(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError
+    return data
+
+def _recv_msg(f):
+    """Read one message; raises EOFError at the end of the stream and
+    ValueError if the header cannot be used to frame the message.
+    """
+    size, = struct.unpack('!I', _recv_exactly(f, 4))
+    header = json.loads(_recv_exactly(f, size))
+    if not isinstance(header, dict):
+        raise ValueError('The header must be a JSON object')
+    sizes = header.get('sizes')
+    if not (isinstance(sizes, list) and
+            all(isinstance(n, int) and n >= 0 for n in sizes)):
+        raise ValueError('The header needs a list of part sizes')
+    parts = [_recv_exactly(f, n) for n in sizes]
+    return header, parts
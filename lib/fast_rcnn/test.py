@@ -8,16 +8,117 @@
 """Test a Fast R-CNN network on an imdb (image database)."""
 
 from fast_rcnn.config import cfg, get_output_dir
-from fast_rcnn.bbox_transform import clip_boxes, bbox_transform_inv
+from fast_rcnn.bbox_transform import clip_boxes, bbox_transform_inv, \
+    bbox_transform_inv_pairs
 import argparse
 from utils.timer import Timer
+from utils.pipeline import StagePool
 import numpy as np
 import cv2
-import caffe
-from fast_rcnn.nms_wrapper import nms
-import cPickle
-from utils.blob import im_list_to_blob
+from fast_rcnn.nms_wrapper import group_nms
+from fast_rcnn.detections import Detections, DetectionLog
+from utils.blob import im_list_to_blob, pack_im_list, pack_shapes
 import os
+import collections
+import multiprocessing
+import traceback
+import Queue
+import hashlib
+
+# cfg.TEST keys that only affect speed, never the detections
+_SPEED_ONLY_TEST_KEYS = frozenset([
+    'IMS_PER_BATCH', 'PREP_THREADS', 'POST_THREADS', 'PIPELINE_DEPTH',
+    'CHECKPOINT_IMAGES', 'SHAPE_BUCKETS', 'ROI_BUCKET', 'SPARSE_DECODE'])
+
+def _config_digest():
+    """Digest of the config fields that can change test-time detections."""
+    items = sorted((key, value) for key, value in cfg.TEST.iteritems()
+                   if key not in _SPEED_ONLY_TEST_KEYS)
+    sha = hashlib.md5(repr(items))
+    sha.update(repr((cfg.DEDUP_BOXES, cfg.PIXEL_MEANS.tolist())))
+    return sha.hexdigest()
+
+def _detections_digest(thresh, max_per_image):
+    """Digest of the settings, besides the network and the images, that the
+    detections of test_net depend on.
+    """
+    sha = hashlib.md5(_config_digest())
+    sha.update(repr((thresh, max_per_image)))
+    return sha.hexdigest()
+
+def _pyramid_scales(im_shape):
+    """Scale factors of the test image pyramid of an image of im_shape:
+    the shorter side goes to each of cfg.TEST.SCALES, unless the longer
+    side would exceed cfg.TEST.MAX_SIZE.
+    """
+    im_size_min = np.min(im_shape[0:2])
+    im_size_max = np.max(im_shape[0:2])
+
+    im_scale_factors = []
+    for target_size in cfg.TEST.SCALES:
+        im_scale = float(target_size) / float(im_size_min)
+        # Prevent the biggest axis from being more than MAX_SIZE
+        if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
+            im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
+        im_scale_factors.append(im_scale)
+    return im_scale_factors
+
+def _get_image_pyramid(im, scales=None):
+    """Scales an image to every test scale.
+
+    Levels are resized from the original image or, when
+    cfg.TEST.PYRAMID_CHAIN_RATIO allows it, from the next finer downscaled
+    level. With cfg.TEST.PYRAMID_UINT8 the uint8 image is resized and the
+    pixel means are subtracted per level.
+
+    Arguments:
+        im (ndarray): a color image in BGR order
+        scales (list): scale factors to use instead of the ones given by
+            cfg.TEST.SCALES and cfg.TEST.MAX_SIZE
+
+    Returns:
+        processed_ims (list): mean-subtracted images, one per pyramid level
+        im_scale_factors (ndarray): image scales (relative to im) used in the
+            image pyramid
+    """
+    if cfg.TEST.PYRAMID_UINT8 and im.dtype == np.uint8:
+        im_orig = im
+    else:
+        im_orig = im.astype(np.float32, copy=True)
+        im_orig -= cfg.PIXEL_MEANS
+
+    im_shape = im_orig.shape
+    if scales is not None:
+        im_scale_factors = [float(im_scale) for im_scale in scales]
+    else:
+        im_scale_factors = _pyramid_scales(im_shape)
+
+    # Build the levels from the finest to the coarsest
+    processed_ims = [None] * len(im_scale_factors)
+    fine_im, fine_scale = im_orig, 1.
+    for k in np.argsort(im_scale_factors)[::-1]:
+        im_scale = im_scale_factors[k]
+        chain_ratio = cfg.TEST.PYRAMID_CHAIN_RATIO
+        if fine_im is not im_orig and chain_ratio > 0 and \
+                im_scale / fine_scale >= chain_ratio:
+            # same size as resizing the original image by im_scale
+            dsize = (int(np.round(im_shape[1] * im_scale)),
+                     int(np.round(im_shape[0] * im_scale)))
+            im = cv2.resize(fine_im, dsize, interpolation=cv2.INTER_LINEAR)
+        else:
+            im = cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
+                            interpolation=cv2.INTER_LINEAR)
+        # only downscaled levels are sharp enough to resize further
+        if im_scale < 1:
+            fine_im, fine_scale = im, im_scale
+        processed_ims[k] = im
+
+    if im_orig.dtype == np.uint8:
+        for k, im in enumerate(processed_ims):
+            processed_ims[k] = im.astype(np.float32)
+            processed_ims[k] -= cfg.PIXEL_MEANS
+
+    return processed_ims, np.array(im_scale_factors)
 
 def _get_image_blob(im):
     """Converts an image into a network input.
@@ -30,30 +131,12 @@ def _get_image_blob(im):
         im_scale_factors (list): list of image scales (relative to im) used
             in the image pyramid
     """
-    im_orig = im.astype(np.float32, copy=True)
-    im_orig -= cfg.PIXEL_MEANS
-
-    im_shape = im_orig.shape
-    im_size_min = np.min(im_shape[0:2])
-    im_size_max = np.max(im_shape[0:2])
-
-    processed_ims = []
-    im_scale_factors = []
-
-    for target_size in cfg.TEST.SCALES:
-        im_scale = float(target_size) / float(im_size_min)
-        # Prevent the biggest axis from being more than MAX_SIZE
-        if np.round(im_scale * im_size_max) > cfg.TEST.MAX_SIZE:
-            im_scale = float(cfg.TEST.MAX_SIZE) / float(im_size_max)
-        im = cv2.resize(im_orig, None, None, fx=im_scale, fy=im_scale,
-                        interpolation=cv2.INTER_LINEAR)
-        im_scale_factors.append(im_scale)
-        processed_ims.append(im)
+    processed_ims, im_scale_factors = _get_image_pyramid(im)
 
     # Create a blob to hold the input images
     blob = im_list_to_blob(processed_ims)
 
-    return blob, np.array(im_scale_factors)
+    return blob, im_scale_factors
 
 def _get_rois_blob(im_rois, im_scale_factors):
     """Converts RoIs into network inputs.
@@ -97,13 +180,22 @@ def _project_im_rois(im_rois, scales):
 
     return rois, levels
 
-def _get_blobs(im, rois):
-    """Convert an image and RoIs within that image into network inputs."""
-    blobs = {'data' : None, 'rois' : None}
-    blobs['data'], im_scale_factors = _get_image_blob(im)
-    if not cfg.TEST.HAS_RPN:
-        blobs['rois'] = _get_rois_blob(rois, im_scale_factors)
-    return blobs, im_scale_factors
+def _dedup_rois(rois_blob):
+    """Find the unique subset of an image's feature map RoIs.
+
+    When mapping from image ROIs to feature map ROIs, there's some aliasing
+    (some distinct image ROIs get mapped to the same feature ROI). Features
+    only need to be computed on the unique subset.
+
+    Returns:
+        index (ndarray): rows of rois_blob forming the unique subset
+        inv_index (ndarray): maps each original row to its unique row
+    """
+    v = np.array([1, 1e3, 1e6, 1e9, 1e12])
+    hashes = np.round(rois_blob * cfg.DEDUP_BOXES).dot(v)
+    _, index, inv_index = np.unique(hashes, return_index=True,
+                                    return_inverse=True)
+    return index, inv_index
 
 def im_detect(net, im, boxes=None):
     """Detect object classes in an image given object proposals.
@@ -118,32 +210,192 @@ def im_detect(net, im, boxes=None):
             background as object category 0)
         boxes (ndarray): R x (4*K) array of predicted bounding boxes
     """
-    blobs, im_scales = _get_blobs(im, boxes)
-
-    # When mapping from image ROIs to feature map ROIs, there's some aliasing
-    # (some distinct image ROIs get mapped to the same feature ROI).
-    # Here, we identify duplicate feature ROIs, so we only compute features
-    # on the unique subset.
-    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
-        v = np.array([1, 1e3, 1e6, 1e9, 1e12])
-        hashes = np.round(blobs['rois'] * cfg.DEDUP_BOXES).dot(v)
-        _, index, inv_index = np.unique(hashes, return_index=True,
-                                        return_inverse=True)
-        blobs['rois'] = blobs['rois'][index, :]
-        boxes = boxes[index, :]
+    return im_detect_batch(net, [im], [boxes])[0]
 
-    if cfg.TEST.HAS_RPN:
-        im_blob = blobs['data']
-        blobs['im_info'] = np.array(
-            [[im_blob.shape[2], im_blob.shape[3], im_scales[0]]],
-            dtype=np.float32)
+def im_detect_batch(net, ims, boxes_list=None):
+    """Detect object classes in several images with a single forward pass.
+
+    The images (and every level of their pyramids) are packed into one data
+    blob; the RoIs of all images are stacked into one rois blob whose first
+    column indexes the packed data blob.
+
+    Arguments:
+        net (caffe.Net): Fast R-CNN network to use
+        ims (list): color images to test (in BGR order)
+        boxes_list (list): R_i x 4 arrays of object proposals, one per image,
+            or None (for RPN)
+
+    Returns:
+        detections (list): (scores, boxes) per image, as returned by
+            im_detect
+    """
+    blobs, batch = _get_batch_blobs(ims, boxes_list)
+    return _forward_batch(net, blobs, batch)
+
+def _get_batch_blobs(ims, boxes_list=None, data_buckets=None, scales=None):
+    """Build the network inputs for im_detect_batch.
+
+    This does not touch the network, so it can run ahead of the forward pass
+    in another thread. With scales, every image is resized by those factors
+    instead of to cfg.TEST.SCALES (see _get_image_pyramid).
+
+    With data_buckets (see _data_shape_buckets) the data blob is zero-padded
+    to the smallest canonical (height, width) that holds it, and with
+    cfg.TEST.ROI_BUCKET the rois blob is padded with dummy RoIs to a
+    multiple of that count; outputs for the dummy RoIs are dropped.
+
+    Returns:
+        blobs (dict): network input blobs
+        batch (dict): per-image bookkeeping needed by _forward_batch, plus
+            pyramid statistics (prep_time, num_pixels, padded_pixels)
+    """
+    if boxes_list is None:
+        boxes_list = [None] * len(ims)
 
-    # reshape network inputs
-    net.blobs['data'].reshape(*(blobs['data'].shape))
+    timer = Timer()
+    timer.tic()
+    processed_ims = []
+    batch = {'im_shapes': [], 'im_scales': [], 'im_rois': [],
+             'num_rois': [], 'inv_index': []}
+    im_info_list = []
+    rois_blobs = []
+    content_pixels = 0
+    for im, boxes in zip(ims, boxes_list):
+        im_levels, im_scales = _get_image_pyramid(im, scales)
+        content_pixels += sum(level.shape[0] * level.shape[1]
+                              for level in im_levels)
+
+        if not cfg.TEST.HAS_RPN:
+            rois_blob = _get_rois_blob(boxes, im_scales)
+            inv_index = None
+            if cfg.DEDUP_BOXES > 0:
+                index, inv_index = _dedup_rois(rois_blob)
+                rois_blob = rois_blob[index, :]
+                boxes = boxes[index, :]
+            if cfg.TEST.PYRAMID_PACK and len(im_levels) > 1:
+                # all levels go into one canvas: move every RoI to where its
+                # level was placed
+                canvas, offsets = pack_im_list(im_levels,
+                                               gap=cfg.TEST.PYRAMID_PACK_GAP)
+                levels = rois_blob[:, 0].astype(np.int)
+                rois_blob[:, 1:] += offsets[levels][:, (1, 0, 1, 0)]
+                rois_blob[:, 0] = 0
+                im_levels = [canvas]
+            # pyramid level -> index of that level in the packed data blob
+            rois_blob[:, 0] += len(processed_ims)
+            rois_blobs.append(rois_blob)
+            batch['im_rois'].append(boxes)
+            batch['num_rois'].append(rois_blob.shape[0])
+            batch['inv_index'].append(inv_index)
+        else:
+            assert len(im_scales) == 1, "Only single-scale RPN testing implemented"
+            # (height, width, scale) of the image inside the padded blob
+            im_info_list.append(
+                [im_levels[0].shape[0], im_levels[0].shape[1], im_scales[0]])
+
+        processed_ims.extend(im_levels)
+        batch['im_shapes'].append(im.shape)
+        batch['im_scales'].append(im_scales)
+
+    blobs = {'data': im_list_to_blob(processed_ims)}
     if cfg.TEST.HAS_RPN:
-        net.blobs['im_info'].reshape(*(blobs['im_info'].shape))
+        blobs['im_info'] = np.array(im_info_list, dtype=np.float32)
     else:
-        net.blobs['rois'].reshape(*(blobs['rois'].shape))
+        blobs['rois'] = np.vstack(rois_blobs)
+
+    batch['raw_shapes'] = dict((name, blob.shape)
+                               for name, blob in blobs.iteritems())
+    if data_buckets:
+        blobs['data'] = _pad_to_bucket(blobs['data'], data_buckets)
+    if cfg.TEST.ROI_BUCKET > 0 and not cfg.TEST.HAS_RPN:
+        num_rois = blobs['rois'].shape[0]
+        num_padded = -num_rois % cfg.TEST.ROI_BUCKET
+        if num_padded > 0:
+            # dummy RoIs at the end, after every image's real RoIs
+            blobs['rois'] = np.vstack(
+                (blobs['rois'], np.zeros((num_padded, 5), dtype=np.float32)))
+
+    batch['prep_time'] = timer.toc(average=False)
+    batch['num_pixels'] = blobs['data'].shape[0] * blobs['data'].shape[2] * \
+        blobs['data'].shape[3]
+    batch['padded_pixels'] = batch['num_pixels'] - content_pixels
+    return blobs, batch
+
+def _pad_to_bucket(data, buckets):
+    """Zero-pad an N x C x H x W blob to the smallest bucket (height, width)
+    that holds it; the blob is returned as is if none does.
+    """
+    height, width = data.shape[2:]
+    fits = [(h * w, h, w) for h, w in buckets if h >= height and w >= width]
+    if len(fits) == 0:
+        return data
+    _, h, w = min(fits)
+    if (h, w) == (height, width):
+        return data
+    padded = np.zeros(data.shape[:2] + (h, w), dtype=data.dtype)
+    padded[:, :, :height, :width] = data
+    return padded
+
+def _data_blob_shape(height, width):
+    """(height, width) of the data blob _get_batch_blobs builds for a single
+    image of that size: the largest pyramid level or, with
+    cfg.TEST.PYRAMID_PACK, the canvas all levels are packed into.
+    """
+    # the same rounding as cv2.resize
+    shapes = [(int(np.round(height * im_scale)),
+               int(np.round(width * im_scale)))
+              for im_scale in _pyramid_scales((height, width))]
+    if cfg.TEST.PYRAMID_PACK and len(shapes) > 1 and not cfg.TEST.HAS_RPN:
+        _, canvas_shape = pack_shapes(shapes, gap=cfg.TEST.PYRAMID_PACK_GAP)
+        return tuple(canvas_shape)
+    return tuple(np.max(shapes, axis=0))
+
+def _data_shape_buckets(imdb, num_buckets):
+    """Choose canonical data blob shapes from the image sizes of imdb.
+
+    The data blob shape of every batch of test_net (cfg.TEST.IMS_PER_BATCH
+    images in imdb order) is computed from the image sizes the imdb already
+    knows, without reading the images. Batches are grouped by orientation
+    and, within an orientation, by blob area; every group gets the bucket
+    (max height, max width) of its members.
+
+    Returns:
+        buckets (list): (height, width) canonical shapes
+    """
+    im_shapes = [_data_blob_shape(height, width)
+                 for width, height in imdb.image_sizes()]
+    shapes = np.array([np.max(im_shapes[start:start + cfg.TEST.IMS_PER_BATCH],
+                              axis=0)
+                       for start in xrange(0, len(im_shapes),
+                                           cfg.TEST.IMS_PER_BATCH)])
+
+    buckets = set()
+    for portrait in (False, True):
+        group = shapes[(shapes[:, 0] > shapes[:, 1]) == portrait]
+        if len(group) == 0:
+            continue
+        group = group[np.argsort(group[:, 0] * group[:, 1])]
+        num_splits = max(1, int(round(num_buckets * float(len(group)) /
+                                      len(shapes))))
+        for split in np.array_split(group, num_splits):
+            if len(split) > 0:
+                buckets.add(tuple(split.max(axis=0)))
+    return sorted(buckets)
+
+def _forward_batch(net, blobs, batch, sparse=False):
+    """Run the network on blobs from _get_batch_blobs and split the outputs.
+
+    The returned arrays never alias network blobs, so they stay valid across
+    later forward passes. With sparse, the boxes of each image are returned
+    as _EncodedBoxes, which only decodes the (RoI, class) pairs that are
+    asked for.
+    """
+    # reshape network inputs whose shape changed since the last forward
+    batch['reshaped'] = False
+    for name in ('data', 'im_info' if cfg.TEST.HAS_RPN else 'rois'):
+        if net.blobs[name].data.shape != blobs[name].shape:
+            net.blobs[name].reshape(*(blobs[name].shape))
+            batch['reshaped'] = True
 
     # do forward
     forward_kwargs = {'data': blobs['data'].astype(np.float32, copy=False)}
@@ -154,34 +406,81 @@ def im_detect(net, im, boxes=None):
     blobs_out = net.forward(**forward_kwargs)
 
     if cfg.TEST.HAS_RPN:
-        assert len(im_scales) == 1, "Only single-image batch implemented"
         rois = net.blobs['rois'].data.copy()
-        # unscale back to raw image space
-        boxes = rois[:, 1:5] / im_scales[0]
 
     if cfg.TEST.SVM:
         # use the raw scores before softmax under the assumption they
         # were trained as linear SVMs
-        scores = net.blobs['cls_score'].data
+        all_scores = net.blobs['cls_score'].data
     else:
         # use softmax estimated probabilities
-        scores = blobs_out['cls_prob']
+        all_scores = blobs_out['cls_prob']
 
-    if cfg.TEST.BBOX_REG:
-        # Apply bounding-box regression deltas
-        box_deltas = blobs_out['bbox_pred']
-        pred_boxes = bbox_transform_inv(boxes, box_deltas)
-        pred_boxes = clip_boxes(pred_boxes, im.shape)
-    else:
-        # Simply repeat the boxes, once for each class
-        pred_boxes = np.tile(boxes, (1, scores.shape[1]))
+    # Split the batched outputs back per image
+    detections = []
+    start = 0
+    for i, im_shape in enumerate(batch['im_shapes']):
+        if cfg.TEST.HAS_RPN:
+            inds = np.where(rois[:, 0] == i)[0]
+            # unscale back to raw image space
+            boxes = rois[inds, 1:5] / batch['im_scales'][i][0]
+        else:
+            inds = np.arange(start, start + batch['num_rois'][i])
+            start += batch['num_rois'][i]
+            boxes = batch['im_rois'][i]
+
+        scores = all_scores[inds]
+
+        inv_index = None
+        if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
+            inv_index = batch['inv_index'][i]
+
+        if sparse:
+            box_deltas = None
+            if cfg.TEST.BBOX_REG:
+                box_deltas = blobs_out['bbox_pred'][inds]
+            pred_boxes = _EncodedBoxes(boxes, box_deltas, im_shape, inv_index)
+        elif cfg.TEST.BBOX_REG:
+            # Apply bounding-box regression deltas
+            box_deltas = blobs_out['bbox_pred'][inds]
+            pred_boxes = bbox_transform_inv(boxes, box_deltas)
+            pred_boxes = clip_boxes(pred_boxes, im_shape)
+        else:
+            # Simply repeat the boxes, once for each class
+            pred_boxes = np.tile(boxes, (1, scores.shape[1]))
+
+        if inv_index is not None:
+            # Map scores and predictions back to the original set of boxes
+            scores = scores[inv_index, :]
+            if not sparse:
+                pred_boxes = pred_boxes[inv_index, :]
 
-    if cfg.DEDUP_BOXES > 0 and not cfg.TEST.HAS_RPN:
-        # Map scores and predictions back to the original set of boxes
-        scores = scores[inv_index, :]
-        pred_boxes = pred_boxes[inv_index, :]
+        detections.append((scores, pred_boxes))
 
-    return scores, pred_boxes
+    return detections
+
+class _EncodedBoxes(object):
+    """Per-class predicted boxes of one image, decoded on demand.
+
+    take(inds, classes) returns the same rows as indexing the dense
+    R x (4*K) boxes returned by im_detect, but only regresses and clips the
+    requested (RoI, class) pairs.
+    """
+
+    def __init__(self, rois, deltas, im_shape, inv_index=None):
+        self._rois = rois
+        self._deltas = deltas
+        self._im_shape = im_shape
+        self._inv_index = inv_index
+
+    def take(self, inds, classes):
+        if self._inv_index is not None:
+            inds = self._inv_index[inds]
+        if self._deltas is None:
+            return self._rois[inds, :]
+        boxes = bbox_transform_inv_pairs(self._rois, self._deltas,
+                                         inds, classes)
+        return clip_boxes(boxes, self._im_shape)
 
 def vis_detections(im, class_name, dets, thresh=0.3):
     """Visual debugging of detections."""
@@ -202,94 +501,429 @@ def vis_detections(im, class_name, dets, thresh=0.3):
             plt.title('{}  {:.3f}'.format(class_name, score))
             plt.show()
 
-def apply_nms(all_boxes, thresh):
+def apply_nms(detections, thresh):
     """Apply non-maximum suppression to all predicted boxes output by the
     test_net method.
+
+    Arguments:
+        detections (Detections): detections, or legacy all_boxes lists
+        thresh (float): IoU threshold
+
+    Returns:
+        nms_detections (Detections): the kept detections
     """
-    num_classes = len(all_boxes)
-    num_images = len(all_boxes[0])
-    nms_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(num_classes)]
-    for cls_ind in xrange(num_classes):
-        for im_ind in xrange(num_images):
-            dets = all_boxes[cls_ind][im_ind]
-            if dets == []:
-                continue
-            # CPU NMS is much faster than GPU NMS when the number of boxes
-            # is relative small (e.g., < 10k)
-            # TODO(rbg): autotune NMS dispatch
-            keep = nms(dets, thresh, force_cpu=True)
-            if len(keep) == 0:
+    if not isinstance(detections, Detections):
+        detections = Detections.from_all_boxes(detections)
+    # every (image, class) cell is suppressed independently
+    groups = detections.images.astype(np.int64) * detections.num_classes + \
+        detections.classes
+    keep, _ = group_nms(detections.boxes, detections.scores, groups, thresh)
+    return detections.take(keep)
+
+def _image_detections(scores, boxes, max_per_image, thresh):
+    """Threshold, NMS and cap the detections of one image.
+
+    All classes are thresholded at once and suppressed with a single
+    class-aware NMS call (hard or Soft-NMS, see cfg.TEST.NMS_METHOD).
+
+    Arguments:
+        scores (ndarray): R x K class scores, as returned by im_detect
+        boxes (ndarray): R x (4*K) boxes, as returned by im_detect, or
+            _EncodedBoxes
+        max_per_image (int): cap on detections over all classes (0: no cap)
+        thresh (float): score threshold
+
+    Returns:
+        dets (ndarray): N x 6 array of (x1, y1, x2, y2, score, class), sorted
+            by class and, within a class, by decreasing score
+    """
+    num_rois, num_classes = scores.shape
+    # skip j = 0, because it's the background class
+    inds, classes = np.nonzero(scores[:, 1:] > thresh)
+    classes += 1
+
+    dets = np.empty((len(inds), 6), dtype=np.float32)
+    if isinstance(boxes, _EncodedBoxes):
+        dets[:, :4] = boxes.take(inds, classes)
+    else:
+        dets[:, :4] = boxes.reshape((num_rois, num_classes, 4))[inds, classes]
+    dets[:, 4] = scores[inds, classes]
+    dets[:, 5] = classes
+    # a class cannot contribute more than max_per_image detections to the
+    # final cap, so NMS can stop after that many per class
+    keep, keep_scores = group_nms(dets[:, :4], dets[:, 4], classes,
+                                  cfg.TEST.NMS, method=cfg.TEST.NMS_METHOD,
+                                  sigma=cfg.TEST.SOFT_NMS_SIGMA,
+                                  min_score=cfg.TEST.SOFT_NMS_MIN_SCORE,
+                                  max_num=max_per_image)
+    dets = dets[keep, :]
+    dets[:, 4] = keep_scores
+
+    # Limit to max_per_image detections *over all classes*
+    if 0 < max_per_image < dets.shape[0]:
+        kth = dets.shape[0] - max_per_image
+        image_thresh = np.partition(dets[:, 4], kth)[kth]
+        dets = dets[dets[:, 4] >= image_thresh, :]
+    return dets
+
+def _tile_starts(length, tile_size, overlap):
+    """Start offsets of tiles covering [0, length); the last tile is moved
+    back to end at length, so every tile (but a single one) is full size.
+    """
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = range(0, length - tile_size, stride)
+    starts.append(length - tile_size)
+    return starts
+
+def _assign_rois_to_tiles(boxes, tiles):
+    """Give every proposal to the tile that holds most of it.
+
+    Proposals fully inside several tiles go to the tile whose center is
+    closest to theirs, so they are away from the tile borders.
+
+    Returns:
+        assignment (ndarray): tile index of every proposal
+    """
+    boxes = boxes.astype(np.float32, copy=False)
+    tiles = np.asarray(tiles, dtype=np.float32)
+    iw = np.minimum(boxes[:, 2:3], tiles[:, 2]) - \
+        np.maximum(boxes[:, 0:1], tiles[:, 0]) + 1
+    ih = np.minimum(boxes[:, 3:4], tiles[:, 3]) - \
+        np.maximum(boxes[:, 1:2], tiles[:, 1]) + 1
+    inter = np.maximum(iw, 0) * np.maximum(ih, 0)
+    best = inter >= inter.max(axis=1)[:, np.newaxis]
+    ctr_dist = \
+        np.abs((boxes[:, 0:1] + boxes[:, 2:3]) - (tiles[:, 0] + tiles[:, 2])) + \
+        np.abs((boxes[:, 1:2] + boxes[:, 3:4]) - (tiles[:, 1] + tiles[:, 3]))
+    return np.argmin(np.where(best, ctr_dist, np.inf), axis=1)
+
+def im_detect_tiled(net, im, boxes=None, max_per_image=100, thresh=0.05,
+                    tile_size=None, overlap=None):
+    """Detect objects in a large image tile by tile.
+
+    The image is cut into overlapping tile_size x tile_size tiles (default
+    cfg.TEST.TILE_SIZE) that overlap by overlap pixels (default
+    cfg.TEST.TILE_OVERLAP); the last tile of a row or column is moved back
+    inside the image, so all tiles have the same size unless the image is
+    smaller than a tile. Tiles are tested at native resolution (scale 1,
+    whatever cfg.TEST.SCALES is) and run cfg.TEST.IMS_PER_BATCH at a time,
+    so memory use depends on the tile size rather than the image size.
+
+    Proposals are assigned to the tile holding most of them (and clipped to
+    it). Detections that end on an inner tile border and are narrower than
+    the overlap are dropped, since the neighbouring tile sees all of the
+    object; the rest are mapped back to image coordinates and merged with
+    class-aware NMS.
+
+    Returns:
+        dets (ndarray): N x 6 array of (x1, y1, x2, y2, score, class), as
+            returned by _image_detections
+    """
+    if tile_size is None:
+        tile_size = cfg.TEST.TILE_SIZE
+    if overlap is None:
+        overlap = cfg.TEST.TILE_OVERLAP
+    assert 0 <= overlap < tile_size, 'Tile overlap must be below tile size'
+
+    height, width = im.shape[:2]
+    tiles = [(x, y, min(x + tile_size, width) - 1,
+              min(y + tile_size, height) - 1)
+             for y in _tile_starts(height, tile_size, overlap)
+             for x in _tile_starts(width, tile_size, overlap)]
+    if boxes is not None:
+        assignment = _assign_rois_to_tiles(boxes, tiles)
+
+    crops = []
+    for t, (x1, y1, x2, y2) in enumerate(tiles):
+        tile_boxes = None
+        if boxes is not None:
+            tile_boxes = boxes[assignment == t, :].astype(np.float32) - \
+                (x1, y1, x1, y1)
+            if tile_boxes.shape[0] == 0:
                 continue
-            nms_boxes[cls_ind][im_ind] = dets[keep, :].copy()
-    return nms_boxes
+            tile_boxes = clip_boxes(tile_boxes, (y2 - y1 + 1, x2 - x1 + 1))
+        crops.append((tiles[t], tile_boxes))
+
+    all_dets = []
+    for start in xrange(0, len(crops), cfg.TEST.IMS_PER_BATCH):
+        batch_crops = crops[start:start + cfg.TEST.IMS_PER_BATCH]
+        blobs, batch = _get_batch_blobs(
+            [im[y1:y2 + 1, x1:x2 + 1] for (x1, y1, x2, y2), _ in batch_crops],
+            None if cfg.TEST.HAS_RPN else
+            [b for _, b in batch_crops], scales=[1.])
+        outputs = _forward_batch(net, blobs, batch,
+                                 sparse=cfg.TEST.SPARSE_DECODE)
+        for ((x1, y1, x2, y2), _), (scores, pred_boxes) in \
+                zip(batch_crops, outputs):
+            dets = _image_detections(scores, pred_boxes, 0, thresh)
+            # drop truncated copies of objects that the next tile holds whole
+            keep = np.ones(dets.shape[0], dtype=np.bool)
+            w = dets[:, 2] - dets[:, 0] + 1
+            h = dets[:, 3] - dets[:, 1] + 1
+            if x1 > 0:
+                keep &= (dets[:, 0] > 0) | (w >= overlap)
+            if x2 < width - 1:
+                keep &= (dets[:, 2] < x2 - x1) | (w >= overlap)
+            if y1 > 0:
+                keep &= (dets[:, 1] > 0) | (h >= overlap)
+            if y2 < height - 1:
+                keep &= (dets[:, 3] < y2 - y1) | (h >= overlap)
+            dets = dets[keep, :]
+            dets[:, :4] += (x1, y1, x1, y1)
+            all_dets.append(dets)
+
+    if len(all_dets) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+    dets = np.vstack(all_dets)
+    # merge duplicates across tile seams (hard NMS: Soft-NMS already ran
+    # inside every tile)
+    keep, _ = group_nms(dets[:, :4], dets[:, 4], dets[:, 5], cfg.TEST.NMS,
+                        max_num=max_per_image)
+    dets = dets[keep, :]
+    if 0 < max_per_image < dets.shape[0]:
+        kth = dets.shape[0] - max_per_image
+        image_thresh = np.partition(dets[:, 4], kth)[kth]
+        dets = dets[dets[:, 4] >= image_thresh, :]
+    return dets
 
 def test_net(net, imdb, max_per_image=100, thresh=0.05, vis=False):
-    """Test a Fast R-CNN network on an image database."""
+    """Test a Fast R-CNN network on an image database.
+
+    Testing runs as a three-stage pipeline: a pool of cfg.TEST.PREP_THREADS
+    threads reads images and builds the input blobs, the main thread runs
+    the forward passes, and a pool of cfg.TEST.POST_THREADS threads does
+    the per-class thresholding and NMS. Stages hand work over through
+    queues bounded by cfg.TEST.PIPELINE_DEPTH.
+
+    Detections are flushed every cfg.TEST.CHECKPOINT_IMAGES images to a log
+    in the output directory; an interrupted run restarted with the same
+    output directory skips the images that were already flushed.
+    """
     num_images = len(imdb.image_index)
-    # all detections are collected into:
-    #    all_boxes[cls][image] = N x 5 array of detections in
-    #    (x1, y1, x2, y2, score)
-    all_boxes = [[[] for _ in xrange(num_images)]
-                 for _ in xrange(imdb.num_classes)]
 
     output_dir = get_output_dir(imdb, net)
+    # all detections are collected in an append-only log on disk
+    det_log = DetectionLog(os.path.join(output_dir, 'detections_log'),
+                           num_images, imdb.num_classes,
+                           chunk_size=cfg.TEST.CHECKPOINT_IMAGES,
+                           settings=_detections_digest(thresh, max_per_image))
+    if len(det_log.done) > 0:
+        print 'Resuming: {:d}/{:d} images already done'.format(
+            len(det_log.done), num_images)
+
+    data_buckets = None
+    if cfg.TEST.SHAPE_BUCKETS > 0:
+        data_buckets = _data_shape_buckets(imdb, cfg.TEST.SHAPE_BUCKETS)
+        print 'Data blob buckets: {}'.format(data_buckets)
+
+    def prep(batch_inds):
+        ims, box_proposals = _load_images(imdb, batch_inds)
+        blobs, batch = _get_batch_blobs(ims, box_proposals, data_buckets)
+        return batch_inds, (ims if vis else None), blobs, batch
+
+    def post(i, scores, boxes):
+        dets = _image_detections(scores, boxes, max_per_image, thresh)
+        det_log.append(i, dets)
+        return dets
+
+    todo = [i for i in xrange(num_images) if i not in det_log.done]
+    batches = [(todo[start:start + cfg.TEST.IMS_PER_BATCH],)
+               for start in xrange(0, len(todo), cfg.TEST.IMS_PER_BATCH)]
+    prep_pool = StagePool('prep', prep, cfg.TEST.PREP_THREADS,
+                          cfg.TEST.PIPELINE_DEPTH)
+    # visualization has to happen on the main thread
+    post_pool = StagePool('post', post, 0 if vis else cfg.TEST.POST_THREADS,
+                          cfg.TEST.PIPELINE_DEPTH)
 
     # timers
-    _t = {'im_detect' : Timer(), 'misc' : Timer()}
-
-    if not cfg.TEST.HAS_RPN:
-        roidb = imdb.roidb
-
-    for i in xrange(num_images):
-        # filter out any ground truth boxes
-        if cfg.TEST.HAS_RPN:
-            box_proposals = None
-        else:
-            # The roidb may contain ground-truth rois (for example, if the roidb
-            # comes from the training or val split). We only want to evaluate
-            # detection on the *non*-ground-truth rois. We select those the rois
-            # that have the gt_classes field set to 0, which means there's no
-            # ground truth.
-            box_proposals = roidb[i]['boxes'][roidb[i]['gt_classes'] == 0]
-
-        im = cv2.imread(imdb.image_path_at(i))
+    _t = {'im_detect' : Timer(), 'wait' : Timer()}
+    # (total forward time, forwards), keyed by whether the net was reshaped
+    forwards = {True: [0., 0], False: [0., 0]}
+    # forwards that would have reshaped the net without bucketing
+    raw_reshapes = 0
+    last_raw_shapes = None
+    pyramid = {'prep_time': 0., 'num_pixels': 0, 'padded_pixels': 0}
+    results = collections.deque()
+
+    _t['wait'].tic()
+    for batch_inds, ims, blobs, batch in prep_pool.imap(batches):
+        _t['wait'].toc()
+        for key in pyramid:
+            pyramid[key] += batch[key]
         _t['im_detect'].tic()
-        scores, boxes = im_detect(net, im, box_proposals)
+        outputs = _forward_batch(net, blobs, batch,
+                                 sparse=cfg.TEST.SPARSE_DECODE)
         _t['im_detect'].toc()
-
-        _t['misc'].tic()
-        # skip j = 0, because it's the background class
-        for j in xrange(1, imdb.num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            cls_scores = scores[inds, j]
-            cls_boxes = boxes[inds, j*4:(j+1)*4]
-            cls_dets = np.hstack((cls_boxes, cls_scores[:, np.newaxis])) \
-                .astype(np.float32, copy=False)
-            keep = nms(cls_dets, cfg.TEST.NMS)
-            cls_dets = cls_dets[keep, :]
+        forwards[batch['reshaped']][0] += _t['im_detect'].diff
+        forwards[batch['reshaped']][1] += 1
+        if batch['raw_shapes'] != last_raw_shapes:
+            raw_reshapes += 1
+            last_raw_shapes = batch['raw_shapes']
+
+        for k, (i, (scores, boxes)) in enumerate(zip(batch_inds, outputs)):
+            results.append(post_pool.submit(i, scores, boxes))
             if vis:
-                vis_detections(im, imdb.classes[j], cls_dets)
-            all_boxes[j][i] = cls_dets
-
-        # Limit to max_per_image detections *over all classes*
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1]
-                                      for j in xrange(1, imdb.num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
+                dets = results[-1].get()
                 for j in xrange(1, imdb.num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-        _t['misc'].toc()
+                    vis_detections(ims[k], imdb.classes[j],
+                                   dets[dets[:, 5] == j, :5])
+
+            print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
+                  .format(i + 1, num_images, _t['im_detect'].average_time,
+                          post_pool.average_time)
+        # re-raise errors from the post-processing workers early, and do not
+        # hold on to detections that are already in the log
+        while len(results) > 0 and results[0].ready():
+            results.popleft().get()
+        _t['wait'].tic()
+
+    for result in results:
+        # re-raises any exception from the post-processing workers
+        result.get()
+    prep_pool.close()
+    post_pool.close()
+
+    print 'Pipeline busy / idle time:'
+    for name, busy, idle in [
+            ('prep', prep_pool.busy_time, prep_pool.idle_time),
+            ('forward', _t['im_detect'].total_time, _t['wait'].total_time),
+            ('post', post_pool.busy_time, post_pool.idle_time)]:
+        print '{:>8s}: busy {:.1f}s  idle {:.1f}s'.format(name, busy, idle)
+    num_reshapes = forwards[True][1]
+    print 'Net input reshapes: {:d} of {:d} forwards ({:d} without ' \
+          'bucketing)'.format(num_reshapes, _t['im_detect'].calls,
+                              raw_reshapes)
+    if num_reshapes > 0 and forwards[False][1] > 0:
+        reshape_cost = forwards[True][0] / forwards[True][1] - \
+            forwards[False][0] / forwards[False][1]
+        print 'Estimated time saved by bucketing: {:.1f}s'.format(
+            (raw_reshapes - num_reshapes) * reshape_cost)
+    if len(todo) > 0:
+        print 'Image pyramids: {:.3f}s per image, {:d} of {:d} blob ' \
+              'pixels ({:.1%}) are padding'.format(
+                  pyramid['prep_time'] / len(todo), pyramid['padded_pixels'],
+                  pyramid['num_pixels'], float(pyramid['padded_pixels']) /
+                  max(pyramid['num_pixels'], 1))
+
+    _save_and_evaluate(det_log, imdb, output_dir)
+
+def _test_shard(prototxt, caffemodel, imdb, image_inds, max_per_image,
+                thresh, queue):
+    """Worker process of test_net_sharded: detect on image_inds on the CPU
+    and put (image index, detections) on queue.
+    """
+    try:
+        # imported here so that the rest of this module (used by
+        # fast_rcnn.server) works with any object exposing a Caffe-style
+        # forward() and blobs
+        import caffe
+        caffe.set_mode_cpu()
+        cfg.USE_GPU_NMS = False
+        net = caffe.Net(prototxt, caffemodel, caffe.TEST)
+        for start in xrange(0, len(image_inds), cfg.TEST.IMS_PER_BATCH):
+            batch_inds = image_inds[start:start + cfg.TEST.IMS_PER_BATCH]
+            ims, box_proposals = _load_images(imdb, batch_inds)
+            blobs, batch = _get_batch_blobs(ims, box_proposals)
+            outputs = _forward_batch(net, blobs, batch,
+                                     sparse=cfg.TEST.SPARSE_DECODE)
+            for i, (scores, boxes) in zip(batch_inds, outputs):
+                queue.put((i, _image_detections(scores, boxes, max_per_image,
+                                                thresh)))
+    except Exception:
+        queue.put((None, traceback.format_exc()))
+
+def test_net_sharded(prototxt, caffemodel, imdb, num_workers,
+                     max_per_image=100, thresh=0.05, strided=True):
+    """Test a Fast R-CNN network on an image database with several CPU
+    worker processes.
+
+    Each worker loads its own copy of the network in CPU mode and tests a
+    strided (image k, k + num_workers, ...) or contiguous shard of the
+    images; results are streamed back to this process, which logs them like
+    test_net and evaluates once at the end.
+    """
+    num_images = len(imdb.image_index)
+    net_name = os.path.splitext(os.path.basename(caffemodel))[0]
+
+    output_dir = get_output_dir(imdb, net_name)
+    det_log = DetectionLog(os.path.join(output_dir, 'detections_log'),
+                           num_images, imdb.num_classes,
+                           chunk_size=cfg.TEST.CHECKPOINT_IMAGES,
+                           settings=_detections_digest(thresh, max_per_image))
+    if len(det_log.done) > 0:
+        print 'Resuming: {:d}/{:d} images already done'.format(
+            len(det_log.done), num_images)
+
+    todo = [i for i in xrange(num_images) if i not in det_log.done]
+    if strided:
+        shards = [todo[k::num_workers] for k in xrange(num_workers)]
+    else:
+        bounds = np.linspace(0, len(todo), num_workers + 1).astype(np.int)
+        shards = [todo[bounds[k]:bounds[k + 1]] for k in xrange(num_workers)]
+
+    if not cfg.TEST.HAS_RPN and len(todo) > 0:
+        # read the proposal file (or build the roidb) before forking so that
+        # the workers share it
+        imdb.proposal_boxes(todo[0])
+    queue = multiprocessing.Queue(cfg.TEST.PIPELINE_DEPTH * num_workers)
+    workers = [multiprocessing.Process(
+                   target=_test_shard,
+                   args=(prototxt, caffemodel, imdb, shard, max_per_image,
+                         thresh, queue))
+               for shard in shards]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    timer = Timer()
+    timer.tic()
+    for n in xrange(len(todo)):
+        while True:
+            try:
+                i, dets = queue.get(timeout=10)
+                break
+            except Queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError('All test workers exited early')
+        if i is None:
+            for worker in workers:
+                worker.terminate()
+            raise RuntimeError('Test worker failed:\n' + dets)
+        det_log.append(i, dets)
+        print 'im_detect: {:d}/{:d} {:.3f}s' \
+              .format(n + 1, len(todo), timer.toc(average=False) / (n + 1))
+    for worker in workers:
+        worker.join()
+
+    _save_and_evaluate(det_log, imdb, output_dir)
+
+def _load_images(imdb, image_inds):
+    """Read images and their proposals for testing.
+
+    Returns:
+        ims (list): color images (in BGR order)
+        box_proposals (list): R x 4 arrays of object proposals, or None
+            (for RPN)
+    """
+    if cfg.TEST.HAS_RPN:
+        box_proposals = None
+    else:
+        # proposals only (no ground-truth boxes), read without building the
+        # training roidb when the dataset supports it
+        box_proposals = [imdb.proposal_boxes(i) for i in image_inds]
 
-        print 'im_detect: {:d}/{:d} {:.3f}s {:.3f}s' \
-              .format(i + 1, num_images, _t['im_detect'].average_time,
-                      _t['misc'].average_time)
+    ims = [cv2.imread(imdb.image_path_at(i)) for i in image_inds]
+    return ims, box_proposals
 
-    det_file = os.path.join(output_dir, 'detections.pkl')
-    with open(det_file, 'wb') as f:
-        cPickle.dump(all_boxes, f, cPickle.HIGHEST_PROTOCOL)
+def _save_and_evaluate(det_log, imdb, output_dir):
+    """Save the logged detections column-wise and evaluate them."""
+    all_dets = det_log.load()
+    det_dir = os.path.join(output_dir, 'detections')
+    all_dets.save(det_dir)
+    det_log.remove()
+    print 'Wrote detections to {}'.format(det_dir)
 
     print 'Evaluating detections'
-    imdb.evaluate_detections(all_boxes, output_dir)
+    imdb.evaluate_detections(all_dets, output_dir)
@@ -10,6 +10,7 @@
 import caffe
 from fast_rcnn.config import cfg
 import roi_data_layer.roidb as rdl_roidb
+from roi_data_layer.base_layer import print_layer_timings
 from utils.timer import Timer
 import numpy as np
 import os
@@ -103,6 +104,7 @@ class SolverWrapper(object):
             timer.toc()
             if self.solver.iter % (10 * self.solver_param.display) == 0:
                 print 'speed: {:.3f}s / iter'.format(timer.average_time)
+                print_layer_timings()
 
             if self.solver.iter % cfg.TRAIN.SNAPSHOT_ITERS == 0:
                 last_snapshot_iter = self.solver.iter
@@ -0,0 +1,133 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+# cython: boundscheck=False, wraparound=False, cdivision=True
+
+"""Multi-threaded CPU NMS using the block bitmask scheme of nms_kernel.cu.
+
+Boxes are sorted by decreasing score and cut into blocks of 64; a 64-bit
+word per block records which of its boxes are suppressed. Blocks are
+resolved in order: the boxes of a block that survive the earlier blocks
+are checked against each other serially, then the block's kept boxes mark
+the boxes they suppress in every later block, one word per task, in
+parallel with the GIL released. Only kept boxes are ever compared with the
+rest, so the work is that of cpu_nms while the overlap loop is branch-free
+and spread over threads.
+
+The overlap test is the same float32 computation as cpu_nms, so the kept
+boxes are identical.
+"""
+
+import numpy as np
+cimport numpy as np
+cimport openmp
+from cython.parallel cimport prange
+from libc.stdint cimport uint64_t
+
+DEF BLOCK = 64
+
+cdef inline np.float32_t max(np.float32_t a, np.float32_t b) nogil:
+    return a if a >= b else b
+
+cdef inline np.float32_t min(np.float32_t a, np.float32_t b) nogil:
+    return a if a <= b else b
+
+cdef inline int imax(int a, int b) nogil:
+    return a if a >= b else b
+
+cdef inline int imin(int a, int b) nogil:
+    return a if a <= b else b
+
+cdef inline uint64_t _overlap_bits(int i, int col_block, int j_start,
+                                   int j_end, np.float32_t *x1,
+                                   np.float32_t *y1, np.float32_t *x2,
+                                   np.float32_t *y2, np.float32_t *areas,
+                                   double thresh) nogil:
+    """Bits of the boxes j_start <= j < j_end of col_block that box i
+    overlaps by at least thresh."""
+    cdef int j
+    cdef np.float32_t ix1 = x1[i], iy1 = y1[i], ix2 = x2[i], iy2 = y2[i]
+    cdef np.float32_t iarea = areas[i]
+    cdef np.float32_t w, h, inter, ovr
+    cdef uint64_t bits = 0
+    # branch-free so that the compiler can vectorize it
+    for j in range(j_start, j_end):
+        w = max(0.0, min(ix2, x2[j]) - max(ix1, x1[j]) + 1)
+        h = max(0.0, min(iy2, y2[j]) - max(iy1, y1[j]) + 1)
+        inter = w * h
+        ovr = inter / (iarea + areas[j] - inter)
+        bits |= (<uint64_t>(ovr >= thresh)) << (j - col_block * BLOCK)
+    return bits
+
+def cpu_bitmask_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh,
+                    int num_threads=0, int max_num=0):
+    """Greedy NMS over dets (N x 5: x1, y1, x2, y2, score); returns the
+    indices of the kept boxes by decreasing score, like cpu_nms.
+
+    num_threads <= 0 uses the OpenMP default number of threads. The scan
+    stops once max_num boxes are kept (max_num <= 0: no limit).
+    """
+    cdef np.ndarray[np.int_t, ndim=1] order = dets[:, 4].argsort()[::-1]
+    # coordinates of the sorted boxes, one contiguous array each
+    cdef np.ndarray[np.float32_t, ndim=2] boxes = \
+            np.ascontiguousarray(dets[order, :4].T)
+    cdef np.ndarray[np.float32_t, ndim=1] areas = \
+            (boxes[2] - boxes[0] + 1) * (boxes[3] - boxes[1] + 1)
+
+    cdef int ndets = dets.shape[0]
+    cdef int col_blocks = (ndets + BLOCK - 1) // BLOCK
+    cdef np.ndarray[np.uint64_t, ndim=1] remv = \
+            np.zeros((imax(col_blocks, 1)), dtype=np.uint64)
+    # sorted indices of the kept boxes
+    cdef np.ndarray[np.int32_t, ndim=1] kept = \
+            np.zeros((ndets), dtype=np.int32)
+
+    if num_threads <= 0:
+        num_threads = openmp.omp_get_max_threads()
+    if ndets == 0:
+        return []
+    cdef np.float32_t *x1 = &boxes[0, 0]
+    cdef np.float32_t *y1 = &boxes[1, 0]
+    cdef np.float32_t *x2 = &boxes[2, 0]
+    cdef np.float32_t *y2 = &boxes[3, 0]
+    cdef np.float32_t *a = &areas[0]
+    cdef uint64_t *r = &remv[0]
+    cdef np.int32_t *k = &kept[0]
+    cdef double c_thresh = thresh
+    cdef int row_block, col_block, i, n, i_end, block_start, num_kept = 0
+    cdef bint done = False
+    cdef uint64_t bits
+    with nogil:
+        for row_block in range(col_blocks):
+            # resolve the block serially: its boxes only need suppressing
+            # by the kept boxes of the block itself and of earlier blocks
+            block_start = num_kept
+            i_end = imin(ndets, (row_block + 1) * BLOCK)
+            for i in range(row_block * BLOCK, i_end):
+                if r[row_block] & ((<uint64_t>1) << (i % BLOCK)):
+                    continue
+                k[num_kept] = i
+                num_kept += 1
+                if num_kept == max_num:
+                    done = True
+                    break
+                r[row_block] |= _overlap_bits(i, row_block, i + 1, i_end,
+                                              x1, y1, x2, y2, a, c_thresh)
+            if done:
+                break
+            if block_start == num_kept or row_block + 1 == col_blocks:
+                continue
+            # then suppress the later blocks in parallel, one word each
+            for col_block in prange(row_block + 1, col_blocks,
+                                    schedule='static',
+                                    num_threads=num_threads):
+                bits = 0
+                for n in range(block_start, num_kept):
+                    bits = bits | _overlap_bits(
+                        k[n], col_block, col_block * BLOCK,
+                        imin(ndets, (col_block + 1) * BLOCK),
+                        x1, y1, x2, y2, a, c_thresh)
+                r[col_block] |= bits
+    return list(order[kept[:num_kept]])
@@ -0,0 +1,188 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+# cython: boundscheck=False, wraparound=False, cdivision=True
+
+"""Class-aware hard NMS and Soft-NMS over many groups in one compiled loop.
+
+Boxes are sorted once by (group, decreasing score) and every group is then
+suppressed in place, without returning to Python between groups. Boxes of
+a group are visited in the same order as cpu_nms visits them, including
+among equal scores, and hard NMS uses the same float32 overlap test, so it
+keeps the same boxes as cpu_nms applied to every group. Soft-NMS (Bodla et al.,
+ICCV 2017) decays the scores of the boxes overlapping each picked box by
+1 - IoU above thresh (linear) or exp(-IoU^2 / sigma) (gaussian) and drops
+boxes whose score falls below min_score.
+"""
+
+import numpy as np
+cimport numpy as np
+from libc.math cimport exp
+
+# values of the method argument
+DEF HARD = 0
+DEF LINEAR = 1
+DEF GAUSSIAN = 2
+
+cdef inline np.float32_t max(np.float32_t a, np.float32_t b) nogil:
+    return a if a >= b else b
+
+cdef inline np.float32_t min(np.float32_t a, np.float32_t b) nogil:
+    return a if a <= b else b
+
+cdef inline np.float32_t _overlap(np.float32_t *b, np.float32_t *areas,
+                                  int i, int j) nogil:
+    cdef np.float32_t w = max(0.0, min(b[4 * i + 2], b[4 * j + 2]) -
+                                   max(b[4 * i], b[4 * j]) + 1)
+    cdef np.float32_t h = max(0.0, min(b[4 * i + 3], b[4 * j + 3]) -
+                                   max(b[4 * i + 1], b[4 * j + 1]) + 1)
+    cdef np.float32_t inter = w * h
+    return inter / (areas[i] + areas[j] - inter)
+
+cdef inline void _swap(np.float32_t *b, np.float32_t *areas,
+                       np.float32_t *s, np.int64_t *idx, int i, int j) nogil:
+    cdef int k
+    cdef np.float32_t f
+    cdef np.int64_t n
+    for k in range(4):
+        f = b[4 * i + k]
+        b[4 * i + k] = b[4 * j + k]
+        b[4 * j + k] = f
+    f = areas[i]
+    areas[i] = areas[j]
+    areas[j] = f
+    f = s[i]
+    s[i] = s[j]
+    s[j] = f
+    n = idx[i]
+    idx[i] = idx[j]
+    idx[j] = n
+
+def _group_order(np.ndarray[np.float32_t, ndim=1] scores,
+                 np.ndarray[np.int64_t, ndim=1] groups):
+    """Order of the boxes by group and, within a group, in the order
+    cpu_nms visits the group's boxes (given in their original order).
+
+    Returns:
+        idx (ndarray): box indices in that order
+        bounds (ndarray): start of every group in idx, then len(idx)
+    """
+    idx = np.lexsort((-scores, groups)).astype(np.int64)
+    sorted_groups = groups[idx]
+    sorted_scores = scores[idx]
+    bounds = np.r_[0, np.flatnonzero(np.diff(sorted_groups)) + 1,
+                   len(idx)].astype(np.int64)
+    # cpu_nms orders by scores.argsort()[::-1], which is not stable: redo
+    # that exact sort in every group with equal scores
+    tied = np.flatnonzero((np.diff(sorted_groups) == 0) &
+                          (np.diff(sorted_scores) == 0))
+    for g in np.unique(np.searchsorted(bounds, tied, side='right') - 1):
+        inds = np.sort(idx[bounds[g]:bounds[g + 1]])
+        idx[bounds[g]:bounds[g + 1]] = inds[scores[inds].argsort()[::-1]]
+    return idx, bounds
+
+cdef int _hard_group(np.float32_t *b, np.float32_t *areas, np.float32_t *s,
+                     np.int64_t *idx, np.uint8_t *suppressed, int start,
+                     int end, double thresh, int max_num,
+                     np.int64_t *keep, np.float32_t *keep_scores) nogil:
+    cdef int i, j, num_kept = 0
+    for i in range(start, end):
+        if suppressed[i]:
+            continue
+        keep[num_kept] = idx[i]
+        keep_scores[num_kept] = s[i]
+        num_kept += 1
+        if num_kept == max_num:
+            break
+        for j in range(i + 1, end):
+            if not suppressed[j] and _overlap(b, areas, i, j) >= thresh:
+                suppressed[j] = 1
+    return num_kept
+
+cdef int _soft_group(np.float32_t *b, np.float32_t *areas, np.float32_t *s,
+                     np.int64_t *idx, int start, int end, double thresh,
+                     int method, double sigma, double min_score, int max_num,
+                     np.int64_t *keep, np.float32_t *keep_scores) nogil:
+    cdef int i, j, best, num_kept = 0
+    cdef np.float32_t ovr
+    cdef double weight
+    i = start
+    while i < end:
+        # pick the highest remaining score
+        best = i
+        for j in range(i + 1, end):
+            if s[j] > s[best]:
+                best = j
+        _swap(b, areas, s, idx, i, best)
+        keep[num_kept] = idx[i]
+        keep_scores[num_kept] = s[i]
+        num_kept += 1
+        if num_kept == max_num:
+            break
+        j = i + 1
+        while j < end:
+            ovr = _overlap(b, areas, i, j)
+            if method == LINEAR:
+                weight = 1 - ovr if ovr > thresh else 1
+            else:
+                weight = exp(-(ovr * ovr) / sigma)
+            s[j] = <np.float32_t>(s[j] * weight)
+            if s[j] < min_score:
+                # drop box j by moving the last remaining box into its place
+                end -= 1
+                _swap(b, areas, s, idx, j, end)
+            else:
+                j += 1
+        i += 1
+    return num_kept
+
+def cpu_group_nms(np.ndarray[np.float32_t, ndim=2] boxes,
+                  np.ndarray[np.float32_t, ndim=1] scores,
+                  np.ndarray[np.int64_t, ndim=1] groups, double thresh,
+                  int method=HARD, double sigma=0.5, double min_score=0.001,
+                  int max_num=0):
+    """Suppress boxes (N x 4: x1, y1, x2, y2) within each group.
+
+    Returns:
+        keep (ndarray): indices of the kept boxes, sorted by group and,
+            within a group, by decreasing (updated) score
+        keep_scores (ndarray): float32 scores of the kept boxes, decayed by
+            Soft-NMS (unchanged by hard NMS)
+
+    At most max_num boxes are kept per group (max_num <= 0: no limit).
+    """
+    cdef int ndets = boxes.shape[0]
+    cdef np.ndarray[np.int64_t, ndim=1] idx, bounds
+    idx, bounds = _group_order(scores, groups)
+    cdef np.ndarray[np.float32_t, ndim=2] b = np.ascontiguousarray(boxes[idx])
+    cdef np.ndarray[np.float32_t, ndim=1] s = np.ascontiguousarray(scores[idx])
+    cdef np.ndarray[np.float32_t, ndim=1] areas = \
+            (b[:, 2] - b[:, 0] + 1) * (b[:, 3] - b[:, 1] + 1)
+    cdef np.ndarray[np.uint8_t, ndim=1] suppressed = \
+            np.zeros((ndets), dtype=np.uint8)
+    cdef np.ndarray[np.int64_t, ndim=1] keep = \
+            np.zeros((ndets), dtype=np.int64)
+    cdef np.ndarray[np.float32_t, ndim=1] keep_scores = \
+            np.zeros((ndets), dtype=np.float32)
+    if ndets == 0:
+        return keep, keep_scores
+
+    cdef np.float32_t *pb = &b[0, 0]
+    cdef np.float32_t *pa = &areas[0]
+    cdef np.float32_t *ps = &s[0]
+    cdef np.int64_t *pi = &idx[0]
+    cdef int g, num_groups = bounds.shape[0] - 1, num_kept = 0
+    with nogil:
+        for g in range(num_groups):
+            if method == HARD:
+                num_kept += _hard_group(
+                    pb, pa, ps, pi, &suppressed[0], bounds[g], bounds[g + 1],
+                    thresh, max_num, &keep[num_kept], &keep_scores[num_kept])
+            else:
+                num_kept += _soft_group(
+                    pb, pa, ps, pi, bounds[g], bounds[g + 1], thresh, method,
+                    sigma, min_score, max_num, &keep[num_kept],
+                    &keep_scores[num_kept])
+    return keep[:num_kept], keep_scores[:num_kept]
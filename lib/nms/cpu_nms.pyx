@@ -14,7 +14,8 @@ cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
 cdef inline np.float32_t min(np.float32_t a, np.float32_t b):
     return a if a <= b else b
 
-def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
+def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh,
+            int max_num=0):
     cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
     cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
     cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
@@ -39,12 +40,17 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
     cdef np.float32_t w, h
     cdef np.float32_t inter, ovr
 
+    # stop once max_num boxes are kept (max_num <= 0: no limit)
+    cdef int num_kept = 0
     keep = []
     for _i in range(ndets):
         i = order[_i]
         if suppressed[i] == 1:
             continue
         keep.append(i)
+        num_kept += 1
+        if num_kept == max_num:
+            break
         ix1 = x1[i]
         iy1 = y1[i]
         ix2 = x2[i]
@@ -7,8 +7,9 @@
 
 import numpy as np
 
-def py_cpu_nms(dets, thresh):
-    """Pure Python NMS baseline."""
+def py_cpu_nms(dets, thresh, max_num=0):
+    """Pure Python NMS baseline; stops once max_num boxes are kept
+    (max_num <= 0: no limit)."""
     x1 = dets[:, 0]
     y1 = dets[:, 1]
     x2 = dets[:, 2]
@@ -22,6 +23,8 @@ def py_cpu_nms(dets, thresh):
     while order.size > 0:
         i = order[0]
         keep.append(i)
+        if len(keep) == max_num:
+            break
         xx1 = np.maximum(x1[i], x1[order[1:]])
         yy1 = np.maximum(y1[i], y1[order[1:]])
         xx2 = np.minimum(x2[i], x2[order[1:]])
@@ -0,0 +1,86 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Shared plumbing for the Caffe Python layers in roi_data_layer."""
+
+import caffe
+from utils.timer import Timer
+
+# Every layer instance, so that the solver can report where time goes
+_layers = []
+
+class BaseLayer(caffe.Layer):
+    """Base class for the roi_data_layer Python layers.
+
+    Subclasses call _declare_blobs() once in setup() and implement _forward()
+    and, if they propagate gradients, _backward(). Bottoms are read through
+    _bottom(), which returns a read-only view of the blob data (never a copy),
+    and tops are written through _top() / _set_top(), which reshape the blob
+    and expose its float32 buffer so each top is written at most once.
+    forward() and backward() are timed per layer.
+    """
+
+    def _declare_blobs(self, bottom_names, top_names):
+        """Build the name -> index maps for this layer's bottoms and tops."""
+        self._name_to_bottom_map = dict(
+            (name, i) for i, name in enumerate(bottom_names))
+        self._name_to_top_map = dict(
+            (name, i) for i, name in enumerate(top_names))
+        self._timers = {'forward': Timer(), 'backward': Timer()}
+        _layers.append(self)
+
+    def _bottom(self, bottom, name):
+        """Return a read-only view of the data of the named bottom blob."""
+        data = bottom[self._name_to_bottom_map[name]].data.view()
+        data.flags.writeable = False
+        return data
+
+    def _top(self, top, name, shape):
+        """Reshape the named top blob and return its data buffer.
+
+        The buffer is float32 and owned by Caffe; callers compute into it
+        in place.
+        """
+        blob = top[self._name_to_top_map[name]]
+        blob.reshape(*shape)
+        return blob.data
+
+    def _set_top(self, top, name, array):
+        """Reshape the named top blob and copy array into it."""
+        self._top(top, name, array.shape)[...] = array
+
+    def forward(self, bottom, top):
+        self._timers['forward'].tic()
+        self._forward(bottom, top)
+        self._timers['forward'].toc()
+
+    def backward(self, top, propagate_down, bottom):
+        self._timers['backward'].tic()
+        self._backward(top, propagate_down, bottom)
+        self._timers['backward'].toc()
+
+    def _forward(self, bottom, top):
+        raise NotImplementedError
+
+    def _backward(self, top, propagate_down, bottom):
+        """This layer does not propagate gradients."""
+        pass
+
+    def reshape(self, bottom, top):
+        """Reshaping happens during the call to forward."""
+        pass
+
+def layer_timings():
+    """Return (layer name, avg forward s, avg backward s) for every layer."""
+    return [(type(layer).__name__,
+             layer._timers['forward'].average_time,
+             layer._timers['backward'].average_time) for layer in _layers]
+
+def print_layer_timings():
+    """Print per-layer Python forward / backward time, slowest first."""
+    timings = sorted(layer_timings(), key=lambda t: -(t[1] + t[2]))
+    for name, fwd, bwd in timings:
+        print '{:>24s}: forward {:.4f}s  backward {:.4f}s'.format(
+            name, fwd, bwd)
@@ -9,19 +9,16 @@
 RoIDataLayer implements a Caffe Python layer.
 """
 
-import caffe
 from fast_rcnn.config import cfg
+from roi_data_layer.base_layer import BaseLayer
 from roi_data_layer.minibatch import get_minibatch, get_allrois_minibatch, get_ohem_minibatch, get_ohem_minibatch_ratio
+from utils.image_writer import AsyncImageWriter
 import numpy as np
 import yaml
-import os
-import os.path 
-
-import cv2
 
 from multiprocessing import Process, Queue
 
-class RoIDataLayer(caffe.Layer):
+class RoIDataLayer(BaseLayer):
     """Fast R-CNN data layer used for training."""
 
     def _shuffle_roidb_inds(self):
@@ -97,77 +94,52 @@ class RoIDataLayer(caffe.Layer):
 
         self._num_classes = int(layer_params['num_classes'])
 
-        self._name_to_top_map = {}
-
         # data blob: holds a batch of N images, each with 3 channels
-        idx = 0
-        top[idx].reshape(cfg.TRAIN.IMS_PER_BATCH, 3,
-            max(cfg.TRAIN.SCALES), cfg.TRAIN.MAX_SIZE)
-        self._name_to_top_map['data'] = idx
-        idx += 1
+        top_names = ['data']
+        top_shapes = [(cfg.TRAIN.IMS_PER_BATCH, 3,
+                       max(cfg.TRAIN.SCALES), cfg.TRAIN.MAX_SIZE)]
 
         if cfg.TRAIN.HAS_RPN:
-            top[idx].reshape(1, 3)
-            self._name_to_top_map['im_info'] = idx
-            idx += 1
-
-            top[idx].reshape(1, 4)
-            self._name_to_top_map['gt_boxes'] = idx
-            idx += 1
+            top_names += ['im_info', 'gt_boxes']
+            top_shapes += [(1, 3), (1, 4)]
         else: # not using RPN
             # rois blob: holds R regions of interest, each is a 5-tuple
             # (n, x1, y1, x2, y2) specifying an image batch index n and a
             # rectangle (x1, y1, x2, y2)
-            top[idx].reshape(1, 5)
-            self._name_to_top_map['rois'] = idx
-            idx += 1
-
             # labels blob: R categorical labels in [0, ..., K] for K foreground
             # classes plus background
-            top[idx].reshape(1)
-            self._name_to_top_map['labels'] = idx
-            idx += 1
-
-            if cfg.TRAIN.BBOX_REG:
+            top_names += ['rois', 'labels']
+            top_shapes += [(1, 5), (1,)]
+
+            if cfg.TRAIN.BBOX_REG and cfg.TRAIN.USE_OHEM:
+                # bbox_targets blob: R compact (cls, dx, dy, dw, dh) targets;
+                # OHEMDataLayer expands them for the hard RoIs only
+                top_names += ['bbox_targets']
+                top_shapes += [(1, 5)]
+            elif cfg.TRAIN.BBOX_REG:
                 # bbox_targets blob: R bounding-box regression targets with 4
                 # targets per class
-                top[idx].reshape(1, self._num_classes * 4)
-                self._name_to_top_map['bbox_targets'] = idx
-                idx += 1
-
                 # bbox_inside_weights blob: At most 4 targets per roi are active;
                 # thisbinary vector sepcifies the subset of active targets
-                top[idx].reshape(1, self._num_classes * 4)
-                self._name_to_top_map['bbox_inside_weights'] = idx
-                idx += 1
+                top_names += ['bbox_targets', 'bbox_inside_weights',
+                              'bbox_outside_weights']
+                top_shapes += [(1, self._num_classes * 4)] * 3
 
-                top[idx].reshape(1, self._num_classes * 4)
-                self._name_to_top_map['bbox_outside_weights'] = idx
-                idx += 1
+        self._declare_blobs([], top_names)
+        for name, shape in zip(top_names, top_shapes):
+            self._top(top, name, shape)
 
         print 'RoiDataLayer: name_to_top:', self._name_to_top_map
         assert len(top) == len(self._name_to_top_map)
 
-    def forward(self, bottom, top):
+    def _forward(self, bottom, top):
         """Get blobs and copy them into this layer's top blob vector."""
         blobs = self._get_next_minibatch()
 
         for blob_name, blob in blobs.iteritems():
-            top_ind = self._name_to_top_map[blob_name]
-            # Reshape net's input blobs
-            top[top_ind].reshape(*(blob.shape))
-            # Copy data into net's input blobs
-            top[top_ind].data[...] = blob.astype(np.float32, copy=False)
-
-    def backward(self, top, propagate_down, bottom):
-        """This layer does not propagate gradients."""
-        pass
-
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
+            self._set_top(top, blob_name, blob)
 
-class OHEMDataLayer(caffe.Layer):
+class OHEMDataLayer(BaseLayer):
     """Online Hard-example Mining Layer."""
     def setup(self, bottom, top):
         """Setup the OHEMDataLayer."""
@@ -180,138 +152,85 @@ class OHEMDataLayer(caffe.Layer):
         self._maintain_before = layer_params['maintain_before']
         self._count_iter = 0 
 
-        self._name_to_bottom_map = {
-            'cls_prob_readonly': 0,
-            'bbox_pred_readonly': 1,
-            'rois': 2,
-            'labels': 3}
-
-        if cfg.TRAIN.BBOX_REG:
-            self._name_to_bottom_map['bbox_targets'] = 4
-            self._name_to_bottom_map['bbox_loss_weights'] = 5
-
-        self._name_to_top_map = {}
-
-        assert cfg.TRAIN.HAS_RPN == False
-        # data blob: holds a batch of N images, each with 3 channels
-        idx = 0
+        bottom_names = ['cls_prob_readonly', 'bbox_pred_readonly', 'rois',
+                        'labels']
         # rois blob: holds R regions of interest, each is a 5-tuple
         # (n, x1, y1, x2, y2) specifying an image batch index n and a
         # rectangle (x1, y1, x2, y2)
-        top[idx].reshape(1, 5)
-        self._name_to_top_map['rois_hard'] = idx
-        idx += 1
-
         # labels blob: R categorical labels in [0, ..., K] for K foreground
         # classes plus background
-        top[idx].reshape(1)
-        self._name_to_top_map['labels_hard'] = idx
-        idx += 1
+        top_names = ['rois_hard', 'labels_hard']
+        top_shapes = [(1, 5), (1,)]
 
         if cfg.TRAIN.BBOX_REG:
+            # compact (cls, dx, dy, dw, dh) targets from RoIDataLayer
+            bottom_names += ['bbox_targets']
             # bbox_targets blob: R bounding-box regression targets with 4
             # targets per class
-            top[idx].reshape(1, self._num_classes * 4)
-            self._name_to_top_map['bbox_targets_hard'] = idx
-            idx += 1
-
             # bbox_inside_weights blob: At most 4 targets per roi are active;
             # thisbinary vector sepcifies the subset of active targets
-            top[idx].reshape(1, self._num_classes * 4)
-            self._name_to_top_map['bbox_inside_weights_hard'] = idx
-            idx += 1
-
-            top[idx].reshape(1, self._num_classes * 4)
-            self._name_to_top_map['bbox_outside_weights_hard'] = idx
-            idx += 1
+            top_names += ['bbox_targets_hard', 'bbox_inside_weights_hard',
+                          'bbox_outside_weights_hard']
+            top_shapes += [(1, self._num_classes * 4)] * 3
 
         # used for ASDN
-        if cfg.TRAIN.USE_ASDN: 
-            top[idx].reshape(*(bottom[0].data.shape))
-            self._name_to_top_map['prop_before'] = idx
-            idx += 1
+        if cfg.TRAIN.USE_ASDN:
+            top_names += ['prop_before']
+            top_shapes += [bottom[0].data.shape]
+
+        assert cfg.TRAIN.HAS_RPN == False
+        self._declare_blobs(bottom_names, top_names)
+        for name, shape in zip(top_names, top_shapes):
+            self._top(top, name, shape)
 
 
         print 'OHEMDataLayer: name_to_top:', self._name_to_top_map
         assert len(top) == len(self._name_to_top_map)
 
-    def forward(self, bottom, top):
+    def _forward(self, bottom, top):
         """Compute loss, select RoIs using OHEM. Use RoIs to get blobs and copy them into this layer's top blob vector."""
 
-        cls_prob = bottom[0].data
-        bbox_pred = bottom[1].data
-        rois = bottom[2].data
-        labels = bottom[3].data
+        cls_prob = self._bottom(bottom, 'cls_prob_readonly')
+        bbox_pred = self._bottom(bottom, 'bbox_pred_readonly')
+        rois = self._bottom(bottom, 'rois')
+        labels = self._bottom(bottom, 'labels')
 
         self._count_iter = (self._count_iter + 1) % self._iter_size
 
         if cfg.TRAIN.BBOX_REG:
-            bbox_target = bottom[4].data
-            bbox_inside_weights = bottom[5].data
-            bbox_outside_weights = bottom[6].data
+            bbox_target = self._bottom(bottom, 'bbox_targets')
         else:
             bbox_target = None
-            bbox_inside_weights = None
-            bbox_outside_weights = None
 
-        flt_min = np.finfo(float).eps
         # classification loss
-        loss = [ -1 * np.log(max(x, flt_min)) \
-            for x in [cls_prob[i,label] for i, label in enumerate(labels)]]
+        flt_min = np.finfo(float).eps
+        prob = cls_prob[np.arange(labels.shape[0]), labels.astype(np.int64)]
+        loss = -np.log(np.maximum(prob, flt_min))
 
         if cfg.TRAIN.BBOX_REG:
             # bounding-box regression loss
-            # d := w * (b0 - b1)
-            # smoothL1(x) = 0.5 * x^2    if |x| < 1
-            #               |x| - 0.5    otherwise
-            def smoothL1(x):
-                if abs(x) < 1:
-                    return 0.5 * x * x
-                else:
-                    return abs(x) - 0.5
-
-            bbox_loss = np.zeros(labels.shape[0])
-            for i in np.where(labels > 0 )[0]:
-                indices = np.where(bbox_inside_weights[i,:] != 0)[0]
-                bbox_loss[i] = sum(bbox_outside_weights[i,indices] * [smoothL1(x) \
-                    for x in bbox_inside_weights[i,indices] * (bbox_pred[i,indices] - bbox_target[i,indices])])
-            loss += bbox_loss
-
-        blobs = []
-        hard_inds = []
-
+            loss += _bbox_loss(bbox_pred, bbox_target)
 
         if self._count_iter < self._maintain_before  or cfg.TRAIN.OHEM_RATIO < 0.1: 
-            blobs, hard_inds = get_ohem_minibatch(loss, rois, labels, bbox_target, bbox_inside_weights, bbox_outside_weights)
+            blobs, hard_inds = get_ohem_minibatch(loss, rois, labels, bbox_target,
+                                                  num_classes=self._num_classes)
         else:
-            blobs, hard_inds = get_ohem_minibatch_ratio(loss, rois, labels, bbox_target, bbox_inside_weights, bbox_outside_weights, ratio=cfg.TRAIN.OHEM_RATIO, hard_negative=cfg.TRAIN.OHEM_HARD_NEG)
+            blobs, hard_inds = get_ohem_minibatch_ratio(loss, rois, labels, bbox_target,
+                                                        num_classes=self._num_classes,
+                                                        ratio=cfg.TRAIN.OHEM_RATIO,
+                                                        hard_negative=cfg.TRAIN.OHEM_HARD_NEG)
         
         for blob_name, blob in blobs.iteritems():
-            top_ind = self._name_to_top_map[blob_name]
-            # Reshape net's input blobs
-            top[top_ind].reshape(*(blob.shape))
-            # Copy data into net's input blobs
-            top[top_ind].data[...] = blob.astype(np.float32, copy=False)
+            self._set_top(top, blob_name, blob)
 
         # used for ASDN
         if cfg.TRAIN.USE_ASDN:
-            prop_before = cls_prob[hard_inds]
-            top_ind = self._name_to_top_map['prop_before']
-            top[top_ind].reshape(*(prop_before.shape))
-            top[top_ind].data[...] = prop_before.astype(np.float32, copy=False)
+            prop_before = self._top(top, 'prop_before',
+                                    (len(hard_inds),) + cls_prob.shape[1:])
+            np.take(cls_prob, hard_inds, axis=0, out=prop_before)
 
 
-
-    def backward(self, top, propagate_down, bottom):
-        """This layer does not propagate gradients."""
-        pass
-
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
-
-
-class ASDNPretrainLossLayer(caffe.Layer):
+class ASDNPretrainLossLayer(BaseLayer):
     def setup(self, bottom, top):
         """Setup the ASDNPretrainLossLayer."""
 
@@ -319,6 +238,8 @@ class ASDNPretrainLossLayer(caffe.Layer):
         layer_params = yaml.load(self.param_str_)
         self._num_classes = layer_params['num_classes']
         self._drop_neg = layer_params['drop_neg']
+        self._debug_writer = _debug_writer_from_params(
+            layer_params, '/scratch/xiaolonw/frcnn_debug_drop/')
 
         self.ignore_label = None
 
@@ -326,34 +247,26 @@ class ASDNPretrainLossLayer(caffe.Layer):
 
         self._count = 0 
 
-        self._name_to_bottom_map = {
-            'mask_pred': 0,
-            'conv_feat_mask': 1,
-            'prop': 2,
-            'labels_pos': 3, 
-            'rois_pos': 4, 
-            'data': 5}
-
         # (n, x1, y1, x2, y2) specifying an image batch index n and a
         # rectangle (x1, y1, x2, y2)
 
         # mask_thres 0 means block, 1 means maintain 
 
-        self._name_to_top_map = {
-            'loss': 0}
+        self._declare_blobs(['mask_pred', 'conv_feat_mask', 'prop',
+                             'labels_pos', 'rois_pos', 'data'], ['loss'])
 
         top[0].reshape(1)
 
         print 'ASDNPretrainLossLayer: name_to_top:', self._name_to_top_map
         assert len(top) == len(self._name_to_top_map)
 
-    def forward(self, bottom, top):
-        mask_pred = bottom[0].data
-        conv_feat_mask = bottom[1].data
-        prop =  bottom[2].data
-        labels_pos = bottom[3].data
-        rois_pos = bottom[4].data
-        data = bottom[5].data 
+    def _forward(self, bottom, top):
+        mask_pred = self._bottom(bottom, 'mask_pred')
+        conv_feat_mask = self._bottom(bottom, 'conv_feat_mask')
+        prop = self._bottom(bottom, 'prop')
+        labels_pos = self._bottom(bottom, 'labels_pos')
+        rois_pos = self._bottom(bottom, 'rois_pos')
+        data = self._bottom(bottom, 'data')
 
         N = bottom[0].shape[0]      # 1 * num_pos
         N2 = bottom[1].shape[0]     # 16 * num_pos
@@ -386,7 +299,7 @@ class ASDNPretrainLossLayer(caffe.Layer):
             mask_label[i, :, :, :] = conv_feat_mask[min_id]
 
         # copy from: https://github.com/philkr/voc-classification/blob/master/src/python_layers.py#L52
-        f, df, t = bottom[0].data, bottom[0].diff, mask_label
+        f, df, t = mask_pred, bottom[0].diff, mask_label
         mask = (self.ignore_label is None or t != self.ignore_label)
         lZ  = np.log(1+np.exp(-np.abs(f))) * mask
         dlZ = np.exp(np.minimum(f,0))/(np.exp(np.minimum(f,0))+np.exp(-np.maximum(f,0))) * mask
@@ -410,87 +323,39 @@ class ASDNPretrainLossLayer(caffe.Layer):
 
 
 
-        ###### debug 
-        debug_sign = True
-        debug_folder = '/scratch/xiaolonw/frcnn_debug_drop/'
-
-
-        if debug_sign and os.path.exists(debug_folder):
-            print_num = 10 
-            print_rp = np.random.permutation(np.arange(N))
-
+        ###### debug
+        writer = self._debug_writer
+        if writer.sample():
             self._count = self._count + 1
-
-            if print_num > N: 
-                print_num = N 
+            print_num = min(10, N)
+            print_rp = np.random.permutation(np.arange(N))
 
             for i in range(print_num):
                 print_id = print_rp[i]
-                print_label = mask_label[print_id]
-                print_pred  = mask_pred[print_id]
-                print_bp    = bp_mask[print_id]
-
-                print_pred  = 1 / (1 + np.exp(- print_pred))
-
-                print_label = print_label * 255
-                print_label = print_label.astype(np.uint8)
-                filename = debug_folder + str(self._count) + '_' + str(i) + '_gt.jpg'
-                print_label = np.reshape(print_label, (7,7,1))
-                print_label = 255 - print_label
-                cv2.imwrite(filename, print_label)
-
-                print_pred = print_pred * 255
-                print_pred = print_pred.astype(np.uint8)
-                filename = debug_folder + str(self._count) + '_' + str(i) + '_pred.jpg' 
-                print_pred = np.reshape(print_pred, (7,7,1))
-                print_pred = 255 - print_pred
-                cv2.imwrite(filename, print_pred)
-
-                print_bp = print_bp * 255
-                print_bp = print_bp.astype(np.uint8)
-                filename = debug_folder + str(self._count) + '_' + str(i) + '_bpmask.jpg' 
-                print_bp = np.reshape(print_bp, (7,7,1))
-                cv2.imwrite(filename, print_bp)
+                prefix = str(self._count) + '_' + str(i)
+                print_label = np.reshape(mask_label[print_id], (pool_len, pool_len, 1))
+                print_pred  = 1 / (1 + np.exp(- mask_pred[print_id]))
+                print_pred  = np.reshape(print_pred, (pool_len, pool_len, 1))
+                print_bp    = np.reshape(bp_mask[print_id], (pool_len, pool_len, 1))
 
+                writer.put(prefix + '_gt.jpg', 255 - print_label * 255)
+                writer.put(prefix + '_pred.jpg', 255 - print_pred * 255)
+                writer.put(prefix + '_bpmask.jpg', print_bp * 255)
+                writer.put(prefix + '_rgb.jpg', _debug_roi_crop(data, rois_pos[print_id]),
+                           size=(100, 100))
 
-                # rgb 
 
-                roi = rois_pos[print_id]
-                imid = roi[0]
-                x1 = roi[1]
-                y1 = roi[2]
-                x2 = roi[3]
-                y2 = roi[4]
 
-                im = data[imid]
-                im = im[:, y1:y2, x1:x2]
-                im = im.transpose((1, 2, 0)).copy()
-                im += cfg.PIXEL_MEANS
-                # im = im[:, :, (2, 1, 0)]
 
-                im = cv2.resize(im, (100,100))
 
-                im = im.astype(np.uint8)
-                filename = debug_folder + str(self._count) + '_' + str(i) + '_rgb.jpg' 
-                cv2.imwrite(filename, im)
-
-
-
-
-
-    def backward(self, top, propagate_down, bottom):
+    def _backward(self, top, propagate_down, bottom):
         bottom[0].diff[...] *= top[0].diff
 
 
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
-
-
 
 
 
-class ASDNPretrainLabelLayer(caffe.Layer):
+class ASDNPretrainLabelLayer(BaseLayer):
     def setup(self, bottom, top):
         """Setup the ASDNDataLayer."""
 
@@ -499,17 +364,10 @@ class ASDNPretrainLabelLayer(caffe.Layer):
 
         # mask_pred 1 means block, 0 means maintain 
 
-        self._name_to_bottom_map = {
-            'conv_feat': 0,
-            'labels': 1,
-            'rois': 2}
-
         # mask_thres 0 means block, 1 means maintain 
 
-        self._name_to_top_map = {
-            'conv_feat_pos': 0,
-            'labels_pos': 1,
-            'rois_pos': 2}
+        self._declare_blobs(['conv_feat', 'labels', 'rois'],
+                            ['conv_feat_pos', 'labels_pos', 'rois_pos'])
 
         top[0].reshape(*(bottom[0].data.shape))
         top[1].reshape(1)
@@ -520,62 +378,32 @@ class ASDNPretrainLabelLayer(caffe.Layer):
         assert len(top) == len(self._name_to_top_map)
 
 
-    def forward(self, bottom, top):
-
+    def _forward(self, bottom, top):
 
-        conv_feat = np.copy(bottom[0].data)
-        labels = np.copy(bottom[1].data)
-        rois = np.copy(bottom[2].data)
-
-        sample_num = conv_feat.shape[0]
-        channels   = conv_feat.shape[1]
-        pool_len   = conv_feat.shape[2]
 
-        labels = np.reshape(labels, sample_num)
+        conv_feat = self._bottom(bottom, 'conv_feat')
+        labels = self._bottom(bottom, 'labels')
+        rois = self._bottom(bottom, 'rois')
 
-        count_pos = 0
+        labels = np.reshape(labels, conv_feat.shape[0])
 
-        for i in range(sample_num):
-            if labels[i] > 0: 
-                count_pos = count_pos + 1
+        # compact the positive RoIs straight into the top blobs
+        pos = labels > 0
+        count_pos = np.count_nonzero(pos)
 
-        conv_feat_pos = np.zeros((count_pos, channels, pool_len, pool_len))
-        labels_pos    = np.zeros(count_pos)
-        rois_pos = np.zeros((count_pos, rois.shape[1]))
+        conv_feat_pos = self._top(top, 'conv_feat_pos',
+                                  (count_pos,) + conv_feat.shape[1:])
+        labels_pos = self._top(top, 'labels_pos', (count_pos,))
+        rois_pos = self._top(top, 'rois_pos', (count_pos, rois.shape[1]))
 
-        cnt = 0
+        np.compress(pos, conv_feat, axis=0, out=conv_feat_pos)
+        np.compress(pos, labels, axis=0, out=labels_pos)
+        np.compress(pos, rois, axis=0, out=rois_pos)
 
-        for i in range(sample_num):
-            if labels[i] > 0:
-                labels_pos[cnt] = labels[i]
-                conv_feat_pos[cnt] = np.copy(conv_feat[i])
-                rois_pos[cnt, :] = np.copy(rois[i, :])
-                cnt = cnt + 1
-
-        top[0].reshape(*(conv_feat_pos.shape))
-        top[0].data[...] = conv_feat_pos.astype(np.float32, copy=False)
-
-        top[1].reshape(*(labels_pos.shape))
-        top[1].data[...] = labels_pos.astype(np.float32, copy=False)
-
-        top[2].reshape(*(rois_pos.shape))
-        top[2].data[...] = rois_pos.astype(np.float32, copy=False)
-
-
-        
 
-    def backward(self, top, propagate_down, bottom):
-        """This layer does not propagate gradients."""
-        pass
 
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
 
-
-
-
-class ASDNPretrainDataLayer(caffe.Layer):
+class ASDNPretrainDataLayer(BaseLayer):
     def setup(self, bottom, top):
         """Setup the ASDNDataLayer."""
 
@@ -588,14 +416,9 @@ class ASDNPretrainDataLayer(caffe.Layer):
 
         # mask_pred 1 means block, 0 means maintain 
 
-        self._name_to_bottom_map = {
-            'conv_feat': 0}
-
         # mask_thres 0 means block, 1 means maintain 
 
-        self._name_to_top_map = {
-            'conv_feat_rep': 0,
-            'conv_feat_mask': 1}
+        self._declare_blobs(['conv_feat'], ['conv_feat_rep', 'conv_feat_mask'])
 
         top[0].reshape(*(bottom[0].data.shape))
         top[1].reshape(*(bottom[0].data.shape))
@@ -604,28 +427,25 @@ class ASDNPretrainDataLayer(caffe.Layer):
         assert len(top) == len(self._name_to_top_map)
 
 
-    def generate_feature(self, conv_feat):
+    def generate_feature(self, conv_feat, conv_feat_rep, conv_feat_mask):
+        """Fill conv_feat_rep / conv_feat_mask (one block of sample_num rows
+        per dropped window) in place."""
 
         sample_num = conv_feat.shape[0]
-        channels   = conv_feat.shape[1]
         pool_len   = conv_feat.shape[2]
 
         drop_size  = self._drop_size
         drop_stride = self._drop_stride
 
         rep_num = int(np.ceil(float(pool_len) / float(drop_stride)))
-        rep_num_area = rep_num * rep_num
 
-        conv_feat_rep = np.zeros((sample_num * rep_num_area, channels, pool_len, pool_len))
-        conv_feat_mask = np.zeros((sample_num * rep_num_area, 1, pool_len, pool_len))
+        conv_feat_mask[...] = 0
 
         cnt = 0 
 
         for i in range(rep_num):
             for j in range(rep_num):
 
-                now_feat = np.copy(conv_feat)
-
                 startx = i * drop_stride
                 starty = j * drop_stride
 
@@ -637,44 +457,36 @@ class ASDNPretrainDataLayer(caffe.Layer):
                 endx   = np.min( (startx + drop_size, pool_len) )
                 endy   = np.min( (starty + drop_size, pool_len) )
 
-                now_feat[:,:, startx : endx, starty : endy ] = now_feat[:,:, startx : endx, starty : endy ] * 0.0
-                conv_feat_rep[ cnt * sample_num : cnt * sample_num + sample_num, :, :, : ] = np.copy(now_feat)
+                rows = slice(cnt * sample_num, cnt * sample_num + sample_num)
+                conv_feat_rep[rows] = conv_feat
+                conv_feat_rep[rows, :, startx : endx, starty : endy] = 0
 
-                conv_feat_mask[ cnt * sample_num : cnt * sample_num + sample_num, :, startx : endx, starty : endy] = 1
+                conv_feat_mask[rows, :, startx : endx, starty : endy] = 1
 
                 cnt = cnt + 1
 
-        return conv_feat_rep, conv_feat_mask
-
-
-    def forward(self, bottom, top):
 
+    def _forward(self, bottom, top):
 
-        conv_feat = np.copy(bottom[0].data)
 
-        conv_feat_rep, conv_feat_mask = self.generate_feature(conv_feat)
+        conv_feat = self._bottom(bottom, 'conv_feat')
 
-	print 'top[0].data.shape', top[0].data.shape
-        top[0].reshape(*(conv_feat_rep.shape))
-	print 'top[0].data.shape', top[0].data.shape
-        top[0].data[...] = conv_feat_rep.astype(np.float32, copy=False)
-
-        top[1].reshape(*(conv_feat_mask.shape))
-        top[1].data[...] = conv_feat_mask.astype(np.float32, copy=False)
-        
+        sample_num = conv_feat.shape[0]
+        pool_len   = conv_feat.shape[2]
+        rep_num = int(np.ceil(float(pool_len) / float(self._drop_stride)))
+        rep_num_area = rep_num * rep_num
 
-    def backward(self, top, propagate_down, bottom):
-        """This layer does not propagate gradients."""
-        pass
+        conv_feat_rep = self._top(top, 'conv_feat_rep',
+                                  (sample_num * rep_num_area,) + conv_feat.shape[1:])
+        conv_feat_mask = self._top(top, 'conv_feat_mask',
+                                   (sample_num * rep_num_area, 1, pool_len, pool_len))
 
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
+        self.generate_feature(conv_feat, conv_feat_rep, conv_feat_mask)
 
 
 
 
-class ASDNLossLayer(caffe.Layer):
+class ASDNLossLayer(BaseLayer):
     def setup(self, bottom, top):
         """Setup the ASDNLossLayer."""
 
@@ -687,6 +499,8 @@ class ASDNLossLayer(caffe.Layer):
         self._iter_size = layer_params['iter_size']
         self._maintain_before = layer_params['maintain_before'] # maintain the first image unchanged 
         self._count_iter = 0 
+        self._debug_writer = _debug_writer_from_params(
+            layer_params, '/scratch/xiaolonw/frcnn_debug_ft/')
 
 
         self.ignore_label = None
@@ -695,26 +509,17 @@ class ASDNLossLayer(caffe.Layer):
 
         # mask_pred 1 means block, 0 means maintain 
 
-        self._name_to_bottom_map = {
-            'mask_pred': 0,
-            'mask_thres': 1,
-            'prop_before': 2,
-            'prop_after': 3, 
-            'labels': 4, 
-            'rois': 5,
-            'data': 6}
-
         # mask_thres 0 means block, 1 means maintain 
 
-        self._name_to_top_map = {
-            'loss': 0}
+        self._declare_blobs(['mask_pred', 'mask_thres', 'prop_before',
+                             'prop_after', 'labels', 'rois', 'data'], ['loss'])
 
         top[0].reshape(1)
 
         print 'ASDNLossLayer: name_to_top:', self._name_to_top_map
         assert len(top) == len(self._name_to_top_map)
 
-    def forward(self, bottom, top):
+    def _forward(self, bottom, top):
         
         N = bottom[0].shape[0]
 
@@ -722,8 +527,7 @@ class ASDNLossLayer(caffe.Layer):
 
         if self._count_iter < self._maintain_before:
             # top[0].data[0] = 0.0
-            f, df, t = bottom[0].data, bottom[0].diff, bottom[1].data
-            df[...] = np.zeros(f.shape)
+            bottom[0].diff[...] = 0
             return 
 
 
@@ -731,14 +535,14 @@ class ASDNLossLayer(caffe.Layer):
         for i in range(len(bottom[0].shape)):
             count_bit = count_bit * bottom[0].shape[i]
 
-        mask_pred  = bottom[0].data
-        mask_label = bottom[1].data
+        mask_pred  = self._bottom(bottom, 'mask_pred')
+        mask_label = self._bottom(bottom, 'mask_thres')
 
-        prop_before = bottom[2].data
-        prop_after  = bottom[3].data
-        labels      = bottom[4].data
-        rois = bottom[5].data
-        data = bottom[6].data 
+        prop_before = self._bottom(bottom, 'prop_before')
+        prop_after  = self._bottom(bottom, 'prop_after')
+        labels      = self._bottom(bottom, 'labels')
+        rois = self._bottom(bottom, 'rois')
+        data = self._bottom(bottom, 'data')
 
         prop_before = np.reshape(prop_before, (N, self._num_classes))
         prop_after = np.reshape(prop_after, (N, self._num_classes))
@@ -746,7 +550,7 @@ class ASDNLossLayer(caffe.Layer):
 
 
         # copy from: https://github.com/philkr/voc-classification/blob/master/src/python_layers.py#L52
-        f, df, t = bottom[0].data, bottom[0].diff, bottom[1].data
+        f, df, t = mask_pred, bottom[0].diff, mask_label
         mask = (self.ignore_label is None or t != self.ignore_label)
         lZ  = np.log(1+np.exp(-np.abs(f))) * mask
         dlZ = np.exp(np.minimum(f,0))/(np.exp(np.minimum(f,0))+np.exp(-np.maximum(f,0))) * mask
@@ -773,18 +577,15 @@ class ASDNLossLayer(caffe.Layer):
 
 
 
-        ###### debug 
-        debug_sign = True
-        debug_folder = '/scratch/xiaolonw/frcnn_debug_ft/'
-
-
-        if debug_sign and os.path.exists(debug_folder):
-
+        ###### debug
+        writer = self._debug_writer
+        if writer.sample():
             self._count = self._count + 1
-            cnt = 0 
+            pool_len = mask_pred.shape[2]
+            cnt = 0
             for i in range(N):
                 print_id = i
-                lbl = labels[i]
+                lbl = int(labels[i])
                 prop_before_select = prop_before[i][lbl]
                 prop_after_select = prop_after[i][lbl]
 
@@ -795,65 +596,30 @@ class ASDNLossLayer(caffe.Layer):
                 if cnt > 10:
                     break
 
-                print_label = mask_label[print_id]
-                print_pred  = mask_pred[print_id]
-
-                print_pred  = 1 / (1 + np.exp(- print_pred))
-
-                print_label = print_label * 255
-                print_label = print_label.astype(np.uint8)
-                filename = debug_folder + str(self._count) + '_' + str(cnt) + '_gt.jpg'
-                print_label = np.reshape(print_label, (7,7,1))
-                print_label = 255 - print_label
-                cv2.imwrite(filename, print_label)
-
-                print_pred = print_pred * 255
-                print_pred = print_pred.astype(np.uint8)
-                filename = debug_folder + str(self._count) + '_' + str(cnt) + '_pred.jpg' 
-                print_pred = np.reshape(print_pred, (7,7,1))
-                print_pred = 255 - print_pred
-                cv2.imwrite(filename, print_pred)
-
-                # rgb 
-
-                roi = rois[print_id]
-                imid = roi[0]
-                x1 = roi[1]
-                y1 = roi[2]
-                x2 = roi[3]
-                y2 = roi[4]
-
-                im = data[imid]
-                im = im[:, y1:y2, x1:x2]
-                im = im.transpose((1, 2, 0)).copy()
-                im += cfg.PIXEL_MEANS
-                # im = im[:, :, (2, 1, 0)]
+                prefix = str(self._count) + '_' + str(cnt)
+                print_label = np.reshape(mask_label[print_id], (pool_len, pool_len, 1))
+                print_pred  = 1 / (1 + np.exp(- mask_pred[print_id]))
+                print_pred  = np.reshape(print_pred, (pool_len, pool_len, 1))
 
-                im = cv2.resize(im, (100,100))
-
-                im = im.astype(np.uint8)
-                filename = debug_folder + str(self._count) + '_' + str(cnt) + '_rgb.jpg' 
-                cv2.imwrite(filename, im)
+                writer.put(prefix + '_gt.jpg', 255 - print_label * 255)
+                writer.put(prefix + '_pred.jpg', 255 - print_pred * 255)
+                writer.put(prefix + '_rgb.jpg', _debug_roi_crop(data, rois[print_id]),
+                           size=(100, 100))
 
 
 
 
     
-    def backward(self, top, prop, bottom):
+    def _backward(self, top, propagate_down, bottom):
         bottom[0].diff[...] *= top[0].diff
 
 
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
-
 
 
 
 
 
-
-class ASDNDataLayer(caffe.Layer):
+class ASDNDataLayer(BaseLayer):
     def setup(self, bottom, top):
         """Setup the ASDNDataLayer."""
 
@@ -873,15 +639,10 @@ class ASDNDataLayer(caffe.Layer):
 
         # mask_pred 1 means block, 0 means maintain 
 
-        self._name_to_bottom_map = {
-            'mask_pred': 0,
-            'labels': 1}
-
         # mask_thres 0 means block, 1 means maintain 
 
-        self._name_to_top_map = {
-            'mask_thres': 0,
-            'mask_thres_block': 1}
+        self._declare_blobs(['mask_pred', 'labels'],
+                            ['mask_thres', 'mask_thres_block'])
 
 
         top[0].reshape(*(bottom[0].data.shape))
@@ -965,11 +726,11 @@ class ASDNDataLayer(caffe.Layer):
 
 
 
-    def forward(self, bottom, top):
+    def _forward(self, bottom, top):
 
 
-        mask_pred = np.copy(bottom[0].data)
-        labels = np.copy(bottom[1].data)
+        mask_pred = self._bottom(bottom, 'mask_pred')
+        labels = self._bottom(bottom, 'labels')
 
 
         self._count_iter = (self._count_iter + 1) % self._iter_size
@@ -978,28 +739,19 @@ class ASDNDataLayer(caffe.Layer):
 
         if self._count_iter >= self._maintain_before:
             mask_thres = self.thres_mask_rand(mask_pred, labels)
-        
-        mask_thres_block = np.tile(mask_thres, [1, self._channels, 1, 1])
-
-        mask_thres = 1 - mask_thres # for mask labels 
 
+        # the block mask is the keep mask broadcast over channels
+        sample_num, _, height, width = mask_thres.shape
+        mask_thres_block = self._top(top, 'mask_thres_block',
+                                     (sample_num, self._channels, height, width))
+        mask_thres_block[...] = mask_thres
 
-        top_ind = self._name_to_top_map['mask_thres']
-        top[top_ind].reshape(*(mask_thres.shape))
-        top[top_ind].data[...] = mask_thres.astype(np.float32, copy=False)
+        # for mask labels 
+        np.subtract(1, mask_thres,
+                    out=self._top(top, 'mask_thres', mask_thres.shape))
 
-        top_ind = self._name_to_top_map['mask_thres_block']
-        top[top_ind].reshape(*(mask_thres_block.shape))
-        top[top_ind].data[...] = mask_thres_block.astype(np.float32, copy=False)
 
-        
-
-    def backward(self, top, propagate_down, bottom):
-        """This layer does not propagate gradients."""
-        pass
-
-
-class ASTNDataLayer(caffe.Layer):
+class ASTNDataLayer(BaseLayer):
     def setup(self, bottom, top):
         """Setup the ASTNDataLayer"""
 
@@ -1007,14 +759,7 @@ class ASTNDataLayer(caffe.Layer):
         layer_params = yaml.load(self.param_str_)
 
         self._block_num = layer_params['block_num']
-        self._name_to_bottom_map = {
-            'trans_param': 0,
-            'pool5': 1
-        }
-
-        self._name_to_top_map = {
-            'trans_feat': 0
-        }
+        self._declare_blobs(['trans_param', 'pool5'], ['trans_feat'])
 
         top[0].reshape(*(bottom[1].data.shape))
 	# print "top[0].shape: ", top[0].data.shape
@@ -1173,9 +918,9 @@ class ASTNDataLayer(caffe.Layer):
         return dx, dy
 
 
-    def forward(self, bottom, top):
-        trans_param = np.copy(bottom[0].data)
-        rois_feat = np.copy(bottom[1].data)
+    def _forward(self, bottom, top):
+        trans_param = self._bottom(bottom, 'trans_param')
+        rois_feat = self._bottom(bottom, 'pool5')
         # print 'trans_param shape', trans_param.shape
         # print 'rois_feat shape', rois_feat.shape
 
@@ -1196,10 +941,8 @@ class ASTNDataLayer(caffe.Layer):
             for i in range(self._block_num):
 		trans_grid[b, channels[i], :, :] = self.generate_grid(bottom[1], len(channels[i]), trans_param[b, i])
 
-        top_ind = self._name_to_top_map['trans_feat']
-	# print top[top_ind].data.shape
-        top[top_ind].reshape(*(rois_feat.shape))
-        self.bilinear_sample(rois_feat, top[top_ind].data, trans_grid)
+        trans_feat = self._top(top, 'trans_feat', rois_feat.shape)
+        self.bilinear_sample(rois_feat, trans_feat, trans_grid)
 
         # calculate the diff
         ones = np.ones(rois_feat.shape)
@@ -1241,30 +984,19 @@ class ASTNDataLayer(caffe.Layer):
         bottom[bottom_inx].diff[...] = dtheta_mean
 
 
-    def backward(self, top, propagate_down, bottom):
-	# print 'bottom', bottom[0].data.shape
-	# print 'top', top[0].data.shape
-	batch_size = top[0].data.shape[0]
-	channels = top[0].data.shape[1]
-
-	bottom_inx = self._name_to_bottom_map['pool5']
-	bottom[bottom_inx].diff[...] *= top[0].diff
-
-	bottom_inx = self._name_to_bottom_map['trans_param']
-    	diff = np.copy(top[0].diff)
-	diff = diff.reshape([batch_size, self._block_num, -1])
-	# print 'diff.shape', diff.shape
-	dtheta = np.mean(diff, axis=2)
-	# print 'dtheta.shape', dtheta.shape
-	bottom[bottom_inx].diff[...] *= dtheta
+    def _backward(self, top, propagate_down, bottom):
+        batch_size = top[0].data.shape[0]
 
+        bottom_inx = self._name_to_bottom_map['pool5']
+        bottom[bottom_inx].diff[...] *= top[0].diff
 
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
+        bottom_inx = self._name_to_bottom_map['trans_param']
+        diff = top[0].diff.reshape([batch_size, self._block_num, -1])
+        dtheta = np.mean(diff, axis=2)
+        bottom[bottom_inx].diff[...] *= dtheta
 
 
-class ASTNLossLayer(caffe.Layer):
+class ASTNLossLayer(BaseLayer):
     """optimize the detector to classify foreground objects as the background class"""
 
     def setup(self, bottom, top):
@@ -1275,44 +1007,98 @@ class ASTNLossLayer(caffe.Layer):
 
         self._num_classes = layer_params['num_classes']
 
-        self._name_to_bottom_map = {
-            'cls_prob': 0,
-            'labels': 1
-        }
-
-        self._name_to_top_map = {
-            'labels': 0
-        }
+        self._declare_blobs(['cls_prob', 'labels'], ['loss'])
 
         top[0].reshape(1)
 
 
-    def forward(self, bottom, top):
-        prob_pre = bottom[0].data
-        labels = bottom[1].data
-	# print 'prob_pre.shape', prob_pre.shape
-	# print 'labels.shape', labels.shape
-
+    def _forward(self, bottom, top):
+        prob_pre = self._bottom(bottom, 'cls_prob')
         batch_size = prob_pre.shape[0]
-	labels = labels.reshape(batch_size).astype(np.int32)
-        loss = -np.log(1 - prob_pre[range(batch_size), labels])
-        dloss = 1 / (1 - prob_pre[:, labels])
-        for i in range(batch_size):
-            if labels[i] == 0:
-                loss[i] = 0.0
-                dloss[i] = 0.0
+        prob_pre = prob_pre.reshape(batch_size, -1)
+        labels = self._bottom(bottom, 'labels').reshape(batch_size).astype(np.int32)
+
+        loss, dloss = _astn_loss(prob_pre, labels)
 
-        top[0].data[...] = np.sum(loss) / batch_size
-        bottom[0].diff[...] = np.sum(dloss) / batch_size
+        top[0].data[...] = loss
+        bottom[0].diff[...] = dloss.reshape(bottom[0].diff.shape)
 
 
-    def backward(self, top, propagate_down, bottom):
+    def _backward(self, top, propagate_down, bottom):
         bottom[0].diff[...] *= top[0].diff
 
 
-    def reshape(self, bottom, top):
-        """Reshaping happens during the call to forward."""
-        pass
+def _bbox_loss(bbox_pred, bbox_targets):
+    """Smooth-L1 regression loss of each RoI against its compact target.
+
+    d := w * (b0 - b1)
+    smoothL1(x) = 0.5 * x^2    if |x| < 1
+                  |x| - 0.5    otherwise
+
+    Arguments:
+        bbox_pred (ndarray): R x 4K predicted deltas
+        bbox_targets (ndarray): R x 5 (cls, dx, dy, dw, dh) targets
+
+    Returns:
+        loss (ndarray): R losses, zero for RoIs without a regression target
+    """
+    loss = np.zeros(bbox_targets.shape[0])
+    inds = np.where(bbox_targets[:, 0] > 0)[0]
+    cols = 4 * bbox_targets[inds, 0].astype(np.int64)[:, np.newaxis] + np.arange(4)
+    inside_weights = np.array(cfg.TRAIN.BBOX_INSIDE_WEIGHTS)
+    d = np.abs(inside_weights *
+               (bbox_pred[inds[:, np.newaxis], cols] - bbox_targets[inds, 1:]))
+    smooth_l1 = np.where(d < 1, 0.5 * d * d, d - 0.5)
+    loss[inds] = np.sum(smooth_l1 * (inside_weights > 0), axis=1)
+    return loss
+
+
+def _astn_loss(prob, labels):
+    """Adversarial loss -log(1 - p(label)) averaged over the batch.
+
+    Only the probability of each RoI's own label is gathered (one entry per
+    RoI), and background RoIs contribute neither loss nor gradient.
+
+    Arguments:
+        prob (ndarray): N x K array of class probabilities
+        labels (ndarray): N array of integer class labels
+
+    Returns:
+        loss (float): mean loss over the N RoIs
+        dloss (ndarray): N x K gradient of loss w.r.t. prob
+    """
+    batch_size = prob.shape[0]
+    rows = np.arange(batch_size)
+    fg = labels > 0
+
+    # clamp so that p(label) == 1 does not produce inf
+    prob_rest = np.maximum(1.0 - prob[rows, labels], np.finfo(np.float32).eps)
+
+    loss = np.sum(-np.log(prob_rest) * fg) / batch_size
+
+    dloss = np.zeros(prob.shape, dtype=np.float32)
+    dloss[rows, labels] = fg / prob_rest / batch_size
+
+    return loss, dloss
+
+
+def _debug_writer_from_params(layer_params, default_dir):
+    """Create the debug image writer configured by a layer's param_str.
+
+    Recognized keys are debug_dir (dumps are off unless it exists),
+    debug_sample_rate (fraction of iterations dumped) and debug_queue_size
+    (images held before new ones are dropped).
+    """
+    return AsyncImageWriter(layer_params.get('debug_dir', default_dir),
+                            sample_rate=layer_params.get('debug_sample_rate', 1.0),
+                            max_queue=layer_params.get('debug_queue_size', 64))
+
+
+def _debug_roi_crop(data, roi):
+    """Copy the mean-restored image crop under a (n, x1, y1, x2, y2) RoI."""
+    imid, x1, y1, x2, y2 = [int(v) for v in roi]
+    im = data[imid, :, y1:y2, x1:x2].transpose((1, 2, 0))
+    return im + cfg.PIXEL_MEANS
 
 
 class BlobFetcher(Process):
@@ -11,7 +11,7 @@ import numpy.random as npr
 import cv2
 from fast_rcnn.config import cfg
 from utils.blob import prep_im_for_blob, im_list_to_blob
-from fast_rcnn.nms_wrapper import nms
+from fast_rcnn.nms_wrapper import group_nms
 
 def get_minibatch(roidb, num_classes):
     """Given a roidb, construct a minibatch sampled from it."""
@@ -113,12 +113,10 @@ def get_allrois_minibatch(roidb, num_classes):
         # Now, build the region of interest and label blobs
         rois_blob = np.zeros((0, 5), dtype=np.float32)
         labels_blob = np.zeros((0), dtype=np.float32)
-        bbox_targets_blob = np.zeros((0, 4 * num_classes), dtype=np.float32)
-        bbox_inside_blob = np.zeros(bbox_targets_blob.shape, dtype=np.float32)
+        bbox_targets_blob = np.zeros((0, 5), dtype=np.float32)
 
         for im_i in xrange(num_images):
-            labels, overlaps, im_rois, bbox_targets, bbox_inside_weights \
-                = _all_rois(roidb[im_i], num_classes)
+            labels, overlaps, im_rois, bbox_targets = _all_rois(roidb[im_i])
 
             # Add to RoIs blob
             rois = _project_im_rois(im_rois, im_scales[im_i])
@@ -126,45 +124,37 @@ def get_allrois_minibatch(roidb, num_classes):
             rois_blob_this_image = np.hstack((batch_ind, rois))
             rois_blob = np.vstack((rois_blob, rois_blob_this_image))
 
-            # Add to labels, bbox targets, and bbox loss blobs
+            # Add to labels and bbox targets blobs
             labels_blob = np.hstack((labels_blob, labels))
             bbox_targets_blob = np.vstack((bbox_targets_blob, bbox_targets))
-            bbox_inside_blob = np.vstack((bbox_inside_blob, bbox_inside_weights))
 
         blobs['rois'] = rois_blob
         blobs['labels'] = labels_blob
 
         if cfg.TRAIN.BBOX_REG:
+            # Targets stay in the compact (cls, dx, dy, dw, dh) form; they are
+            # only expanded to 4-of-4*K for the hard RoIs chosen by OHEM
             blobs['bbox_targets'] = bbox_targets_blob
-            blobs['bbox_inside_weights'] = bbox_inside_blob
-            blobs['bbox_outside_weights'] = \
-                np.array(bbox_inside_blob > 0).astype(np.float32)
 
     return blobs
 
 
-def get_ohem_minibatch(loss, rois, labels, bbox_targets=None,
-                       bbox_inside_weights=None, bbox_outside_weights=None):
-    """Given rois and their loss, construct a minibatch using OHEM."""
+def get_ohem_minibatch(loss, rois, labels, bbox_targets=None, num_classes=None):
+    """Given rois and their loss, construct a minibatch using OHEM.
+
+    bbox_targets holds compact (cls, dx, dy, dw, dh) rows; only the selected
+    hard RoIs are expanded to the 4-of-4*K blobs used by the loss.
+    """
     loss = np.array(loss)
 
     if cfg.TRAIN.OHEM_USE_NMS:
-        # Do NMS using loss for de-dup and diversity
-        keep_inds = []
-        nms_thresh = cfg.TRAIN.OHEM_NMS_THRESH
-        source_img_ids = [roi[0] for roi in rois]
-        for img_id in np.unique(source_img_ids):
-            for label in np.unique(labels):
-                sel_indx = np.where(np.logical_and(labels == label, \
-                                    source_img_ids == img_id))[0]
-                if not len(sel_indx):
-                    continue
-                boxes = np.concatenate((rois[sel_indx, 1:],
-                        loss[sel_indx][:,np.newaxis]), axis=1).astype(np.float32)
-                keep_inds.extend(sel_indx[nms(boxes, nms_thresh)])
+        # Do NMS using loss for de-dup and diversity, within every
+        # (image, label) group
+        keep_inds, _ = group_nms(rois[:, 1:], loss, _ohem_groups(rois, labels),
+                                 cfg.TRAIN.OHEM_NMS_THRESH)
 
         hard_keep_inds = select_hard_examples(loss[keep_inds])
-        hard_inds = np.array(keep_inds)[hard_keep_inds]
+        hard_inds = keep_inds[hard_keep_inds]
     else:
         hard_inds = select_hard_examples(loss)
 
@@ -174,38 +164,35 @@ def get_ohem_minibatch(loss, rois, labels, bbox_targets=None,
 
     if bbox_targets is not None:
         assert cfg.TRAIN.BBOX_REG
-        blobs['bbox_targets_hard'] = bbox_targets[hard_inds, :].copy()
-        blobs['bbox_inside_weights_hard'] = bbox_inside_weights[hard_inds, :].copy()
-        blobs['bbox_outside_weights_hard'] = bbox_outside_weights[hard_inds, :].copy()
+        _add_hard_bbox_blobs(blobs, bbox_targets[hard_inds, :], num_classes)
 
     return blobs, hard_inds
 
 
 
 def get_ohem_minibatch_ratio(loss, rois, labels, bbox_targets=None,
-                       bbox_inside_weights=None, bbox_outside_weights=None, ratio=0.25, hard_negative=True):
-    """Given rois and their loss, construct a minibatch using OHEM."""
+                       num_classes=None, ratio=0.25, hard_negative=True):
+    """Given rois and their loss, construct a minibatch using OHEM.
+
+    bbox_targets holds compact (cls, dx, dy, dw, dh) rows; only the selected
+    hard RoIs are expanded to the 4-of-4*K blobs used by the loss.
+    """
     loss = np.array(loss)
 
     if cfg.TRAIN.OHEM_USE_NMS:
         # Do NMS using loss for de-dup and diversity
-        keep_inds = []
-        nms_thresh = cfg.TRAIN.OHEM_NMS_THRESH
-        # nms_thresh_pos = 0.9
-        source_img_ids = [roi[0] for roi in rois]
-        for img_id in np.unique(source_img_ids):
-            for label in np.unique(labels):
-                sel_indx = np.where(np.logical_and(labels == label, \
-                                    source_img_ids == img_id))[0]
-                if not len(sel_indx):
-                    continue
-                boxes = np.concatenate((rois[sel_indx, 1:],
-                        loss[sel_indx][:,np.newaxis]), axis=1).astype(np.float32)
-
-                if label == 0 and hard_negative == True:
-                    keep_inds.extend(sel_indx[nms(boxes, nms_thresh)])
-                else:
-                    keep_inds.extend(sel_indx)
+        groups = _ohem_groups(rois, labels)
+        if hard_negative == True:
+            # only background RoIs are suppressed
+            bg_inds = np.where(labels == 0)[0]
+            keep_bg, _ = group_nms(rois[bg_inds, 1:], loss[bg_inds],
+                                   groups[bg_inds], cfg.TRAIN.OHEM_NMS_THRESH)
+            keep_inds = np.concatenate((bg_inds[keep_bg],
+                                        np.where(labels != 0)[0]))
+        else:
+            keep_inds = np.arange(len(labels))
+        # order by (image, label) group
+        keep_inds = keep_inds[np.argsort(groups[keep_inds], kind='mergesort')]
 
         hard_keep_inds = []
 
@@ -214,7 +201,7 @@ def get_ohem_minibatch_ratio(loss, rois, labels, bbox_targets=None,
         else:
             hard_keep_inds = select_rand_examples_ratio(loss[keep_inds], labels[keep_inds], ratio)
 
-        hard_inds = np.array(keep_inds)[hard_keep_inds]
+        hard_inds = keep_inds[hard_keep_inds]
     else:
         hard_inds = select_hard_examples(loss)
 
@@ -225,15 +212,30 @@ def get_ohem_minibatch_ratio(loss, rois, labels, bbox_targets=None,
     
     if bbox_targets is not None:
         assert cfg.TRAIN.BBOX_REG
-        blobs['bbox_targets_hard'] = bbox_targets[hard_inds, :].copy()
-        blobs['bbox_inside_weights_hard'] = bbox_inside_weights[hard_inds, :].copy()
-        blobs['bbox_outside_weights_hard'] = bbox_outside_weights[hard_inds, :].copy()
+        _add_hard_bbox_blobs(blobs, bbox_targets[hard_inds, :], num_classes)
 
     return blobs, hard_inds
 
 
 
 
+def _ohem_groups(rois, labels):
+    """Group id of every RoI for OHEM NMS: one group per (image, label)."""
+    labels = labels.astype(np.int64)
+    return rois[:, 0].astype(np.int64) * (labels.max() + 1) + labels
+
+def _add_hard_bbox_blobs(blobs, bbox_target_data, num_classes):
+    """Expand the compact targets of the hard RoIs into the loss blobs."""
+    bbox_targets, bbox_inside_weights = _get_bbox_regression_labels(
+            bbox_target_data, num_classes)
+    blobs['bbox_targets_hard'] = bbox_targets
+    blobs['bbox_inside_weights_hard'] = bbox_inside_weights
+    blobs['bbox_outside_weights_hard'] = \
+        np.array(bbox_inside_weights > 0).astype(np.float32)
+
+
+
+
 def select_rand_examples_ratio(loss, labels, ratio=0.25):
     """Select hard rois."""
     # Sort and select top hard examples.
@@ -369,9 +371,9 @@ def _sample_rois(roidb, fg_rois_per_image, rois_per_image, num_classes):
 
     return labels, overlaps, rois, bbox_targets, bbox_inside_weights
 
-def _all_rois(roidb, num_classes):
-    """Generate a random sample of RoIs comprising foreground and background
-    examples.
+def _all_rois(roidb):
+    """Return all foreground and background RoIs of an image, with their
+    regression targets in the compact (cls, dx, dy, dw, dh) form.
     """
     # label = class RoI has max overlap with
     labels = roidb['max_classes']
@@ -395,11 +397,9 @@ def _all_rois(roidb, num_classes):
     labels[len(fg_inds):] = 0
     overlaps = overlaps[keep_inds]
     rois = rois[keep_inds]
+    bbox_targets = roidb['bbox_targets'][keep_inds, :]
 
-    bbox_targets, bbox_inside_weights = _get_bbox_regression_labels(
-            roidb['bbox_targets'][keep_inds, :], num_classes)
-
-    return labels, overlaps, rois, bbox_targets, bbox_inside_weights
+    return labels, overlaps, rois, bbox_targets
 
 def _get_image_blob(roidb, scale_inds):
     """Builds an input blob from the images in the roidb at the specified
@@ -444,12 +444,11 @@ def _get_bbox_regression_labels(bbox_target_data, num_classes):
     bbox_targets = np.zeros((clss.size, 4 * num_classes), dtype=np.float32)
     bbox_inside_weights = np.zeros(bbox_targets.shape, dtype=np.float32)
     inds = np.where(clss > 0)[0]
-    for ind in inds:
-        cls = int(clss[ind])
-        start = 4 * cls
-        end = start + 4
-        bbox_targets[ind, start:end] = bbox_target_data[ind, 1:]
-        bbox_inside_weights[ind, start:end] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
+    # row / column of the 4 active targets of each foreground RoI
+    rows = inds[:, np.newaxis]
+    cols = 4 * clss[inds].astype(np.int64)[:, np.newaxis] + np.arange(4)
+    bbox_targets[rows, cols] = bbox_target_data[inds, 1:]
+    bbox_inside_weights[rows, cols] = cfg.TRAIN.BBOX_INSIDE_WEIGHTS
     return bbox_targets, bbox_inside_weights
 
 def _vis_minibatch(im_blob, rois_blob, labels_blob, overlaps):
@@ -58,20 +58,55 @@ class ProposalLayer(caffe.Layer):
         # take after_nms_topN proposals after NMS
         # return the top proposals (-> RoIs top, scores top)
 
-        assert bottom[0].data.shape[0] == 1, \
-            'Only single item batches are supported'
-
         cfg_key = str(self.phase) # either 'TRAIN' or 'TEST'
-        pre_nms_topN  = cfg[cfg_key].RPN_PRE_NMS_TOP_N
-        post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
-        nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH
-        min_size      = cfg[cfg_key].RPN_MIN_SIZE
 
-        # the first set of _num_anchors channels are bg probs
-        # the second set are the fg probs, which we want
-        scores = bottom[0].data[:, self._num_anchors:, :, :]
-        bbox_deltas = bottom[1].data
-        im_info = bottom[2].data[0, :]
+        # Proposals are generated independently for every image in the batch;
+        # the batch index of each RoI is written to the first rois column
+        rois = []
+        roi_scores = []
+        for n in xrange(bottom[0].data.shape[0]):
+            # the first set of _num_anchors channels are bg probs
+            # the second set are the fg probs, which we want
+            scores = bottom[0].data[n:n + 1, self._num_anchors:, :, :]
+            bbox_deltas = bottom[1].data[n:n + 1]
+            im_info = bottom[2].data[n, :]
+            proposals, scores = self._image_proposals(
+                scores, bbox_deltas, im_info, cfg[cfg_key])
+
+            batch_inds = np.empty((proposals.shape[0], 1), dtype=np.float32)
+            batch_inds.fill(n)
+            rois.append(np.hstack(
+                (batch_inds, proposals.astype(np.float32, copy=False))))
+            roi_scores.append(scores)
+
+        # Output rois blob
+        blob = np.vstack(rois)
+        top[0].reshape(*(blob.shape))
+        top[0].data[...] = blob
+
+        # [Optional] output scores blob
+        if len(top) > 1:
+            scores = np.vstack(roi_scores)
+            top[1].reshape(*(scores.shape))
+            top[1].data[...] = scores
+
+    def _image_proposals(self, scores, bbox_deltas, im_info, phase_cfg):
+        """Generate the proposals of a single image.
+
+        Arguments:
+            scores (ndarray): 1 x A x H x W fg probabilities
+            bbox_deltas (ndarray): 1 x 4A x H x W predicted transformations
+            im_info (ndarray): (height, width, scale) of the image
+            phase_cfg (dict): cfg.TRAIN or cfg.TEST
+
+        Returns:
+            proposals (ndarray): R x 4 proposals, sorted by score
+            scores (ndarray): R x 1 proposal scores
+        """
+        pre_nms_topN  = phase_cfg.RPN_PRE_NMS_TOP_N
+        post_nms_topN = phase_cfg.RPN_POST_NMS_TOP_N
+        nms_thresh    = phase_cfg.RPN_NMS_THRESH
+        min_size      = phase_cfg.RPN_MIN_SIZE
 
         if DEBUG:
             print 'im_size: ({}, {})'.format(im_info[0], im_info[1])
@@ -141,24 +176,12 @@ class ProposalLayer(caffe.Layer):
         # 6. apply nms (e.g. threshold = 0.7)
         # 7. take after_nms_topN (e.g. 300)
         # 8. return the top proposals (-> RoIs top)
-        keep = nms(np.hstack((proposals, scores)), nms_thresh)
-        if post_nms_topN > 0:
-            keep = keep[:post_nms_topN]
+        keep = nms(np.hstack((proposals, scores)), nms_thresh,
+                   max_num=post_nms_topN)
         proposals = proposals[keep, :]
         scores = scores[keep]
 
-        # Output rois blob
-        # Our RPN implementation only supports a single input image, so all
-        # batch inds are 0
-        batch_inds = np.zeros((proposals.shape[0], 1), dtype=np.float32)
-        blob = np.hstack((batch_inds, proposals.astype(np.float32, copy=False)))
-        top[0].reshape(*(blob.shape))
-        top[0].data[...] = blob
-
-        # [Optional] output scores blob
-        if len(top) > 1:
-            top[1].reshape(*(scores.shape))
-            top[1].data[...] = scores
+        return proposals, scores
 
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
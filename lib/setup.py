@@ -122,6 +122,20 @@ ext_modules = [
         extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
         include_dirs = [numpy_include]
     ),
+    Extension(
+        "nms.cpu_bitmask_nms",
+        ["nms/cpu_bitmask_nms.pyx"],
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function",
+                                    "-fopenmp"]},
+        extra_link_args=['-fopenmp'],
+        include_dirs = [numpy_include]
+    ),
+    Extension(
+        "nms.cpu_group_nms",
+        ["nms/cpu_group_nms.pyx"],
+        extra_compile_args={'gcc': ["-Wno-cpp", "-Wno-unused-function"]},
+        include_dirs = [numpy_include]
+    ),
     Extension('nms.gpu_nms',
         ['nms/nms_kernel.cu', 'nms/gpu_nms.pyx'],
         library_dirs=[CUDA['lib64']],
@@ -28,6 +28,46 @@ def im_list_to_blob(ims):
     blob = blob.transpose(channel_swap)
     return blob
 
+def pack_im_list(ims, gap=0, align=16):
+    """Pack a list of images into a single canvas.
+
+    Images are stacked along the shorter side of the largest image, each
+    starting at a multiple of align pixels and separated by at least gap
+    pixels. Assumes images are already prepared (means subtracted, BGR
+    order, ...).
+
+    Returns:
+        canvas (ndarray): H x W x 3 image holding every input image
+        offsets (ndarray): N x 2 array of (y, x) image origins in the canvas
+    """
+    offsets, canvas_shape = pack_shapes([im.shape[:2] for im in ims],
+                                        gap=gap, align=align)
+    canvas = np.zeros((canvas_shape[0], canvas_shape[1], 3), dtype=np.float32)
+    for i, im in enumerate(ims):
+        y, x = offsets[i]
+        canvas[y:y + im.shape[0], x:x + im.shape[1], :] = im
+    return canvas, offsets
+
+def pack_shapes(shapes, gap=0, align=16):
+    """Lay out images of the given (height, width) shapes as pack_im_list
+    does, without touching any pixels.
+
+    Returns:
+        offsets (ndarray): N x 2 array of (y, x) image origins in the canvas
+        canvas_shape (ndarray): (height, width) of the canvas
+    """
+    shapes = np.array(shapes)
+    # stack vertically for landscape images, horizontally for portrait ones
+    axis = 0 if shapes[:, 1].max() >= shapes[:, 0].max() else 1
+    offsets = np.zeros((len(shapes), 2), dtype=np.int)
+    pos = 0
+    for i in xrange(len(shapes)):
+        offsets[i, axis] = pos
+        pos += shapes[i, axis] + gap
+        pos = int(np.ceil(float(pos) / align)) * align
+    canvas_shape = (offsets + shapes).max(axis=0)
+    return offsets, canvas_shape
+
 def prep_im_for_blob(im, pixel_means, target_size, max_size):
     """Mean subtract and scale an image for use in a blob."""
     im = im.astype(np.float32, copy=False)
@@ -0,0 +1,80 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Background writer for debug images dumped by the training layers."""
+
+import os
+import threading
+import Queue
+
+import numpy as np
+import numpy.random as npr
+import cv2
+
+class AsyncImageWriter(object):
+    """Write debug images to disk from a background thread.
+
+    Images are handed over through a bounded queue. When the queue is full
+    the image is dropped rather than blocking the caller, so enabling debug
+    dumps never stalls the solver on disk I/O.
+    """
+
+    def __init__(self, output_dir, sample_rate=1.0, max_queue=64):
+        self._output_dir = output_dir
+        self._sample_rate = sample_rate
+        self._queue = Queue.Queue(max_queue)
+        self.num_written = 0
+        self.num_dropped = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def enabled(self):
+        """True if the output directory exists and sampling is on."""
+        return self._sample_rate > 0 and os.path.isdir(self._output_dir)
+
+    def sample(self):
+        """Decide whether the current iteration should be dumped."""
+        return self.enabled and npr.random() < self._sample_rate
+
+    def put(self, filename, im, size=None):
+        """Queue an image for writing; drop it if the queue is full.
+
+        Arguments:
+            filename (str): file name relative to the output directory
+            im (ndarray): image with values in [0, 255]; it must not alias
+                memory that the caller will overwrite (e.g., a blob)
+            size (tuple): optional (width, height) to resize to before writing
+
+        Returns:
+            queued (bool): False if the image was dropped
+        """
+        try:
+            self._queue.put_nowait((filename, im, size))
+        except Queue.Full:
+            self.num_dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        """Block until every queued image has been written."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            filename, im, size = self._queue.get()
+            try:
+                if size is not None:
+                    im = cv2.resize(im, size)
+                im = np.clip(im, 0, 255).astype(np.uint8)
+                cv2.imwrite(os.path.join(self._output_dir, filename), im)
+                self.num_written += 1
+            except Exception:
+                # a bad crop must not kill the writer thread
+                self.num_dropped += 1
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,130 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Thread pools with bounded queues for overlapping the stages of testing."""
+
+import collections
+import sys
+import threading
+import time
+import Queue
+
+class _Result(object):
+    """The pending result of one work item."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def _set(self, value=None, exc_info=None):
+        self._value = value
+        self._exc_info = exc_info
+        self._done.set()
+
+    def ready(self):
+        """True once the item has been processed."""
+        return self._done.is_set()
+
+    def get(self):
+        """Block until the item has been processed and return its result.
+
+        An exception raised by the worker is re-raised here.
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+class StagePool(object):
+    """One pipeline stage: worker threads fed through a bounded queue.
+
+    submit() blocks while max_queue items are already waiting, so a fast
+    producer cannot run arbitrarily far ahead of a slow stage. With
+    num_threads == 0 items are processed synchronously by the caller.
+
+    Each worker accumulates the wall time it spends inside func (busy time);
+    everything else since the pool was started is idle time.
+    """
+
+    def __init__(self, name, func, num_threads=1, max_queue=4):
+        self.name = name
+        self._func = func
+        self._num_threads = num_threads
+        self._max_queue = max(max_queue, 1)
+        self._queue = Queue.Queue(self._max_queue)
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._stop_time = None
+        self.busy_time = 0.
+        self.num_items = 0
+
+        self._threads = []
+        for _ in xrange(num_threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, *args):
+        """Queue func(*args) and return a result handle with a get() method."""
+        result = _Result()
+        if self._num_threads == 0:
+            self._process(result, args)
+        else:
+            self._queue.put((result, args))
+        return result
+
+    def imap(self, args_iter):
+        """Yield func(*args) for each args tuple, in order.
+
+        At most max_queue + num_threads items are in flight at any time.
+        """
+        pending = collections.deque()
+        for args in args_iter:
+            pending.append(self.submit(*args))
+            if len(pending) >= self._max_queue + self._num_threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        """Wait for the queued items to finish and stop the workers."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stop_time = time.time()
+
+    @property
+    def idle_time(self):
+        """Worker time not spent in func since the pool was started."""
+        stop_time = self._stop_time or time.time()
+        return max(self._num_threads, 1) * (stop_time - self._start_time) - \
+            self.busy_time
+
+    @property
+    def average_time(self):
+        """Average busy time per item."""
+        return self.busy_time / max(self.num_items, 1)
+
+    def _process(self, result, args):
+        start_time = time.time()
+        try:
+            result._set(self._func(*args))
+        except Exception:
+            result._set(exc_info=sys.exc_info())
+        elapsed = time.time() - start_time
+        with self._lock:
+            self.busy_time += elapsed
+            self.num_items += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._process(*item)
@@ -0,0 +1,23 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Set up paths for the tests (same layout as tools/_init_paths.py)."""
+
+import os.path as osp
+import sys
+
+def add_path(path):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+this_dir = osp.dirname(__file__)
+
+# Add caffe to PYTHONPATH
+caffe_path = osp.join(this_dir, '..', 'caffe-fast-rcnn', 'python')
+add_path(caffe_path)
+
+# Add lib to PYTHONPATH
+lib_path = osp.join(this_dir, '..', 'lib')
+add_path(lib_path)
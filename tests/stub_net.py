@@ -0,0 +1,85 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""A stand-in for a Fast R-CNN caffe.Net that takes proposals as input."""
+
+import threading
+import numpy as np
+
+class _Blob(object):
+
+    def __init__(self, shape):
+        self.data = np.zeros(shape, dtype=np.float32)
+
+    def reshape(self, *shape):
+        self.data = np.zeros(shape, dtype=np.float32)
+
+class StubNet(object):
+    """Scores every RoI score for class 1 and shares the rest evenly among
+    the other classes; the box regression deltas are all zero, so every
+    detection is its proposal.
+
+    The number of images and the data blob shape of every forward pass are
+    recorded in forward_sizes and data_shapes.
+    """
+
+    def __init__(self, num_classes=3, score=0.9):
+        self.num_classes = num_classes
+        self.score = score
+        self.blobs = {'data': _Blob((1, 3, 1, 1)), 'rois': _Blob((1, 5)),
+                      'cls_score': _Blob((1, num_classes))}
+        self.forward_sizes = []
+        self.data_shapes = []
+        self._lock = threading.Lock()
+
+    def forward(self, data, rois):
+        assert self.blobs['data'].data.shape == data.shape
+        assert self.blobs['rois'].data.shape == rois.shape
+        return self._outputs(data, rois.shape[0])
+
+    def _outputs(self, data, num_rois):
+        with self._lock:
+            self.forward_sizes.append(data.shape[0])
+            self.data_shapes.append(data.shape)
+        cls_prob = np.empty((num_rois, self.num_classes), dtype=np.float32)
+        cls_prob[:] = (1. - self.score) / (self.num_classes - 1)
+        cls_prob[:, 1] = self.score
+        bbox_pred = np.zeros((num_rois, 4 * self.num_classes),
+                             dtype=np.float32)
+        return {'cls_prob': cls_prob, 'bbox_pred': bbox_pred}
+
+def grid_boxes(height, width, size=40, stride=100):
+    """Non-overlapping size x size proposals every stride pixels."""
+    xs, ys = np.meshgrid(np.arange(0, width - size, stride),
+                         np.arange(0, height - size, stride))
+    x1 = xs.ravel().astype(np.float32)
+    y1 = ys.ravel().astype(np.float32)
+    return np.vstack((x1, y1, x1 + size - 1, y1 + size - 1)).T
+
+class StubRPNNet(StubNet):
+    """A StubNet that makes its own proposals: one RoI around the pixels of
+    each of colors (uint8 gray levels) in every image of the data blob.
+    """
+
+    def __init__(self, colors, num_classes=3, score=0.9):
+        super(StubRPNNet, self).__init__(num_classes, score)
+        self.colors = colors
+        del self.blobs['rois']
+        self.blobs['im_info'] = _Blob((1, 3))
+
+    def forward(self, data, im_info):
+        from fast_rcnn.config import cfg
+        assert self.blobs['data'].data.shape == data.shape
+        assert self.blobs['im_info'].data.shape == im_info.shape
+        rois = []
+        for i in xrange(data.shape[0]):
+            levels = np.round(data[i, 0] + cfg.PIXEL_MEANS[0, 0, 0])
+            for color in self.colors:
+                ys, xs = np.nonzero(levels == color)
+                if len(xs) > 0:
+                    rois.append((i, xs.min(), ys.min(), xs.max(), ys.max()))
+        self.blobs['rois'] = _Blob((len(rois), 5))
+        self.blobs['rois'].data[...] = np.array(rois).reshape((-1, 5))
+        return self._outputs(data, len(rois))
@@ -0,0 +1,85 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Check the ASTN loss and its gradient.
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import _init_paths
+import unittest
+import numpy as np
+
+try:
+    from roi_data_layer.layer import _astn_loss
+except ImportError:
+    # roi_data_layer.layer needs caffe and cv2
+    _astn_loss = None
+
+def _old_astn_loss(prob, labels):
+    """The original B x B formulation of ASTNLossLayer.forward."""
+    batch_size = prob.shape[0]
+    loss = -np.log(1 - prob[range(batch_size), labels])
+    dloss = 1 / (1 - prob[:, labels])
+    for i in range(batch_size):
+        if labels[i] == 0:
+            loss[i] = 0.0
+            dloss[i] = 0.0
+    return np.sum(loss) / batch_size, dloss / batch_size
+
+def _random_batch(rng, batch_size=8, num_classes=5):
+    prob = rng.rand(batch_size, num_classes)
+    prob /= prob.sum(axis=1)[:, np.newaxis]
+    # mixed foreground and background labels
+    labels = rng.randint(0, num_classes, batch_size).astype(np.int32)
+    labels[:2] = (0, 1)
+    return prob, labels
+
+@unittest.skipIf(_astn_loss is None, 'caffe and cv2 are required')
+class TestASTNLoss(unittest.TestCase):
+
+    def test_numerical_gradient(self):
+        rng = np.random.RandomState(0)
+        prob, labels = _random_batch(rng)
+        # one foreground probability close to 1
+        prob[1, labels[1]] = 0.999
+        loss, dloss = _astn_loss(prob, labels)
+        step = 1e-7
+        num_dloss = np.zeros(prob.shape)
+        for i in xrange(prob.shape[0]):
+            for j in xrange(prob.shape[1]):
+                plus, minus = prob.copy(), prob.copy()
+                plus[i, j] += step
+                minus[i, j] -= step
+                num_dloss[i, j] = (_astn_loss(plus, labels)[0] -
+                                   _astn_loss(minus, labels)[0]) / (2 * step)
+        np.testing.assert_allclose(dloss, num_dloss, rtol=1e-4, atol=1e-6)
+        # background RoIs get no gradient
+        self.assertTrue(np.all(dloss[labels == 0] == 0))
+
+    def test_eps_clamp(self):
+        prob = np.array([[0., 1.], [0., 1. - 1e-12], [1., 0.]])
+        labels = np.array([1, 1, 0], dtype=np.int32)
+        loss, dloss = _astn_loss(prob, labels)
+        eps = np.finfo(np.float32).eps
+        self.assertTrue(np.isfinite(loss))
+        self.assertTrue(np.all(np.isfinite(dloss)))
+        self.assertAlmostEqual(loss, -2 * np.log(eps) / 3, places=5)
+        np.testing.assert_allclose(dloss[:2, 1], 1 / eps / 3, rtol=1e-6)
+
+    def test_matches_old_formulation(self):
+        rng = np.random.RandomState(1)
+        prob, labels = _random_batch(rng, batch_size=6)
+        loss, dloss = _astn_loss(prob, labels)
+        old_loss, old_dloss = _old_astn_loss(prob, labels)
+        self.assertAlmostEqual(loss, old_loss, places=6)
+        # the old B x B matrix holds d loss_i / d p(i, label_i) on its
+        # diagonal; the new gradient puts it in column label_i of row i
+        rows = np.arange(len(labels))
+        np.testing.assert_allclose(dloss[rows, labels],
+                                   np.diag(old_dloss), rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Resuming a DetectionLog, and starting it over when settings change."""
+
+import _init_paths
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from fast_rcnn.detections import DetectionLog
+
+class TestDetectionLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'detections_log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, settings):
+        log = DetectionLog(self.path, 4, 3, chunk_size=2, settings=settings)
+        for i in xrange(3):
+            log.append(i, np.array([[0, 0, 10, 10, 0.5, 1]],
+                                   dtype=np.float32))
+        # image 2 is still buffered, as if the run crashed here
+        return log
+
+    def test_resume_with_same_settings(self):
+        self._write('abc')
+        log = DetectionLog(self.path, 4, 3, settings='abc')
+        self.assertEqual(log.done, set([0, 1]))
+        self.assertEqual(len(log.load().scores), 2)
+
+    def test_other_settings_start_over(self):
+        self._write('abc')
+        log = DetectionLog(self.path, 4, 3, settings='xyz')
+        self.assertEqual(log.done, set())
+        self.assertEqual(len(log.load().scores), 0)
+        # and the new settings are the ones resumed from now on
+        log.append(3, np.zeros((1, 6), dtype=np.float32))
+        log.flush()
+        self.assertEqual(DetectionLog(self.path, 4, 3, settings='xyz').done,
+                         set([3]))
+
+    def test_other_number_of_images_starts_over(self):
+        self._write('abc')
+        self.assertEqual(DetectionLog(self.path, 5, 3, settings='abc').done,
+                         set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""group_nms must keep the same boxes as cpu_nms applied to every group."""
+
+import _init_paths
+import unittest
+import numpy as np
+
+try:
+    # the compiled kernels (make in lib)
+    from nms.cpu_nms import cpu_nms
+    from fast_rcnn.nms_wrapper import group_nms
+except ImportError:
+    group_nms = None
+
+@unittest.skipIf(group_nms is None, 'the lib extensions are required')
+class TestGroupNMS(unittest.TestCase):
+
+    def _check_matches_cpu_nms(self, dets, groups, thresh=0.3):
+        keep, keep_scores = group_nms(dets[:, :4], dets[:, 4], groups, thresh)
+        expected = []
+        for g in np.unique(groups):
+            inds = np.flatnonzero(groups == g)
+            expected.extend(inds[cpu_nms(dets[inds, :], thresh)])
+        np.testing.assert_array_equal(keep, expected)
+        np.testing.assert_array_equal(keep_scores, dets[keep, 4])
+
+    def _random_dets(self, rng, num_boxes):
+        xy = rng.rand(num_boxes, 2) * 300
+        wh = rng.rand(num_boxes, 2) * 80 + 10
+        scores = rng.rand(num_boxes, 1)
+        return np.hstack((xy, xy + wh, scores)).astype(np.float32)
+
+    def test_distinct_scores(self):
+        rng = np.random.RandomState(0)
+        for num_boxes in (1, 10, 300):
+            dets = self._random_dets(rng, num_boxes)
+            self._check_matches_cpu_nms(dets, rng.randint(0, 4, num_boxes))
+
+    def test_tied_scores(self):
+        # saturated softmax outputs and repeated OHEM losses tie often
+        rng = np.random.RandomState(1)
+        for num_boxes in (10, 17, 60, 300, 2000):
+            dets = self._random_dets(rng, num_boxes)
+            dets[:, 4] = np.minimum(np.round(dets[:, 4] * 3, 1), 1.)
+            self._check_matches_cpu_nms(dets, rng.randint(0, 4, num_boxes))
+
+    def test_empty(self):
+        keep, keep_scores = group_nms(np.zeros((0, 4)), np.zeros(0),
+                                      np.zeros(0, dtype=np.int64), 0.3)
+        self.assertEqual(len(keep), 0)
+        self.assertEqual(len(keep_scores), 0)
+
+if __name__ == '__main__':
+    unittest.main()
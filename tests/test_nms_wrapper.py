@@ -0,0 +1,49 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Choosing NMS backends by name."""
+
+import _init_paths
+import unittest
+import numpy as np
+
+try:
+    from fast_rcnn.config import cfg
+    from fast_rcnn.nms_wrapper import nms, backend_for
+except ImportError:
+    nms = None
+
+@unittest.skipIf(nms is None, 'the fast_rcnn config is required')
+class TestBackendNames(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = (cfg.NMS_BACKEND, cfg.USE_GPU_NMS)
+        self.dets = np.array([[0, 0, 10, 10, 0.9], [1, 1, 11, 11, 0.8]],
+                             dtype=np.float32)
+
+    def tearDown(self):
+        cfg.NMS_BACKEND, cfg.USE_GPU_NMS = self._saved
+
+    def test_configured_backend(self):
+        cfg.NMS_BACKEND = 'py'
+        self.assertEqual(backend_for(10), 'py')
+        self.assertEqual(list(nms(self.dets, 0.3)), [0])
+
+    def test_unknown_backend(self):
+        cfg.NMS_BACKEND = 'bogus'
+        with self.assertRaisesRegexp(ValueError, "'bogus' is unknown.*py"):
+            backend_for(10)
+        cfg.NMS_BACKEND = ''
+        with self.assertRaisesRegexp(ValueError, "'bogus' is unknown"):
+            nms(self.dets, 0.3, backend='bogus')
+
+    def test_gpu_backend_when_disabled(self):
+        cfg.USE_GPU_NMS = False
+        cfg.NMS_BACKEND = 'gpu'
+        with self.assertRaisesRegexp(ValueError, 'USE_GPU_NMS is off'):
+            nms(self.dets, 0.3)
+
+if __name__ == '__main__':
+    unittest.main()
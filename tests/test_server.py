@@ -0,0 +1,150 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Round trips through DetectionServer / DetectionClient on localhost."""
+
+import _init_paths
+import socket
+import threading
+import unittest
+import numpy as np
+
+try:
+    # image preprocessing needs cv2, NMS the compiled kernels (make in lib)
+    import nms.cpu_group_nms
+    from fast_rcnn.server import DetectionServer, DetectionClient, _send_msg
+except ImportError:
+    DetectionServer = None
+from stub_net import StubNet, grid_boxes
+
+@unittest.skipIf(DetectionServer is None, 'cv2 and the lib extensions are required')
+class TestDetectionServer(unittest.TestCase):
+
+    def setUp(self):
+        self.net = StubNet()
+        # a long latency budget so that concurrent requests share batches
+        self.server = DetectionServer(self.net, ('127.0.0.1', 0),
+                                      max_batch_size=4, max_latency=0.5,
+                                      num_threads=2)
+        self.server.start()
+        self.im = np.random.RandomState(0).randint(
+            0, 256, (300, 400, 3)).astype(np.uint8)
+        self.boxes = grid_boxes(300, 400)
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def _detect_concurrently(self, num_clients):
+        results = [None] * num_clients
+
+        def run(i):
+            client = DetectionClient(self.server.address)
+            try:
+                results[i] = client.detect(self.im, self.boxes)
+            except RuntimeError as e:
+                results[i] = e
+            finally:
+                client.close()
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in xrange(num_clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def _check_dets(self, dets):
+        self.assertEqual(dets.shape, (self.boxes.shape[0], 6))
+        order = np.lexsort((dets[:, 0], dets[:, 1]))
+        # zero deltas decode to the proposal, one pixel wider and taller
+        np.testing.assert_allclose(dets[order, :4], self.boxes, atol=1.)
+        self.assertTrue(np.all(dets[:, 5] == 1))
+        np.testing.assert_allclose(dets[:, 4], self.net.score, rtol=1e-6)
+
+    def test_concurrent_requests_are_batched(self):
+        num_clients = 8
+        for dets in self._detect_concurrently(num_clients):
+            self._check_dets(dets)
+
+        client = DetectionClient(self.server.address)
+        stats = client.stats()
+        client.close()
+        self.assertEqual(stats['requests'], num_clients)
+        self.assertEqual(stats['errors'], 0)
+        self.assertLess(stats['batches'], num_clients)
+        self.assertGreater(stats['mean_batch_size'], 1)
+        self.assertGreater(max(self.net.forward_sizes), 1)
+        self.assertLessEqual(max(self.net.forward_sizes), 4)
+        self.assertEqual(sum(self.net.forward_sizes), num_clients)
+        for p in (50, 95, 99):
+            self.assertGreater(stats['p{:d}_ms'.format(p)], 0)
+        self.assertGreater(stats['throughput'], 0)
+
+    def test_bad_request_only_fails_its_client(self):
+        bad = DetectionClient(self.server.address)
+        # neither raw pixels nor a decodable image
+        _send_msg(bad._wfile, {'op': 'detect'}, ['not an image'])
+        good = self._detect_concurrently(3)
+        with self.assertRaises(RuntimeError):
+            bad._recv()
+        # the connection is still usable after the error reply
+        self._check_dets(bad.detect(self.im, self.boxes))
+        for shape in ([300, 400], [300, 400, 1], [10, 10, 3]):
+            _send_msg(bad._wfile, {'op': 'detect', 'shape': shape},
+                      [np.zeros(shape, dtype=np.uint8).tostring() if
+                       len(shape) == 2 else 'x'])
+            with self.assertRaises(RuntimeError):
+                bad._recv()
+        bad.close()
+        for dets in good:
+            self._check_dets(dets)
+        self.assertEqual(self.server.stats()['requests'], 4)
+
+    def test_header_without_sizes_is_answered(self):
+        sock = socket.create_connection(self.server.address)
+        f = sock.makefile('rwb')
+        data = '{"op": "detect"}'
+        f.write(np.array([len(data)], dtype='>u4').tostring() + data)
+        f.flush()
+        client = DetectionClient(self.server.address)
+        client._rfile.close()
+        client._rfile = f
+        with self.assertRaises(RuntimeError):
+            client._recv()
+        # the server closes the connection, whose framing is lost
+        self.assertEqual(f.read(), '')
+        sock.close()
+        client.close()
+
+@unittest.skipIf(DetectionServer is None, 'cv2 and the lib extensions are required')
+class TestDetectionServerShutdown(unittest.TestCase):
+
+    def _shutdown(self, server):
+        # a hung shutdown() must fail the test, not the test run
+        thread = threading.Thread(target=server.shutdown)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'shutdown() hangs')
+
+    def test_never_started(self):
+        self._shutdown(DetectionServer(StubNet(), ('127.0.0.1', 0)))
+
+    def test_used_through_detect_only(self):
+        net = StubNet()
+        server = DetectionServer(net, ('127.0.0.1', 0), max_latency=0.)
+        im = np.zeros((300, 400, 3), dtype=np.uint8)
+        dets = server.detect(im, grid_boxes(300, 400))
+        self.assertEqual(dets.shape[0], grid_boxes(300, 400).shape[0])
+        self._shutdown(server)
+
+    def test_started_then_shut_down_at_once(self):
+        server = DetectionServer(StubNet(), ('127.0.0.1', 0))
+        server.start()
+        self._shutdown(server)
+
+if __name__ == '__main__':
+    unittest.main()
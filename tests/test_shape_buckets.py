@@ -0,0 +1,89 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Data blob buckets must hold the blobs that testing actually builds."""
+
+import _init_paths
+import unittest
+import numpy as np
+
+try:
+    # image preprocessing needs cv2
+    from fast_rcnn.config import cfg
+    from fast_rcnn.test import _data_shape_buckets, _get_batch_blobs
+except ImportError:
+    _data_shape_buckets = None
+
+class _SizesImdb(object):
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.num_images = len(sizes)
+
+    def image_sizes(self):
+        return self.sizes
+
+    def image_path_at(self, i):
+        raise AssertionError('buckets must not read the images')
+
+@unittest.skipIf(_data_shape_buckets is None, 'cv2 is required')
+class TestShapeBuckets(unittest.TestCase):
+
+    _KEYS = ('SCALES', 'MAX_SIZE', 'PYRAMID_PACK', 'IMS_PER_BATCH', 'HAS_RPN')
+
+    def setUp(self):
+        self._saved = dict((key, cfg.TEST[key]) for key in self._KEYS)
+        cfg.TEST.HAS_RPN = False
+        rng = np.random.RandomState(0)
+        # (width, height), landscape and portrait
+        self.sizes = [tuple(size) for size in rng.randint(200, 700, (24, 2))]
+
+    def tearDown(self):
+        for key, value in self._saved.iteritems():
+            cfg.TEST[key] = value
+
+    def _check_buckets(self):
+        imdb = _SizesImdb(self.sizes)
+        buckets = _data_shape_buckets(imdb, 4)
+        self.assertLessEqual(len(buckets), 4)
+        boxes = np.array([[0, 0, 50, 50]], dtype=np.float32)
+        for start in xrange(0, len(self.sizes), cfg.TEST.IMS_PER_BATCH):
+            ims = [np.zeros((height, width, 3), dtype=np.uint8)
+                   for width, height in
+                   self.sizes[start:start + cfg.TEST.IMS_PER_BATCH]]
+            blobs, _ = _get_batch_blobs(ims, [boxes] * len(ims), buckets)
+            # every batch is padded to a bucket, never left as is
+            self.assertIn(blobs['data'].shape[2:], buckets)
+
+    def test_single_scale(self):
+        cfg.TEST.SCALES = (600,)
+        cfg.TEST.MAX_SIZE = 1000
+        cfg.TEST.PYRAMID_PACK = False
+        cfg.TEST.IMS_PER_BATCH = 1
+        self._check_buckets()
+
+    def test_pyramid(self):
+        cfg.TEST.SCALES = (300, 400, 500, 700)
+        cfg.TEST.MAX_SIZE = 1000
+        cfg.TEST.PYRAMID_PACK = False
+        cfg.TEST.IMS_PER_BATCH = 1
+        self._check_buckets()
+
+    def test_packed_pyramid(self):
+        cfg.TEST.SCALES = (480, 576, 688)
+        cfg.TEST.MAX_SIZE = 1000
+        cfg.TEST.PYRAMID_PACK = True
+        cfg.TEST.IMS_PER_BATCH = 1
+        self._check_buckets()
+
+    def test_batches(self):
+        cfg.TEST.SCALES = (600,)
+        cfg.TEST.MAX_SIZE = 1000
+        cfg.TEST.PYRAMID_PACK = False
+        cfg.TEST.IMS_PER_BATCH = 3
+        self._check_buckets()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""im_detect_tiled with stub networks: tile scale, mapping and seams."""
+
+import _init_paths
+import unittest
+import numpy as np
+
+try:
+    # image preprocessing needs cv2, NMS the compiled kernels (make in lib)
+    import nms.cpu_group_nms
+    from fast_rcnn.config import cfg
+    from fast_rcnn.test import im_detect_tiled, _tile_starts
+except ImportError:
+    im_detect_tiled = None
+from stub_net import StubNet, StubRPNNet, grid_boxes
+
+def _sorted(dets):
+    return dets[np.lexsort((dets[:, 0], dets[:, 1])), :]
+
+@unittest.skipIf(im_detect_tiled is None, 'cv2 and the lib extensions are required')
+class TestTiledDetection(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = (cfg.TEST.SCALES, cfg.TEST.MAX_SIZE, cfg.TEST.HAS_RPN,
+                       cfg.TEST.IMS_PER_BATCH)
+        # tiles would be upscaled twice if they were tested like images
+        cfg.TEST.SCALES = (600,)
+        cfg.TEST.MAX_SIZE = 1000
+        cfg.TEST.IMS_PER_BATCH = 2
+
+    def tearDown(self):
+        (cfg.TEST.SCALES, cfg.TEST.MAX_SIZE, cfg.TEST.HAS_RPN,
+         cfg.TEST.IMS_PER_BATCH) = self._saved
+
+    def test_tile_starts_cover_the_image(self):
+        self.assertEqual(_tile_starts(700, 300, 100), [0, 200, 400])
+        # the last tile is moved back inside the image, not cut short
+        self.assertEqual(_tile_starts(650, 300, 100), [0, 200, 350])
+        self.assertEqual(_tile_starts(250, 300, 100), [0])
+
+    def test_proposals_map_back_at_native_scale(self):
+        cfg.TEST.HAS_RPN = False
+        net = StubNet()
+        im = np.zeros((500, 650, 3), dtype=np.uint8)
+        boxes = grid_boxes(500, 650, size=40, stride=70)
+        dets = im_detect_tiled(net, im, boxes, max_per_image=0,
+                               tile_size=300, overlap=100)
+
+        # every proposal is detected once, in image coordinates
+        self.assertEqual(dets.shape, (boxes.shape[0], 6))
+        np.testing.assert_allclose(_sorted(dets)[:, :4], boxes, atol=1.)
+        self.assertTrue(np.all(dets[:, 5] == 1))
+        # 2 x 3 tiles of 300 x 300 pixels, two per forward pass
+        self.assertEqual(net.forward_sizes, [2, 2, 2])
+        for shape in net.data_shapes:
+            self.assertEqual(shape[2:], (300, 300))
+
+    def test_seam_duplicates_are_merged(self):
+        cfg.TEST.HAS_RPN = True
+        # tiles x in [0, 299] and [200, 499]
+        im = np.zeros((300, 500, 3), dtype=np.uint8)
+        # whole in both tiles
+        im[100:160, 220:280] = 200
+        # cut by the right border of the first tile, whole in the second
+        im[200:260, 270:330] = 250
+        # only in the first tile
+        im[20:60, 20:60] = 150
+        net = StubRPNNet(colors=(150, 200, 250))
+        dets = im_detect_tiled(net, im, max_per_image=0, tile_size=300,
+                               overlap=100)
+
+        expected = np.array([[20, 20, 59, 59],
+                             [220, 100, 279, 159],
+                             [270, 200, 329, 259]], dtype=np.float32)
+        self.assertEqual(dets.shape, (3, 6))
+        np.testing.assert_allclose(_sorted(dets)[:, :4], expected, atol=1.)
+        np.testing.assert_allclose(dets[:, 4], net.score, rtol=1e-6)
+        for shape in net.data_shapes:
+            self.assertEqual(shape[2:], (300, 300))
+
+    def test_max_per_image_caps_the_merged_detections(self):
+        cfg.TEST.HAS_RPN = False
+        im = np.zeros((500, 650, 3), dtype=np.uint8)
+        boxes = grid_boxes(500, 650, size=40, stride=70)
+        dets = im_detect_tiled(StubNet(), im, boxes, max_per_image=5,
+                               tile_size=300, overlap=100)
+        self.assertEqual(dets.shape[0], 5)
+
+if __name__ == '__main__':
+    unittest.main()
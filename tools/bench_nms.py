@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Check and time the NMS kernels on synthetic proposal sets."""
+
+import _init_paths
+from nms.py_cpu_nms import py_cpu_nms
+from nms.cpu_nms import cpu_nms
+from nms.cpu_bitmask_nms import cpu_bitmask_nms
+from utils.timer import Timer
+import argparse
+import numpy as np
+import sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Benchmark NMS kernels')
+    parser.add_argument('--sizes', dest='sizes',
+                        help='comma-separated numbers of boxes',
+                        default='1000,6000,12000,20000', type=str)
+    parser.add_argument('--thresh', dest='thresh', help='NMS IoU threshold',
+                        default=0.7, type=float)
+    parser.add_argument('--threads', dest='num_threads',
+                        help='threads for cpu_bitmask_nms (0: all cores)',
+                        default=0, type=int)
+    parser.add_argument('--max_num', dest='max_num',
+                        help='stop after keeping this many boxes (0: no limit)',
+                        default=0, type=int)
+    parser.add_argument('--iters', dest='iters', help='timed runs per kernel',
+                        default=3, type=int)
+    parser.add_argument('--py_max', dest='py_max',
+                        help='skip py_cpu_nms above this many boxes',
+                        default=12000, type=int)
+
+    args = parser.parse_args()
+    return args
+
+def random_proposals(num_boxes, im_size=(600, 1000), seed=0):
+    """Score-ranked boxes clustered around a few objects, like RPN output."""
+    rng = np.random.RandomState(seed)
+    num_objects = max(num_boxes // 200, 1)
+    centers = rng.rand(num_objects, 2) * (im_size[1], im_size[0])
+    sizes = np.exp(rng.uniform(np.log(16), np.log(400), (num_objects, 2)))
+    obj = rng.randint(0, num_objects, num_boxes)
+    ctr = centers[obj] + rng.randn(num_boxes, 2) * sizes[obj] * 0.2
+    wh = sizes[obj] * np.exp(rng.randn(num_boxes, 2) * 0.2)
+    dets = np.empty((num_boxes, 5), dtype=np.float32)
+    dets[:, 0:2] = ctr - wh / 2
+    dets[:, 2:4] = ctr + wh / 2
+    dets[:, 4] = rng.rand(num_boxes)
+    return dets
+
+def time_kernel(kernel, dets, thresh, max_num, iters):
+    timer = Timer()
+    for _ in xrange(iters):
+        timer.tic()
+        keep = kernel(dets, thresh, max_num=max_num)
+        timer.toc()
+    return list(keep), timer.average_time
+
+if __name__ == '__main__':
+    args = parse_args()
+    kernels = [('py_cpu_nms', py_cpu_nms),
+               ('cpu_nms', cpu_nms),
+               ('cpu_bitmask_nms',
+                lambda dets, thresh, max_num: cpu_bitmask_nms(
+                    dets, thresh, num_threads=args.num_threads,
+                    max_num=max_num))]
+
+    print '{:>8s} {:>8s}'.format('boxes', 'kept') + \
+          ''.join(' {:>16s}'.format(name) for name, _ in kernels)
+    for num_boxes in [int(x) for x in args.sizes.split(',')]:
+        dets = random_proposals(num_boxes)
+        ref = None
+        times = []
+        for name, kernel in kernels:
+            if name == 'py_cpu_nms' and num_boxes > args.py_max:
+                times.append(None)
+                continue
+            keep, t = time_kernel(kernel, dets, args.thresh, args.max_num,
+                                  args.iters)
+            if ref is None:
+                ref, ref_name = keep, name
+            elif keep != ref:
+                print '{} disagrees with {} at {:d} boxes'.format(
+                    name, ref_name, num_boxes)
+                sys.exit(1)
+            times.append(t)
+        print '{:8d} {:8d}'.format(num_boxes, len(ref)) + \
+              ''.join(' {:>14.2f}ms'.format(t * 1000) if t is not None
+                      else ' {:>16s}'.format('-') for t in times)
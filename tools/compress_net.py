@@ -10,7 +10,11 @@
 """Compress a Fast R-CNN network using truncated SVD."""
 
 import _init_paths
+from fast_rcnn.config import cfg
+from utils.timer import Timer
 import caffe
+from caffe.proto import caffe_pb2
+import google.protobuf.text_format
 import argparse
 import numpy as np
 import os, sys
@@ -27,6 +31,21 @@ def parse_args():
     parser.add_argument('--net', dest='caffemodel',
                         help='model to compress',
                         default=None, type=str)
+    parser.add_argument('--param-budget', dest='param_budget',
+                        help='choose ranks (instead of --def-svd) keeping '
+                             'this fraction of the layers\' weights',
+                        default=None, type=float)
+    parser.add_argument('--latency-budget', dest='latency_budget',
+                        help='choose ranks (instead of --def-svd) keeping '
+                             'this fraction of the layers\' CPU time',
+                        default=None, type=float)
+    parser.add_argument('--layers', dest='layers',
+                        help='comma-separated inner product layers to '
+                             'compress in budget mode',
+                        default='fc6,fc7', type=str)
+    parser.add_argument('--num-rois', dest='num_rois',
+                        help='RoIs per forward pass when timing layers',
+                        default=128, type=int)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -35,21 +54,24 @@ def parse_args():
     args = parser.parse_args()
     return args
 
-def compress_weights(W, l):
+def compress_weights(W, l, svd=None):
     """Compress the weight matrix W of an inner product (fully connected) layer
     using truncated SVD.
 
     Parameters:
     W: N x M weights matrix
     l: number of singular values to retain
+    svd: optional (U, s, V) with at least l leading singular triplets of W
+        (e.g., from randomized_svd); the full SVD is computed otherwise
 
     Returns:
     Ul, L: matrices such that W \approx Ul*L
     """
 
-    # numpy doesn't seem to have a fast truncated SVD algorithm...
-    # this could be faster
-    U, s, V = np.linalg.svd(W, full_matrices=False)
+    if svd is None:
+        U, s, V = np.linalg.svd(W, full_matrices=False)
+    else:
+        U, s, V = svd
 
     Ul = U[:, :l]
     sl = s[:l]
@@ -58,8 +80,217 @@ def compress_weights(W, l):
     L = np.dot(np.diag(sl), Vl)
     return Ul, L
 
+def randomized_svd(W, k, oversample=10, n_iter=2, seed=cfg.RNG_SEED):
+    """Leading k singular triplets of W by randomized range finding.
+
+    See Halko, Martinsson and Tropp, "Finding structure with randomness".
+    n_iter power iterations sharpen the estimate when the spectrum decays
+    slowly, as it does for fully connected layers.
+
+    Returns:
+    U, s, V: N x k, k and k x M such that W \approx U*diag(s)*V
+    """
+    rng = np.random.RandomState(seed)
+    p = min(k + oversample, min(W.shape))
+    Q = np.linalg.qr(np.dot(W, rng.randn(W.shape[1], p).astype(W.dtype)))[0]
+    for _ in xrange(n_iter):
+        Q = np.linalg.qr(np.dot(W.T, Q))[0]
+        Q = np.linalg.qr(np.dot(W, Q))[0]
+    Ub, s, V = np.linalg.svd(np.dot(Q.T, W), full_matrices=False)
+    return np.dot(Q, Ub[:, :k]), s[:k], V[:k, :]
+
+def select_ranks(spectra, energies, shapes, param_budget):
+    """Choose SVD ranks that fit a weight budget with the least energy loss.
+
+    The loss of a layer truncated to rank l is the fraction of its squared
+    Frobenius norm dropped, 1 - sum(s[:l] ** 2) / energy. A rank l factor
+    pair of an N x M layer holds l * (N + M) weights. Singular values are
+    added in order of loss reduction per weight, which is optimal up to the
+    last one because every layer's gains decrease with rank.
+
+    Parameters:
+    spectra: layer -> leading singular values (decreasing)
+    energies: layer -> squared Frobenius norm of the weights
+    shapes: layer -> (N, M)
+    param_budget: total number of weights allowed
+
+    Returns:
+    ranks: layer -> rank, or None to keep the layer uncompressed
+    """
+    names = sorted(spectra)
+    costs = np.array([sum(shapes[name]) for name in names])
+    # every layer keeps at least one singular value
+    budget = param_budget - costs.sum()
+    gains = np.hstack([spectra[name][1:] ** 2 / energies[name] / cost
+                       for name, cost in zip(names, costs)])
+    layer_of = np.hstack([np.tile(k, len(spectra[name]) - 1)
+                          for k, name in enumerate(names)])
+    order = np.argsort(-gains, kind='mergesort')
+    taken = order[np.cumsum(costs[layer_of[order]]) <= budget]
+    ranks = dict((name, 1 + int((layer_of[taken] == k).sum()))
+                 for k, name in enumerate(names))
+
+    # a rank that saves nothing is worse than the original layer
+    for name in names:
+        N, M = shapes[name]
+        if ranks[name] * (N + M) >= N * M:
+            ranks[name] = None
+    return ranks
+
+def energy_loss(s, energy, rank):
+    """Fraction of the squared Frobenius norm dropped by rank truncation."""
+    if rank is None:
+        return 0.
+    return 1. - (s[:rank].astype(np.float64) ** 2).sum() / energy
+
+def write_svd_prototxt(prototxt, ranks, filename):
+    """Write prototxt with every layer in ranks (that has a rank) replaced
+    by a bias-free <name>_L inner product with rank outputs followed by a
+    <name>_U inner product with the original outputs and top.
+    """
+    net_param = caffe_pb2.NetParameter()
+    with open(prototxt, 'rt') as f:
+        google.protobuf.text_format.Merge(f.read(), net_param)
+    assert len(net_param.layers) == 0, 'V1 layer definitions not supported'
+
+    layers = []
+    for layer in net_param.layer:
+        if ranks.get(layer.name) is None:
+            layers.append(layer)
+            continue
+        assert layer.type == 'InnerProduct', \
+            '{} is not an inner product layer'.format(layer.name)
+        L = caffe_pb2.LayerParameter()
+        L.name = layer.name + '_L'
+        L.type = 'InnerProduct'
+        L.bottom.extend(layer.bottom)
+        L.top.append(L.name)
+        L.param.extend(layer.param[:1])
+        L.inner_product_param.num_output = ranks[layer.name]
+        L.inner_product_param.bias_term = False
+        U = caffe_pb2.LayerParameter()
+        U.CopyFrom(layer)
+        U.name = layer.name + '_U'
+        del U.bottom[:]
+        U.bottom.append(L.name)
+        layers.extend([L, U])
+    del net_param.layer[:]
+    net_param.layer.extend(layers)
+
+    with open(filename, 'wt') as f:
+        f.write(google.protobuf.text_format.MessageToString(net_param))
+
+def time_layers(net, start, end, num_rois, iters=10):
+    """Average time of a forward pass from layer start through layer end on
+    a batch of num_rois random inputs.
+    """
+    bottom = net.bottom_names[start][0]
+    shape = (num_rois,) + net.blobs[bottom].data.shape[1:]
+    net.blobs[bottom].reshape(*shape)
+    net.blobs[bottom].data[...] = np.random.randn(*shape)
+    # warm up (and reshape the layers)
+    net.forward(start=start, end=end)
+    timer = Timer()
+    for _ in xrange(iters):
+        timer.tic()
+        net.forward(start=start, end=end)
+        timer.toc()
+    return timer.average_time
+
+def compress_to_budget(args):
+    """Compress the layers in args.layers to a weight or CPU time budget,
+    writing the SVD prototxt and model next to args.caffemodel.
+    """
+    caffe.set_mode_cpu()
+    layer_names = args.layers.split(',')
+    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
+
+    shapes = dict((name, net.params[name][0].data.shape)
+                  for name in layer_names)
+    total_params = sum(N * M for N, M in shapes.itervalues())
+    before = dict((name, time_layers(net, name, name, args.num_rois))
+                  for name in layer_names)
+    total_time = sum(before.itervalues())
+    print 'Uncompressed: {:d} weights, {:.2f}ms per {:d} RoIs'.format(
+        total_params, total_time * 1000, args.num_rois)
+
+    if args.latency_budget is not None:
+        # start from time proportional to weights, then correct by timing
+        fraction = args.latency_budget
+    else:
+        fraction = args.param_budget
+    param_budget = fraction * total_params
+
+    # singular spectra up to the largest rank the budget could allow
+    svds = {}
+    energies = {}
+    for name in layer_names:
+        N, M = shapes[name]
+        W = net.params[name][0].data
+        max_rank = min(int(param_budget / (N + M)), N * M / (N + M), N, M)
+        print '  randomized SVD of {} (rank {:d})...'.format(name, max_rank)
+        svds[name] = randomized_svd(W, max(max_rank, 1))
+        energies[name] = (W.astype(np.float64) ** 2).sum()
+    spectra = dict((name, svds[name][1]) for name in layer_names)
+
+    out_dir = os.path.dirname(args.caffemodel)
+    num_attempts = 3
+    for attempt in xrange(num_attempts):
+        ranks = select_ranks(spectra, energies, shapes, param_budget)
+        out = os.path.splitext(os.path.basename(args.caffemodel))[0] + '_svd'
+        for name in layer_names:
+            if ranks[name] is not None:
+                out += '_{}_{}'.format(name, ranks[name])
+        prototxt_svd = os.path.join(out_dir, out + '.prototxt')
+        write_svd_prototxt(args.prototxt, ranks, prototxt_svd)
+
+        net_svd = caffe.Net(prototxt_svd, args.caffemodel, caffe.TEST)
+        after = {}
+        for name in layer_names:
+            if ranks[name] is None:
+                # kept as is (weights copied from the caffemodel)
+                after[name] = time_layers(net_svd, name, name, args.num_rois)
+                continue
+            Ul, L = compress_weights(None, ranks[name], svds[name])
+            net_svd.params[name + '_L'][0].data[...] = L
+            net_svd.params[name + '_U'][0].data[...] = Ul
+            net_svd.params[name + '_U'][1].data[...] = \
+                net.params[name][1].data
+            after[name] = time_layers(net_svd, name + '_L', name + '_U',
+                                      args.num_rois)
+
+        print 'Ranks for a budget of {:d} weights:'.format(int(param_budget))
+        for name in layer_names:
+            print '  {}: rank {}, energy loss {:.2%}, {:.2f}ms -> ' \
+                  '{:.2f}ms'.format(name, ranks[name],
+                                    energy_loss(spectra[name],
+                                                energies[name], ranks[name]),
+                                    before[name] * 1000, after[name] * 1000)
+        target_time = None if args.latency_budget is None else \
+            args.latency_budget * total_time
+        after_time = sum(after.itervalues())
+        if target_time is None or after_time <= target_time:
+            break
+        if attempt == num_attempts - 1:
+            print 'Warning: still over the latency budget after {:d} ' \
+                  'attempts ({:.2f}ms > {:.2f}ms); writing the last ' \
+                  'attempt'.format(num_attempts, after_time * 1000,
+                                   target_time * 1000)
+            break
+        # small factors run below peak FLOP rate: shrink the weight budget
+        param_budget *= target_time / after_time
+        print 'Over the latency budget, retrying'
+
+    filename = os.path.join(out_dir, out + '.caffemodel')
+    net_svd.save(filename)
+    print 'Wrote svd prototxt to: {:s}'.format(prototxt_svd)
+    print 'Wrote svd model to: {:s}'.format(filename)
+
 def main():
     args = parse_args()
+    if args.param_budget is not None or args.latency_budget is not None:
+        compress_to_budget(args)
+        return
 
     # prototxt = 'models/VGG16/test.prototxt'
     # caffemodel = 'snapshots/vgg16_fast_rcnn_iter_40000.caffemodel'
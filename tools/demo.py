@@ -15,8 +15,9 @@ See README.md for installation instructions before running.
 
 import _init_paths
 from fast_rcnn.config import cfg
-from fast_rcnn.test import im_detect
-from fast_rcnn.nms_wrapper import nms
+from fast_rcnn.test import im_detect, im_detect_tiled
+from fast_rcnn.detection_cache import DetectionCache
+from fast_rcnn.nms_wrapper import group_nms
 from utils.timer import Timer
 import matplotlib.pyplot as plt
 import numpy as np
@@ -69,13 +70,45 @@ def vis_detections(im, class_name, dets, thresh=0.5):
     plt.tight_layout()
     plt.draw()
 
-def demo(net, image_name):
+def demo(net, image_name, cache=None, tile=False):
     """Detect object classes in an image using pre-computed object proposals."""
 
     # Load the demo image
     im_file = os.path.join(cfg.DATA_DIR, 'demo', image_name)
     im = cv2.imread(im_file)
 
+    CONF_THRESH = 0.8
+    NMS_THRESH = 0.3
+    if tile:
+        # Native resolution tiles of cfg.TEST.TILE_SIZE pixels (detections
+        # are suppressed at cfg.TEST.NMS == NMS_THRESH)
+        timer = Timer()
+        timer.tic()
+        dets = im_detect_tiled(net, im, thresh=CONF_THRESH, max_per_image=0)
+        timer.toc()
+        print 'Tiled detection took {:.3f}s for a {:d}x{:d} image'.format(
+            timer.total_time, im.shape[1], im.shape[0])
+        for cls_ind, cls in enumerate(CLASSES[1:]):
+            cls_ind += 1 # because we skipped background
+            vis_detections(im, cls, dets[dets[:, 5] == cls_ind, :5],
+                           thresh=CONF_THRESH)
+        return
+
+    if cache is not None:
+        # Detections of images seen before come straight from the cache
+        # (cached detections are suppressed at cfg.TEST.NMS == NMS_THRESH)
+        timer = Timer()
+        timer.tic()
+        dets = cache.detect(net, im, thresh=CONF_THRESH, max_per_image=0)
+        timer.toc()
+        print 'Detection took {:.6f}s (cache hit rate {:.1%})'.format(
+            timer.total_time, cache.stats()['hit_rate'])
+        for cls_ind, cls in enumerate(CLASSES[1:]):
+            cls_ind += 1 # because we skipped background
+            vis_detections(im, cls, dets[dets[:, 5] == cls_ind, :5],
+                           thresh=CONF_THRESH)
+        return
+
     # Detect all object classes and regress object bounds
     timer = Timer()
     timer.tic()
@@ -84,18 +117,21 @@ def demo(net, image_name):
     print ('Detection took {:.3f}s for '
            '{:d} object proposals').format(timer.total_time, boxes.shape[0])
 
+    # Suppress the boxes of all classes (but background) in one call
+    num_classes = len(CLASSES)
+    cls_boxes = boxes.reshape((-1, num_classes, 4))[:, 1:, :].reshape((-1, 4))
+    cls_scores = scores[:, 1:].ravel()
+    classes = np.tile(np.arange(1, num_classes), scores.shape[0])
+    keep, keep_scores = group_nms(cls_boxes, cls_scores, classes, NMS_THRESH)
+    dets = np.hstack((cls_boxes[keep, :],
+                      keep_scores[:, np.newaxis])).astype(np.float32)
+    classes = classes[keep]
+
     # Visualize detections for each class
-    CONF_THRESH = 0.8
-    NMS_THRESH = 0.3
     for cls_ind, cls in enumerate(CLASSES[1:]):
         cls_ind += 1 # because we skipped background
-        cls_boxes = boxes[:, 4*cls_ind:4*(cls_ind + 1)]
-        cls_scores = scores[:, cls_ind]
-        dets = np.hstack((cls_boxes,
-                          cls_scores[:, np.newaxis])).astype(np.float32)
-        keep = nms(dets, NMS_THRESH)
-        dets = dets[keep, :]
-        vis_detections(im, cls, dets, thresh=CONF_THRESH)
+        vis_detections(im, cls, dets[classes == cls_ind, :],
+                       thresh=CONF_THRESH)
 
 def parse_args():
     """Parse input arguments."""
@@ -107,8 +143,20 @@ def parse_args():
                         action='store_true')
     parser.add_argument('--net', dest='demo_net', help='Network to use [vgg16]',
                         choices=NETS.keys(), default='vgg16')
+    parser.add_argument('--cache', dest='cache_dir',
+                        help='cache detections in this directory',
+                        default=None, type=str)
+    parser.add_argument('--cache_mb', dest='cache_mb',
+                        help='size budget of the detection cache (MB)',
+                        default=1024, type=int)
+    parser.add_argument('--tile', dest='tile',
+                        help='detect in native resolution tiles of '
+                        'cfg.TEST.TILE_SIZE pixels (for large images)',
+                        action='store_true')
 
     args = parser.parse_args()
+    if args.tile and args.cache_dir is not None:
+        parser.error('--tile cannot be combined with --cache')
 
     return args
 
@@ -136,6 +184,11 @@ if __name__ == '__main__':
 
     print '\n\nLoaded network {:s}'.format(caffemodel)
 
+    cache = None
+    if args.cache_dir is not None:
+        cache = DetectionCache(args.cache_dir, caffemodel,
+                               max_bytes=args.cache_mb << 20)
+
     # Warmup on a dummy image
     im = 128 * np.ones((300, 500, 3), dtype=np.uint8)
     for i in xrange(2):
@@ -146,6 +199,8 @@ if __name__ == '__main__':
     for im_name in im_names:
         print '~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~'
         print 'Demo for data/demo/{}'.format(im_name)
-        demo(net, im_name)
+        demo(net, im_name, cache, args.tile)
 
+    if cache is not None:
+        print 'Detection cache: {}'.format(cache.stats())
     plt.show()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------
+# Fast R-CNN with OHEM
+# Licensed under The MIT License [see LICENSE for details]
+# --------------------------------------------------------
+
+"""Serve a Fast R-CNN network on a local socket (see fast_rcnn.server)."""
+
+import _init_paths
+from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
+from fast_rcnn.server import DetectionServer
+from fast_rcnn.test import im_detect
+import caffe
+import argparse
+import pprint
+import numpy as np
+import os, sys
+
+def parse_args():
+    """
+    Parse input arguments
+    """
+    parser = argparse.ArgumentParser(description='Serve a Fast R-CNN network')
+    parser.add_argument('--gpu', dest='gpu_id', help='GPU id to use',
+                        default=0, type=int)
+    parser.add_argument('--cpu', dest='cpu_mode',
+                        help='Use CPU mode (overrides --gpu)',
+                        action='store_true')
+    parser.add_argument('--def', dest='prototxt',
+                        help='prototxt file defining the network',
+                        default=None, type=str)
+    parser.add_argument('--net', dest='caffemodel',
+                        help='model to serve',
+                        default=None, type=str)
+    parser.add_argument('--cfg', dest='cfg_file',
+                        help='optional config file', default=None, type=str)
+    parser.add_argument('--host', dest='host', help='address to listen on',
+                        default='127.0.0.1', type=str)
+    parser.add_argument('--port', dest='port', help='port to listen on',
+                        default=5005, type=int)
+    parser.add_argument('--batch', dest='max_batch_size',
+                        help='max images per forward pass',
+                        default=4, type=int)
+    parser.add_argument('--latency_ms', dest='max_latency_ms',
+                        help='max time a request waits for a batch to fill',
+                        default=10., type=float)
+    parser.add_argument('--threads', dest='num_threads',
+                        help='threads for thresholding and NMS',
+                        default=2, type=int)
+    parser.add_argument('--num_dets', dest='max_per_image',
+                        help='max number of detections per image',
+                        default=100, type=int)
+    parser.add_argument('--det_thresh', dest='det_thresh',
+                        help='detection score threshold',
+                        default=0.8, type=float)
+    parser.add_argument('--set', dest='set_cfgs',
+                        help='set config keys', default=None,
+                        nargs=argparse.REMAINDER)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    print('Called with args:')
+    print(args)
+
+    if args.cfg_file is not None:
+        cfg_from_file(args.cfg_file)
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs)
+
+    print('Using config:')
+    pprint.pprint(cfg)
+
+    if args.cpu_mode:
+        caffe.set_mode_cpu()
+        cfg.USE_GPU_NMS = False
+    else:
+        caffe.set_mode_gpu()
+        caffe.set_device(args.gpu_id)
+        cfg.GPU_ID = args.gpu_id
+    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
+
+    # Warmup on a dummy image
+    im = 128 * np.ones((300, 500, 3), dtype=np.uint8)
+    boxes = None if cfg.TEST.HAS_RPN else np.array([[0, 0, 99, 99]])
+    for i in xrange(2):
+        _, _= im_detect(net, im, boxes)
+
+    server = DetectionServer(net, (args.host, args.port),
+                             max_batch_size=args.max_batch_size,
+                             max_latency=args.max_latency_ms / 1000.,
+                             thresh=args.det_thresh,
+                             max_per_image=args.max_per_image,
+                             num_threads=args.num_threads)
+    print 'Serving {:s} on {:s}:{:d}'.format(
+        os.path.basename(args.caffemodel), *server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pprint.pprint(server.stats())
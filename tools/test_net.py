@@ -9,7 +9,7 @@
 """Test a Fast R-CNN network on an image database."""
 
 import _init_paths
-from fast_rcnn.test import test_net
+from fast_rcnn.test import test_net, test_net_sharded
 from fast_rcnn.config import cfg, cfg_from_file, cfg_from_list
 from datasets.factory import get_imdb
 import caffe
@@ -51,6 +51,13 @@ def parse_args():
     parser.add_argument('--det_thresh', dest='det_thresh',
                         help='detection score threshold',
                         default=0.05, type=float)
+    parser.add_argument('--workers', dest='num_workers',
+                        help='test with this many CPU worker processes',
+                        default=0, type=int)
+    parser.add_argument('--contiguous', dest='contiguous',
+                        help='give each worker a contiguous block of images '
+                             '(default: strided)',
+                        action='store_true')
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -79,14 +86,20 @@ if __name__ == '__main__':
         print('Waiting for {} to exist...'.format(args.caffemodel))
         time.sleep(10)
 
-    caffe.set_mode_gpu()
-    caffe.set_device(args.gpu_id)
-    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
-    net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
-
     imdb = get_imdb(args.imdb_name)
     imdb.competition_mode(args.comp_mode)
     if not cfg.TEST.HAS_RPN:
         imdb.set_proposal_method(cfg.TEST.PROPOSAL_METHOD)
 
+    if args.num_workers > 0:
+        test_net_sharded(args.prototxt, args.caffemodel, imdb,
+                         args.num_workers, max_per_image=args.max_per_image,
+                         thresh=args.det_thresh, strided=not args.contiguous)
+        sys.exit(0)
+
+    caffe.set_mode_gpu()
+    caffe.set_device(args.gpu_id)
+    net = caffe.Net(args.prototxt, args.caffemodel, caffe.TEST)
+    net.name = os.path.splitext(os.path.basename(args.caffemodel))[0]
+
     test_net(net, imdb, max_per_image=args.max_per_image, vis=args.vis, thresh=args.det_thresh)
@@ -15,7 +15,8 @@ traditional R-CNN.
 import _init_paths
 from fast_rcnn.config import cfg, cfg_from_file
 from datasets.factory import get_imdb
-from fast_rcnn.test import im_detect
+from fast_rcnn.test import im_detect_batch
+from fast_rcnn.feature_store import FeatureStore
 from utils.timer import Timer
 import caffe
 import argparse
@@ -24,18 +25,64 @@ import numpy as np
 import numpy.random as npr
 import cv2
 from sklearn import svm
+import multiprocessing
 import os, sys
 
+def extract_features(net, imdb, path, layer='fc7', dtype=np.float32):
+    """
+    Run the net once over the roidb and store the features of every RoI
+    (ground truth and proposals) in a FeatureStore at path. A finished store
+    that matches the roidb is reused.
+    """
+    roidb = imdb.roidb
+    counts = [entry['boxes'].shape[0] for entry in roidb]
+    if FeatureStore.is_complete(path):
+        store = FeatureStore.open(path)
+        if np.array_equal(store.counts, counts):
+            print 'Loaded {:s} features from {:s}'.format(layer, path)
+            return store
+        print 'Features in {:s} do not match the roidb'.format(path)
+
+    dim = net.params['cls_score'][0].data.shape[1]
+    store = FeatureStore.create(path, counts, dim, dtype=dtype)
+    _t = Timer()
+    for start in xrange(0, len(roidb), cfg.TEST.IMS_PER_BATCH):
+        inds = range(start, min(start + cfg.TEST.IMS_PER_BATCH, len(roidb)))
+        ims = []
+        for i in inds:
+            im = cv2.imread(imdb.image_path_at(i))
+            if roidb[i]['flipped']:
+                im = im[:, ::-1, :]
+            ims.append(im)
+        _t.tic()
+        im_detect_batch(net, ims, [roidb[i]['boxes'] for i in inds])
+        _t.toc()
+        # the layer's rows follow the RoIs of the batch, image by image
+        feat = net.blobs[layer].data
+        row = 0
+        for i in inds:
+            store.write(i, feat[row:row + counts[i], :])
+            row += counts[i]
+        print 'extract_features: {:d}/{:d} {:.3f}s' \
+              .format(inds[-1] + 1, len(roidb), _t.average_time)
+    store.finish()
+    return FeatureStore.open(path)
+
 class SVMTrainer(object):
     """
     Trains post-hoc detection SVMs for all classes using the algorithm
     and hyper-parameters of traditional R-CNN.
+
+    Features are read from a FeatureStore built by extract_features; the
+    SVM scores used to mine hard negatives are computed from the stored
+    features and the current cls_score parameters, so the net is never run.
     """
 
-    def __init__(self, net, imdb):
+    def __init__(self, net, imdb, features, num_workers=1):
         self.imdb = imdb
         self.net = net
-        self.layer = 'fc7'
+        self.features = features
+        self.num_workers = num_workers
         self.hard_thresh = -1.0001
         self.neg_iou_thresh = 0.3
 
@@ -48,20 +95,12 @@ class SVMTrainer(object):
 
     def _get_feature_scale(self, num_images=100):
         TARGET_NORM = 20.0 # Magic value from traditional R-CNN
-        _t = Timer()
-        roidb = self.imdb.roidb
         total_norm = 0.0
         count = 0.0
         inds = npr.choice(xrange(self.imdb.num_images), size=num_images,
                           replace=False)
         for i_, i in enumerate(inds):
-            im = cv2.imread(self.imdb.image_path_at(i))
-            if roidb[i]['flipped']:
-                im = im[:, ::-1, :]
-            _t.tic()
-            scores, boxes = im_detect(self.net, im, roidb[i]['boxes'])
-            _t.toc()
-            feat = self.net.blobs[self.layer].data
+            feat = self.features.image(i)
             total_norm += np.sqrt((feat ** 2).sum(axis=1)).sum()
             count += feat.shape[0]
             print('{}/{}: avg feature norm: {:.3f}'.format(i_ + 1, num_images,
@@ -93,15 +132,10 @@ class SVMTrainer(object):
         num_images = len(roidb)
         # num_images = 100
         for i in xrange(num_images):
-            im = cv2.imread(self.imdb.image_path_at(i))
-            if roidb[i]['flipped']:
-                im = im[:, ::-1, :]
             gt_inds = np.where(roidb[i]['gt_classes'] > 0)[0]
-            gt_boxes = roidb[i]['boxes'][gt_inds]
             _t.tic()
-            scores, boxes = im_detect(self.net, im, gt_boxes)
+            feat = self.features.image(i)[gt_inds, :]
             _t.toc()
-            feat = self.net.blobs[self.layer].data
             for j in xrange(1, self.imdb.num_classes):
                 cls_inds = np.where(roidb[i]['gt_classes'][gt_inds] == j)[0]
                 if len(cls_inds) > 0:
@@ -132,34 +166,73 @@ class SVMTrainer(object):
         self.net.params['cls_score'][0].data[cls_ind, :] = w
         self.net.params['cls_score'][1].data[cls_ind] = b
 
-    def train_with_hard_negatives(self):
+    def train_with_hard_negatives(self, num_workers=1):
+        """
+        Mine hard negatives and retrain the SVM of every class, then do one
+        final retraining per class and install the SVMs into the net.
+
+        The hard negatives of a class only depend on that class's SVM, so
+        every class makes its own pass over the stored features. The passes
+        run in a pool of num_workers processes that share the features
+        through the memory-mapped store.
+
+        The initial SVMs are read from the net here and passed to the
+        workers, which never touch the net: it may hold GPU state that is
+        not safe to use after fork.
+        """
+        global _trainer
+        _trainer = self
+        tasks = [(j, self.net.params['cls_score'][0].data[j, :].copy(),
+                  self.net.params['cls_score'][1].data[j].copy())
+                 for j in xrange(1, self.imdb.num_classes)]
+        if num_workers > 1:
+            # forked workers inherit the trainer (and the roidb) from here
+            pool = multiprocessing.Pool(num_workers)
+            results = pool.imap_unordered(_train_class, tasks)
+        else:
+            pool = None
+            results = (_train_class(task) for task in tasks)
+        for j, (w, b), loss_history in results:
+            self.trainers[j].loss_history = loss_history
+            self.update_net(j, w, b)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _train_class(self, j, w, b):
+        """Hard negative passes and final retraining of class j, starting
+        from the SVM (w, b)."""
         _t = Timer()
         roidb = self.imdb.roidb
         num_images = len(roidb)
+        trainer = self.trainers[j]
         # num_images = 100
         for i in xrange(num_images):
-            im = cv2.imread(self.imdb.image_path_at(i))
-            if roidb[i]['flipped']:
-                im = im[:, ::-1, :]
             _t.tic()
-            scores, boxes = im_detect(self.net, im, roidb[i]['boxes'])
+            feat = self.features.image(i)
+            # raw cls_score output (the SVM score) of class j
+            scores = np.dot(feat, w) + b
+            hard_inds = \
+                np.where((scores > self.hard_thresh) &
+                         (roidb[i]['gt_overlaps'][:, j].toarray().ravel() <
+                          self.neg_iou_thresh))[0]
+            if len(hard_inds) > 0:
+                new_w_b = trainer.append_neg_and_retrain(
+                    feat=feat[hard_inds, :])
+                if new_w_b is not None:
+                    w = new_w_b[0].ravel()
+                    b = new_w_b[1]
             _t.toc()
-            feat = self.net.blobs[self.layer].data
-            for j in xrange(1, self.imdb.num_classes):
-                hard_inds = \
-                    np.where((scores[:, j] > self.hard_thresh) &
-                             (roidb[i]['gt_overlaps'][:, j].toarray().ravel() <
-                              self.neg_iou_thresh))[0]
-                if len(hard_inds) > 0:
-                    hard_feat = feat[hard_inds, :].copy()
-                    new_w_b = \
-                        self.trainers[j].append_neg_and_retrain(feat=hard_feat)
-                    if new_w_b is not None:
-                        self.update_net(j, new_w_b[0], new_w_b[1])
-
-            print(('train_with_hard_negatives: '
-                   '{:d}/{:d} {:.3f}s').format(i + 1, len(roidb),
-                                               _t.average_time))
+
+            if (i + 1) % 1000 == 0 or i + 1 == num_images:
+                print(('train_with_hard_negatives ({:s}): '
+                       '{:d}/{:d} {:.3f}s').format(trainer.cls, i + 1,
+                                                   num_images,
+                                                   _t.average_time))
+
+        # One final SVM retraining
+        new_w_b = trainer.append_neg_and_retrain(force=True)
+        return j, new_w_b, trainer.loss_history
 
     def train(self):
         # Initialize SVMs using
@@ -173,21 +246,20 @@ class SVMTrainer(object):
         # Pass over roidb, computing features for positives only
         self.get_pos_examples()
 
-        # Pass over roidb
-        #   a. Compute cls_score with forward pass
-        #   b. For each class
-        #       i. Select hard negatives
-        #       ii. Add them to cache
-        #   c. For each class
-        #       i. If SVM retrain criteria met, update SVM
-        #       ii. Install new SVM into net
-        self.train_with_hard_negatives()
-
+        # For each class (in parallel), pass over roidb
+        #   a. Compute the class's SVM scores from the stored features
+        #   b. Select hard negatives
+        #   c. Add them to cache
+        #   d. If SVM retrain criteria met, update SVM
         # One final SVM retraining for each class
         # Install SVMs into net
-        for j in xrange(1, self.imdb.num_classes):
-            new_w_b = self.trainers[j].append_neg_and_retrain(force=True)
-            self.update_net(j, new_w_b[0], new_w_b[1])
+        self.train_with_hard_negatives(self.num_workers)
+
+# SVMTrainer whose classes the train_with_hard_negatives workers train
+_trainer = None
+
+def _train_class(task):
+    return _trainer._train_class(*task)
 
 class SVMClassTrainer(object):
     """Manages post-hoc SVM training for a single object class."""
@@ -195,7 +267,10 @@ class SVMClassTrainer(object):
     def __init__(self, cls, dim, feature_scale=1.0,
                  C=0.001, B=10.0, pos_weight=2.0):
         self.pos = np.zeros((0, dim), dtype=np.float32)
-        self.neg = np.zeros((0, dim), dtype=np.float32)
+        # negatives cache: the first num_neg rows of a buffer that grows
+        # geometrically, so appends are amortized O(1) per row
+        self._neg = np.zeros((0, dim), dtype=np.float32)
+        self.num_neg = 0
         self.B = B
         self.C = C
         self.cls = cls
@@ -216,6 +291,20 @@ class SVMClassTrainer(object):
         self.pos_cur = 0
         self.pos = np.zeros((count, self.dim), dtype=np.float32)
 
+    @property
+    def neg(self):
+        return self._neg[:self.num_neg]
+
+    def _append_neg(self, feat):
+        num = feat.shape[0]
+        if self.num_neg + num > self._neg.shape[0]:
+            capacity = max(2 * self._neg.shape[0], self.num_neg + num, 1024)
+            neg = np.empty((capacity, self.dim), dtype=np.float32)
+            neg[:self.num_neg] = self.neg
+            self._neg = neg
+        self._neg[self.num_neg:self.num_neg + num] = feat
+        self.num_neg += num
+
     def append_pos(self, feat):
         num = feat.shape[0]
         self.pos[self.pos_cur:self.pos_cur + num, :] = feat
@@ -259,7 +348,7 @@ class SVMClassTrainer(object):
     def append_neg_and_retrain(self, feat=None, force=False):
         if feat is not None:
             num = feat.shape[0]
-            self.neg = np.vstack((self.neg, feat))
+            self._append_neg(feat)
             self.num_neg_added += num
         if self.num_neg_added > self.retrain_limit or force:
             self.num_neg_added = 0
@@ -268,8 +357,9 @@ class SVMClassTrainer(object):
             # easy_inds = np.where(neg_scores < self.evict_thresh)[0]
             not_easy_inds = np.where(neg_scores >= self.evict_thresh)[0]
             if len(not_easy_inds) > 0:
-                self.neg = self.neg[not_easy_inds, :]
-                # self.neg = np.delete(self.neg, easy_inds)
+                # compact the kept negatives to the front of the buffer
+                self._neg[:len(not_easy_inds)] = self._neg[not_easy_inds]
+                self.num_neg = len(not_easy_inds)
             print('    Pruning easy negatives')
             print('    Cache holds {} pos examples and {} neg examples'.
                   format(self.pos.shape[0], self.neg.shape[0]))
@@ -297,6 +387,15 @@ def parse_args():
     parser.add_argument('--imdb', dest='imdb_name',
                         help='dataset to train on',
                         default='voc_2007_trainval', type=str)
+    parser.add_argument('--features', dest='feature_dir',
+                        help='fc7 feature store (default: next to the model)',
+                        default=None, type=str)
+    parser.add_argument('--feature_dtype', dest='feature_dtype',
+                        help='precision of the stored features',
+                        default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--workers', dest='num_workers',
+                        help='processes training the class SVMs in parallel',
+                        default=multiprocessing.cpu_count(), type=int)
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -310,8 +409,8 @@ if __name__ == '__main__':
     # pull out features (tricky!)
     cfg.DEDUP_BOXES = 0
 
-    # Must turn this on because we use the test im_detect() method to harvest
-    # hard negatives
+    # Feature extraction runs the test im_detect() path; hard negatives are
+    # scored with the raw cls_score outputs (the SVM scores)
     cfg.TEST.SVM = True
 
     args = parse_args()
@@ -346,7 +445,15 @@ if __name__ == '__main__':
         imdb.append_flipped_images()
         print 'done'
 
-    SVMTrainer(net, imdb).train()
+    feature_dir = args.feature_dir
+    if feature_dir is None:
+        feature_dir = os.path.join(out_dir, '{}_{}_fc7'.format(
+            net.name, imdb.name + ('_flipped' if cfg.TRAIN.USE_FLIPPED
+                                   else '')))
+    features = extract_features(net, imdb, feature_dir,
+                                dtype=np.dtype(args.feature_dtype))
+
+    SVMTrainer(net, imdb, features, num_workers=args.num_workers).train()
 
     filename = '{}/{}.caffemodel'.format(out_dir, out)
     net.save(filename)